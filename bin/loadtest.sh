@@ -0,0 +1,8 @@
+#!/bin/bash
+
+set -e
+
+# Change to the project root.
+cd "$(git rev-parse --show-toplevel 2>/dev/null)"
+
+PYTHONPATH=. python -m carto_renderer.test.loadtest "$@"
@@ -0,0 +1,111 @@
+"""
+Admission control: bound the requests being worked on and waiting.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+from carto_renderer import metrics
+from carto_renderer.errors import ServiceUnavailable
+from carto_renderer.util import get_logger
+
+ADMITTED = metrics.Gauge(
+    'carto_renderer_admission_in_flight',
+    'Requests admitted and being worked on.')
+QUEUED = metrics.Gauge(
+    'carto_renderer_admission_queued',
+    'Requests waiting to be admitted.')
+REJECTED = metrics.Counter(
+    'carto_renderer_admission_rejected_total',
+    'Requests turned away with a 503, by reason.',
+    labels=['reason'])
+QUEUE_FULL = REJECTED.labels('queue_full')
+DEADLINE = REJECTED.labels('deadline')
+
+
+class AdmissionControl(object):
+    """
+    Let at most max_in_flight requests work at once, queueing up to
+    max_queue more in arrival order.
+
+    Anything beyond that, or anything still queued at its deadline, is
+    refused with ServiceUnavailable, asking the client to retry after
+    retry_after seconds. Only use it from the IOLoop's thread.
+    """
+    def __init__(self, max_in_flight, max_queue, retry_after=1,
+                 clock=time.monotonic):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.clock = clock
+        self.in_flight = 0
+        self._waiters = deque()
+
+    @property
+    def queued(self):
+        """
+        The number of requests waiting for a slot.
+        """
+        return len(self._waiters)
+
+    async def acquire(self, deadline=None):
+        """
+        Wait for a slot; deadline is a clock() time, or None to wait as
+        long as it takes.
+        """
+        logger = get_logger(self)
+
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self._admit()
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            logger.warn('Shedding load: %d in flight, %d queued',
+                        self.in_flight, len(self._waiters))
+            QUEUE_FULL.inc()
+            raise ServiceUnavailable('Too busy; try again later.',
+                                     self.retry_after)
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        QUEUED.inc()
+        try:
+            timeout = None if deadline is None else \
+                max(deadline - self.clock(), 0)
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            logger.info('Deadline passed while queued')
+            DEADLINE.inc()
+            raise ServiceUnavailable('Deadline passed while queued.',
+                                     self.retry_after)
+        except asyncio.CancelledError:
+            # A slot handed over just before cancelling must go back.
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                QUEUED.dec()
+
+    def _admit(self):
+        """
+        Take a slot.
+        """
+        self.in_flight += 1
+        ADMITTED.inc()
+
+    def release(self):
+        """
+        Give a slot back, handing it to the longest waiting request.
+        """
+        self.in_flight -= 1
+        ADMITTED.dec()
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            QUEUED.dec()
+            if not waiter.done():
+                self._admit()
+                waiter.set_result(None)
+                return
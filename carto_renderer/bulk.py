@@ -0,0 +1,430 @@
+"""
+Render tiles offline, in parallel, into an MBTiles file or a z/x/y tree.
+
+Jobs are /render payloads that also name their tile with 'z', 'x' and
+'y' (XYZ numbering; 'z' is also the zoom rendered at). They are read as
+a stream of msgpack maps or as JSON lines, in which WKB features are hex
+strings and only the list layout is supported. A job's 'style' names a
+file of compiled Mapnik XML in the --styles directory, or --styles is
+one file used for every job; the style renderer is never contacted:
+
+    bin/bulk.sh jobs.msgpack --styles styles/ --output seed.mbtiles
+
+Tiles already in the output are skipped, so an interrupted run resumes
+where it stopped. Identical images are stored once: MBTiles output uses
+the deduplicating schema (a tiles view over map and images tables), and
+a z/x/y tree hard-links repeated files.
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import msgpack
+
+from carto_renderer import service
+from carto_renderer.util import get_logger
+
+# Output formats by name: (MBTiles format, file extension).
+TILE_FORMATS = {'png': ('png', 'png'),
+                'png8': ('png', 'png'),
+                'png32': ('png', 'png'),
+                'jpeg': ('jpg', 'jpg'),
+                'webp': ('webp', 'webp')}
+# Jobs queued for the executor per worker process.
+PENDING_PER_WORKER = 4
+
+
+def read_jobs(stream):
+    """
+    Iterate over the jobs in a binary stream of msgpack maps or JSON lines.
+
+    Keys come back as bytes either way, as msgpack's raw mode gives them.
+    """
+    first = stream.peek(1)[:1]
+    if first != b'{':
+        for job in msgpack.Unpacker(stream, raw=True):
+            yield job
+        return
+
+    for line in stream:
+        if line.strip():
+            yield from_json(json.loads(line.decode('utf-8')))
+
+
+def from_json(job):
+    """
+    Convert a JSON job to the form a msgpack one decodes to.
+    """
+    def feature(value):
+        """Hex WKB, or a [hex WKB, properties] pair."""
+        if isinstance(value, list):
+            return (bytes.fromhex(value[0]), value[1])
+        return bytes.fromhex(value)
+
+    converted = {key.encode('utf-8'): value for (key, value) in job.items()}
+    if b'tile' in converted:
+        converted[b'tile'] = {
+            name.encode('utf-8'): [feature(value) for value in features]
+            for (name, features) in converted[b'tile'].items()}
+    return converted
+
+
+@functools.lru_cache(maxsize=256)
+def read_style(path):
+    """
+    Return the compiled style in path, reading each file once per process.
+    """
+    with open(path) as xml:
+        return xml.read()
+
+
+def render_job(key, tile, zoom, style_path, overscan, fmt):
+    """
+    Render one job in a worker process, returning (key, image).
+    """
+    xml = read_style(style_path)
+    image = service.render_blank(tile, zoom, xml, fmt)
+    if image is None:
+        image = service.render_png(tile, zoom, xml, overscan, fmt)
+    return (key, image)
+
+
+class MBTiles(object):
+    """
+    Write tiles to an MBTiles file, batch_size rows to a transaction.
+
+    Images are stored once per distinct content, in the images table;
+    tiles refers to them through map.
+    """
+    def __init__(self, path, fmt, batch_size=500):
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY,
+                                                 value TEXT);
+            CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER,
+                                            tile_column INTEGER,
+                                            tile_row INTEGER,
+                                            tile_id TEXT,
+                                            PRIMARY KEY (zoom_level,
+                                                         tile_column,
+                                                         tile_row));
+            CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY,
+                                               tile_data BLOB);
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT zoom_level, tile_column, tile_row, tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+        """)
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO metadata VALUES (?, ?)',
+            [('name', os.path.splitext(os.path.basename(path))[0]),
+             ('format', fmt),
+             ('type', 'baselayer'),
+             ('version', '1.0')])
+        self.connection.commit()
+
+        self.done = {(zoom, column, (1 << zoom) - 1 - row)
+                     for (zoom, column, row) in self.connection.execute(
+                         'SELECT zoom_level, tile_column, tile_row FROM map')}
+        self.images = {tile_id for (tile_id,) in self.connection.execute(
+            'SELECT tile_id FROM images')}
+        self.batch = []
+        self.new_images = []
+        self.deduplicated = 0
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def add(self, key, image):
+        """
+        Queue the tile (z, x, y) for writing.
+        """
+        tile_id = hashlib.sha1(image).hexdigest()
+        if tile_id in self.images:
+            self.deduplicated += 1
+        else:
+            self.images.add(tile_id)
+            self.new_images.append((tile_id, sqlite3.Binary(image)))
+
+        (zoom, column, row) = key
+        self.batch.append((zoom, column, (1 << zoom) - 1 - row, tile_id))
+        self.done.add(key)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the queued tiles in one transaction.
+        """
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO images VALUES (?, ?)', self.new_images)
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)', self.batch)
+        self.batch = []
+        self.new_images = []
+
+    def close(self):
+        """
+        Flush, record the zoom range and close the file.
+        """
+        self.flush()
+        with self.connection:
+            (low, high) = self.connection.execute(
+                'SELECT MIN(zoom_level), MAX(zoom_level) FROM map').fetchone()
+            if low is not None:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                    [('minzoom', str(low)), ('maxzoom', str(high))])
+        self.connection.close()
+
+
+class TileDirectory(object):
+    """
+    Write tiles to directory/z/x/y.extension.
+
+    Each file is written to a temporary name and renamed into place, so
+    an interrupted run leaves no partial tiles. Repeated images are
+    hard links to the first file written with the same content.
+    """
+    def __init__(self, directory, extension):
+        self.directory = directory
+        self.extension = extension
+        self.first = {}
+        self.deduplicated = 0
+
+    def path(self, key):
+        """
+        Return the file for the tile (z, x, y).
+        """
+        (zoom, column, row) = key
+        return os.path.join(self.directory, str(zoom), str(column),
+                            '{}.{}'.format(row, self.extension))
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def add(self, key, image):
+        """
+        Write the tile (z, x, y).
+        """
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        temporary = os.path.join(directory, '.{}.tmp'.format(
+            os.path.basename(path)))
+
+        digest = hashlib.sha1(image).digest()
+        first = self.first.get(digest)
+        if first is not None:
+            try:
+                if os.path.lexists(temporary):
+                    os.remove(temporary)
+                os.link(first, temporary)
+                os.replace(temporary, path)
+                self.deduplicated += 1
+                return
+            except OSError:
+                pass        # No hard links here; write a copy instead.
+
+        with open(temporary, 'wb') as output:
+            output.write(image)
+        os.replace(temporary, path)
+        self.first.setdefault(digest, path)
+
+    def flush(self):
+        """
+        Nothing is buffered.
+        """
+
+    def close(self):
+        """
+        Nothing to close.
+        """
+
+
+def open_output(path, name, batch_size):
+    """
+    Return the MBTiles file or z/x/y directory to write tiles of format
+    name (see TILE_FORMATS) to.
+    """
+    (mbtiles_format, extension) = TILE_FORMATS[name]
+    if path.endswith('.mbtiles'):
+        return MBTiles(path, mbtiles_format, batch_size)
+    return TileDirectory(path, extension)
+
+
+class Styles(object):
+    """
+    Find the compiled style file for a job's 'style'.
+
+    path is one XML file used for every job, or a directory of them, in
+    which the style names a file (with or without its .xml suffix).
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.isdir(path)
+
+    def __call__(self, style):
+        if not self.directory:
+            return self.path
+        name = os.path.basename(service.to_text(style))
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            path += '.xml'
+        if not os.path.exists(path):
+            raise ValueError('No style file for {!r} in {}'.format(
+                name, self.path))
+        return path
+
+
+class Progress(object):
+    """
+    Count tiles, logging throughput every interval seconds.
+    """
+    def __init__(self, interval=10, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self.started = clock()
+        self.reported = self.started
+        self.rendered = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def tick(self):
+        """
+        Log progress if it is time to.
+        """
+        now = self.clock()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            get_logger(self).info(
+                '%d rendered (%.1f tiles/s), %d skipped, %d failed',
+                self.rendered, self.rendered / (now - self.started),
+                self.skipped, self.failed)
+
+    def summary(self, output):
+        """
+        Return the totals as a dict.
+        """
+        elapsed = self.clock() - self.started
+        return {'rendered': self.rendered,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'deduplicated': output.deduplicated,
+                'seconds': elapsed,
+                'tilesPerSecond': self.rendered / elapsed if elapsed else 0}
+
+
+def run(jobs, styles, output, executor, fmt, max_pending, progress,
+        overwrite=False):
+    """
+    Render jobs on executor into output, keeping at most max_pending
+    renders queued. Failed jobs are logged and counted, not retried.
+    """
+    # pylint: disable=too-many-arguments
+    logger = get_logger()
+    pending = set()
+
+    def collect(done):
+        """Write out finished renders."""
+        for future in done:
+            try:
+                (key, image) = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                logger.error('Render failed: %s', err)
+                progress.failed += 1
+                continue
+            output.add(key, image)
+            progress.rendered += 1
+        progress.tick()
+
+    for job in jobs:
+        try:
+            key = (job[b'z'], job[b'x'], job[b'y'])
+            if not overwrite and key in output:
+                progress.skipped += 1
+                continue
+            pending.add(executor.submit(
+                render_job, key, job[b'tile'], job[b'z'],
+                styles(job[b'style']), job.get(b'overscan', 0), fmt))
+        except (KeyError, ValueError) as err:
+            logger.error('Bad job: %s', err)
+            progress.failed += 1
+            continue
+
+        if len(pending) >= max_pending:
+            (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    collect(wait(pending).done)
+    output.flush()
+
+
+def main(argv=None):
+    # pylint: disable=missing-docstring
+    parser = argparse.ArgumentParser(
+        description='Render tiles offline into MBTiles or a z/x/y tree.')
+    parser.add_argument('jobs', nargs='?', default='-',
+                        help='msgpack or JSON lines jobs; - for stdin.')
+    parser.add_argument('--styles', required=True,
+                        help='A compiled style file, or a directory of them.')
+    parser.add_argument('--output', required=True,
+                        help='A .mbtiles file, or a directory.')
+    parser.add_argument('--format', default='png',
+                        choices=sorted(TILE_FORMATS))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch', type=int, default=500,
+                        help='MBTiles rows per transaction.')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Render tiles already in the output again.')
+    parser.add_argument('--report', type=float, default=10,
+                        help='Seconds between progress lines.')
+    parser.add_argument('--map_cache_styles', type=int, default=64)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    formats = service.make_formats()
+    if args.format not in formats:
+        parser.error('This Mapnik cannot write {}'.format(args.format))
+    workers = min(args.workers, service.MAX_RENDER_WORKERS)
+
+    output = open_output(args.output, args.format, args.batch)
+    executor = service.make_executor(
+        'process', workers,
+        initializer=service.configure_renderer,
+        # Each process renders one tile at a time: one idle map a style.
+        initargs=(args.map_cache_styles, 1))
+    progress = Progress(args.report)
+
+    if args.jobs == '-':
+        stream = sys.stdin.buffer
+    else:
+        stream = open(args.jobs, 'rb')
+    try:
+        run(read_jobs(stream), Styles(args.styles), output, executor,
+            formats[args.format][1], workers * PENDING_PER_WORKER, progress,
+            args.overwrite)
+    finally:
+        executor.shutdown()
+        output.close()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+    print(json.dumps(progress.summary(output), sort_keys=True))
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
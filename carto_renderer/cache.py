@@ -0,0 +1,271 @@
+"""
+Caches for the service: in-process, and on local disk.
+"""
+
+import asyncio
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe LRU cache with an optional TTL (in seconds).
+
+    The cache is bounded by entry count (max_size), by total weight
+    (max_weight, as measured by weigher), or both; None disables a bound.
+    Concurrent fetches of the same missing key share one in-flight fetch,
+    which is cancelled if every fetch waiting on it is cancelled.
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, max_size, ttl=None, clock=time.monotonic,
+                 max_weight=None, weigher=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.max_weight = max_weight
+        self.weigher = weigher or (lambda value: 1)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Return the value for key, or default if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                (value, expires) = entry
+                if expires is None or expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """
+        Store value under key, evicting the least recently used entries.
+        """
+        expires = self.clock() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires)
+            self.weight += self.weigher(value)
+            while self._entries and self._over_budget():
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _over_budget(self):
+        """
+        Whether either bound is exceeded.
+        """
+        return ((self.max_size is not None and
+                 len(self._entries) > self.max_size) or
+                (self.max_weight is not None and
+                 self.weight > self.max_weight))
+
+    def _remove(self, key):
+        """
+        Drop key, which must be present; the caller holds the lock.
+        """
+        (value, _) = self._entries.pop(key)
+        self.weight -= self.weigher(value)
+
+    async def fetch(self, key, thunk):
+        """
+        Return the value for key, awaiting thunk() to fill it on a miss.
+
+        Failures are not cached; every waiter sees the exception.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(thunk())
+            self._pending[key] = task
+            self._waiting[task] = 0
+            task.add_done_callback(lambda done: self._settle(key, done))
+        else:
+            self.coalesced += 1
+
+        self._waiting[task] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiting.get(task) == 1:
+                task.cancel()
+            raise
+        finally:
+            if task in self._waiting:
+                self._waiting[task] -= 1
+
+    def _settle(self, key, task):
+        """
+        Store the result of a finished fetch.
+        """
+        del self._pending[key]
+        del self._waiting[task]
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def stats(self):
+        """
+        Return the counters for this cache.
+        """
+        return {'size': len(self._entries),
+                'maxSize': self.max_size,
+                'weight': self.weight,
+                'maxWeight': self.max_weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'coalesced': self.coalesced,
+                'inFlight': len(self._pending)}
+
+
+class DiskCache(object):
+    """
+    A store of bytes values in a directory, bounded to max_bytes, with an
+    optional TTL (in seconds). Every process using the same directory
+    shares it, and it survives restarts.
+
+    Entries are files named by the SHA-1 of their key. They are written
+    to a temporary file and renamed into place, so readers never see a
+    partial entry, and read through mmap. An entry's modification time
+    is when it was written, its access time when it was last read; once
+    the directory is over max_bytes the least recently read go first.
+    """
+    # pylint: disable=too-many-instance-attributes
+    SUFFIX = '.entry'
+
+    def __init__(self, directory, max_bytes, ttl=None, clock=time.time):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.trim()
+
+    def path(self, key):
+        """
+        Return the file key (str or bytes) is stored in.
+        """
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + self.SUFFIX)
+
+    def get(self, key, default=None):
+        """
+        Return the value for key, or default if it is missing or expired.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as entry:
+                status = os.fstat(entry.fileno())
+                if not status.st_size or (
+                        self.ttl and
+                        status.st_mtime + self.ttl <= self.clock()):
+                    self.misses += 1
+                    return default
+                with mmap.mmap(entry.fileno(), 0,
+                               access=mmap.ACCESS_READ) as mapped:
+                    value = mapped[:]
+        except OSError:
+            # Missing, or removed by another process.
+            self.misses += 1
+            return default
+
+        try:
+            # Record the read for eviction, keeping the write time.
+            os.utime(path, (self.clock(), status.st_mtime))
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store value under key, then evict down to max_bytes.
+        """
+        (handle, temporary) = tempfile.mkstemp(dir=self.directory,
+                                               suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as entry:
+                entry.write(value)
+            os.replace(temporary, self.path(key))
+        except OSError:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            raise
+        self.trim()
+
+    def trim(self):
+        """
+        Remove the least recently read entries until the rest fit in
+        max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue        # Already removed by another process.
+            entries.append((status.st_atime, status.st_size, path))
+
+        entries.sort()
+        self.weight = sum(size for (_, size, _) in entries)
+        self.size = len(entries)
+        for (_, size, path) in entries:
+            if self.weight <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            self.weight -= size
+            self.size -= 1
+
+    def stats(self):
+        """
+        Return the counters for this cache, as seen from this process.
+        """
+        return {'size': self.size,
+                'weight': self.weight,
+                'maxWeight': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
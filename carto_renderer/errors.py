@@ -2,21 +2,62 @@
 Error classes for this service.
 """
 
+import reprlib
+
 from carto_renderer.util import get_logger
 
+# Characters of the request body echoed in logs and error responses.
+MAX_ECHO = 1024
+
+_BODY_REPR = reprlib.Repr()
+_BODY_REPR.maxlevel = 3
+_BODY_REPR.maxstring = _BODY_REPR.maxother = 64
+
+
+def summarise(body, limit=MAX_ECHO):
+    """
+    Return at most limit characters describing a request body.
+
+    Raw bodies are decoded leniently, since they are often binary;
+    decoded payloads are abbreviated rather than formatted in full.
+    """
+    if isinstance(body, bytes):
+        text = body[:limit].decode('utf-8', 'replace')
+    elif isinstance(body, str):
+        text = body
+    else:
+        text = _BODY_REPR.repr(body)
+
+    if len(text) > limit or (isinstance(body, bytes) and len(body) > limit):
+        return text[:limit] + '...'
+    return text
+
 
 class ServiceError(Exception):
     """
     Base class for errors in this service.
+
+    headers are added to the error response; request_body is echoed
+    back, abbreviated by summarise. Errors are logged as they are made,
+    unless they are expected ones, which are logged where they are
+    raised instead.
     """
-    def __init__(self, message, status_code, request_body=None):
+    expected = False
+
+    def __init__(self, message, status_code, request_body=None,
+                 headers=None):
+        # Only the message, so tracebacks do not repeat the whole body.
+        super(ServiceError, self).__init__(message)
         self.status_code = status_code
-        self.request_body = request_body
+        self.request_body = summarise(request_body) if request_body else None
         self.message = message
+        self.headers = headers or {}
+        if self.expected:
+            return
         logger = get_logger(self)
-        if request_body:
+        if self.request_body:
             logger.error('Fatal Error (%d): "%s"; body: "%s"',
-                         status_code, message, request_body)
+                         status_code, message, self.request_body)
         else:
             logger.error('Fatal Error (%d): "%s"', status_code, message)
 
@@ -31,6 +72,39 @@ class BadRequest(ServiceError):
                                          request_body=request_body)
 
 
+class PayloadTooLarge(ServiceError):
+    """
+    Error to throw when a request body is over the configured limits.
+    """
+    def __init__(self, message):
+        super(PayloadTooLarge, self).__init__(message, 413)
+
+
+class ServiceUnavailable(ServiceError):
+    """
+    Error to throw when shedding load; retry_after is in seconds.
+    """
+    expected = True
+
+    def __init__(self, message, retry_after):
+        super(ServiceUnavailable, self).__init__(
+            message, 503, headers={'Retry-After': str(retry_after)})
+
+
+class RequestCancelled(ServiceError):
+    """
+    Error to throw when work is abandoned: the client disconnected (499)
+    or the request's deadline passed (504).
+    """
+    expected = True
+
+    def __init__(self, reason):
+        self.reason = reason
+        super(RequestCancelled, self).__init__(
+            'Request cancelled: {}'.format(reason),
+            499 if reason == 'disconnect' else 504)
+
+
 class PayloadKeyError(ServiceError):
     """
     Error to throw when keys are missing.
@@ -0,0 +1,468 @@
+"""
+Plain-Python geometry helpers for features on their way into Mapnik.
+
+Geometries are (kind, parts) pairs in tile pixel coordinates, where kind
+is POINT, LINESTRING or POLYGON and parts is:
+
+- POINT: a list of (x, y) points.
+- LINESTRING: a list of lines, each a list of (x, y) points.
+- POLYGON: a list of polygons, each a list of closed rings.
+
+A tile layer is either a list of WKB features or, in the columnar layout,
+a map holding every feature's WKB concatenated in 'geometries' and their
+offsets in 'offsets': little-endian uint32s, the start of each feature
+followed by the length of the buffer. An optional 'properties' list holds
+each feature's property map, or nil.
+"""
+
+import struct
+import sys
+from array import array
+
+# These match both the MVT GeomType enum and the WKB base types.
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+# WKB multi-geometry types are the base type plus three.
+WKB_MULTI = 3
+WKB_NDR = 1
+
+# Keys of a columnar layer.
+GEOMETRIES = b'geometries'
+OFFSETS = b'offsets'
+PROPERTIES = b'properties'
+
+
+def _coords(points):
+    """
+    Pack a point list as a WKB point count followed by coordinates.
+    """
+    flat = [coord for point in points for coord in point]
+    return struct.pack('<I{}d'.format(len(flat)), len(points), *flat)
+
+
+def _encode_part(kind, part):
+    """
+    Encode a single point, line or polygon as WKB.
+    """
+    if kind == POINT:
+        return struct.pack('<BIdd', WKB_NDR, POINT, part[0], part[1])
+    if kind == LINESTRING:
+        return struct.pack('<BI', WKB_NDR, LINESTRING) + _coords(part)
+
+    rings = [_coords(ring) for ring in part]
+    return struct.pack('<BII', WKB_NDR, POLYGON, len(rings)) + b''.join(rings)
+
+
+def encode_wkb(kind, parts):
+    """
+    Encode a geometry as little-endian WKB, or return None if it is empty.
+
+    Geometries with more than one part become the matching multi type.
+    """
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return _encode_part(kind, parts[0])
+
+    return struct.pack('<BII', WKB_NDR, kind + WKB_MULTI, len(parts)) + \
+        b''.join(_encode_part(kind, part) for part in parts)
+
+
+def ring_area(ring):
+    """
+    Signed area of a ring by the surveyor's formula.
+    """
+    return sum(x0 * y1 - x1 * y0
+               for ((x0, y0), (x1, y1)) in zip(ring, ring[1:] + ring[:1])) / 2.0
+
+
+def parse_wkb(data, offset=0):
+    """
+    Parse 2D WKB (either byte order) at offset into a (kind, parts) pair.
+
+    Raises ValueError for anything else, e.g. collections or Z/M values.
+    """
+    try:
+        (kind, parts, _) = _parse(data, offset)
+    except (IndexError, struct.error) as err:
+        raise ValueError('Invalid WKB: {}'.format(err))
+    return (kind, parts)
+
+
+def _parse(data, pos):
+    """
+    Parse one WKB geometry at pos, returning (kind, parts, new_pos).
+    """
+    order = data[pos]
+    if order not in (0, 1):
+        raise ValueError('Invalid WKB byte order {}'.format(order))
+    endian = '<' if order == WKB_NDR else '>'
+    (wkb_type,) = struct.unpack_from(endian + 'I', data, pos + 1)
+    pos += 5
+
+    if wkb_type == POINT:
+        return (POINT, [struct.unpack_from(endian + 'dd', data, pos)], pos + 16)
+    if wkb_type == LINESTRING:
+        (line, pos) = _parse_points(data, pos, endian)
+        return (LINESTRING, [line], pos)
+    if wkb_type == POLYGON:
+        (count,) = struct.unpack_from(endian + 'I', data, pos)
+        pos += 4
+        rings = []
+        for _ in range(count):
+            (ring, pos) = _parse_points(data, pos, endian)
+            rings.append(ring)
+        return (POLYGON, [rings], pos)
+    if POINT + WKB_MULTI <= wkb_type <= POLYGON + WKB_MULTI:
+        kind = wkb_type - WKB_MULTI
+        (count,) = struct.unpack_from(endian + 'I', data, pos)
+        pos += 4
+        parts = []
+        for _ in range(count):
+            (part_kind, part, pos) = _parse(data, pos)
+            if part_kind != kind:
+                raise ValueError('Mixed multi-geometry')
+            parts.extend(part)
+        return (kind, parts, pos)
+
+    raise ValueError('Unsupported WKB type {}'.format(wkb_type))
+
+
+def _parse_points(data, pos, endian):
+    """
+    Parse a WKB point count and coordinates, returning (points, new_pos).
+    """
+    (count,) = struct.unpack_from(endian + 'I', data, pos)
+    coords = struct.unpack_from('{}{}d'.format(endian, count * 2), data, pos + 4)
+    return (list(zip(coords[0::2], coords[1::2])), pos + 4 + count * 16)
+
+
+def count_vertices(kind, parts):
+    """
+    Number of vertices in a geometry.
+    """
+    if kind == POINT:
+        return len(parts)
+    if kind == LINESTRING:
+        return sum(len(line) for line in parts)
+    return sum(len(ring) for polygon in parts for ring in polygon)
+
+
+def wkb_vertices(data, offset=0):
+    """
+    Count the vertices of 2D WKB, reading only its headers and counts.
+
+    Raises ValueError where parse_wkb would.
+    """
+    try:
+        (_, vertices, _) = _scan(data, offset, None, False)
+    except (IndexError, struct.error) as err:
+        raise ValueError('Invalid WKB: {}'.format(err))
+    return vertices
+
+
+def wkb_extent(data, offset=0):
+    """
+    Return (vertices, bounds) for 2D WKB without building its points.
+
+    bounds is (min_x, min_y, max_x, max_y), or None if there are no
+    points. Polygons are bounded by their exterior rings; empty polygons
+    and rings are allowed. Raises ValueError where parse_wkb would.
+    """
+    extent = [float('inf'), float('inf'), float('-inf'), float('-inf')]
+    try:
+        (_, vertices, _) = _scan(data, offset, extent, True)
+    except (IndexError, struct.error) as err:
+        raise ValueError('Invalid WKB: {}'.format(err))
+    if extent[0] > extent[2]:
+        return (vertices, None)
+    return (vertices, tuple(extent))
+
+
+def _scan(data, pos, extent, bounded):
+    """
+    Count the vertices of one WKB geometry at pos, widening extent by
+    those that bound it if bounded; returns (kind, vertices, new_pos).
+    """
+    order = data[pos]
+    if order not in (0, 1):
+        raise ValueError('Invalid WKB byte order {}'.format(order))
+    endian = '<' if order == WKB_NDR else '>'
+    (wkb_type,) = struct.unpack_from(endian + 'I', data, pos + 1)
+    pos += 5
+
+    if wkb_type == POINT:
+        return (POINT,) + _scan_points(data, pos, endian, 1, extent, bounded)
+    if wkb_type == LINESTRING:
+        (count,) = struct.unpack_from(endian + 'I', data, pos)
+        return (LINESTRING,) + _scan_points(data, pos + 4, endian, count,
+                                            extent, bounded)
+    if wkb_type == POLYGON:
+        (count,) = struct.unpack_from(endian + 'I', data, pos)
+        pos += 4
+        vertices = 0
+        for ring in range(count):
+            (points,) = struct.unpack_from(endian + 'I', data, pos)
+            (points, pos) = _scan_points(data, pos + 4, endian, points,
+                                         extent, bounded and ring == 0)
+            vertices += points
+        return (POLYGON, vertices, pos)
+    if POINT + WKB_MULTI <= wkb_type <= POLYGON + WKB_MULTI:
+        (count,) = struct.unpack_from(endian + 'I', data, pos)
+        pos += 4
+        kind = wkb_type - WKB_MULTI
+        vertices = 0
+        for _ in range(count):
+            (part_kind, points, pos) = _scan(data, pos, extent, bounded)
+            if part_kind != kind:
+                raise ValueError('Mixed multi-geometry')
+            vertices += points
+        return (kind, vertices, pos)
+
+    raise ValueError('Unsupported WKB type {}'.format(wkb_type))
+
+
+def _scan_points(data, pos, endian, count, extent, bounded):
+    """
+    Widen extent by count points at pos, if bounded; returns
+    (count, new_pos).
+    """
+    end = pos + count * 16
+    if end > len(data):
+        raise ValueError('Invalid WKB: {} points overrun the buffer'.format(
+            count))
+    if bounded and count:
+        coords = struct.unpack_from('{}{}d'.format(endian, count * 2), data,
+                                    pos)
+        (xs, ys) = (coords[0::2], coords[1::2])
+        extent[:] = (min(extent[0], min(xs)), min(extent[1], min(ys)),
+                     max(extent[2], max(xs)), max(extent[3], max(ys)))
+    return (count, end)
+
+
+def clip(kind, parts, box):
+    """
+    Clip a geometry to box, (min_x, min_y, max_x, max_y).
+
+    Lines crossing the box edge are split; polygon rings are cut along it.
+    """
+    (min_x, min_y, max_x, max_y) = box
+    if kind == POINT:
+        return [(x, y) for (x, y) in parts
+                if min_x <= x <= max_x and min_y <= y <= max_y]
+    if kind == LINESTRING:
+        return [piece for line in parts for piece in _clip_line(line, box)]
+
+    polygons = []
+    for polygon in parts:
+        rings = [_clip_ring(ring, box) for ring in polygon]
+        if rings and len(rings[0]) >= 4:
+            polygons.append([rings[0]] +
+                            [ring for ring in rings[1:] if len(ring) >= 4])
+    return polygons
+
+
+def _clip_line(line, box):
+    """
+    Liang-Barsky clip each segment, joining pieces that stay connected.
+    """
+    pieces = []
+    current = []
+    for (start, end) in zip(line, line[1:]):
+        segment = _clip_segment(start, end, box)
+        if segment is None:
+            if current:
+                pieces.append(current)
+                current = []
+        elif current and current[-1] == segment[0]:
+            current.append(segment[1])
+        else:
+            if current:
+                pieces.append(current)
+            current = list(segment)
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _clip_segment(start, end, box):
+    """
+    Clip one segment to box, returning its visible (start, end) or None.
+    """
+    (min_x, min_y, max_x, max_y) = box
+    ((x0, y0), (x1, y1)) = (start, end)
+    (dx, dy) = (x1 - x0, y1 - y0)
+    (t0, t1) = (0.0, 1.0)
+
+    for (p, q) in ((-dx, x0 - min_x), (dx, max_x - x0),
+                   (-dy, y0 - min_y), (dy, max_y - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+            continue
+        t = q / p
+        if p < 0:
+            if t > t1:
+                return None
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return None
+            t1 = min(t1, t)
+
+    return (start if t0 == 0 else (x0 + t0 * dx, y0 + t0 * dy),
+            end if t1 == 1 else (x0 + t1 * dx, y0 + t1 * dy))
+
+
+def _clip_ring(ring, box):
+    """
+    Sutherland-Hodgman clip a closed ring to box.
+    """
+    (min_x, min_y, max_x, max_y) = box
+    points = ring[:-1]
+    for (axis, bound, lower) in ((0, min_x, True), (0, max_x, False),
+                                 (1, min_y, True), (1, max_y, False)):
+        if not points:
+            break
+        output = []
+        prev = points[-1]
+        prev_in = prev[axis] >= bound if lower else prev[axis] <= bound
+        for point in points:
+            point_in = point[axis] >= bound if lower else point[axis] <= bound
+            if point_in != prev_in:
+                output.append(_intersect(prev, point, axis, bound))
+            if point_in:
+                output.append(point)
+            (prev, prev_in) = (point, point_in)
+        points = output
+
+    return points + points[:1] if points else []
+
+
+def _intersect(start, end, axis, bound):
+    """
+    Where the segment from start to end crosses the line axis == bound.
+    """
+    t = (bound - start[axis]) / (end[axis] - start[axis])
+    other = 1 - axis
+    value = start[other] + t * (end[other] - start[other])
+    return (bound, value) if axis == 0 else (value, bound)
+
+
+def simplify(kind, parts, tolerance):
+    """
+    Drop vertices closer than tolerance to the previous vertex kept.
+
+    Lines keep their end points, and rings stay closed; a ring that would
+    fall below four vertices is left as it was.
+    """
+    if kind == POINT or tolerance <= 0:
+        return parts
+    if kind == LINESTRING:
+        return [_simplify_path(line, tolerance, 2) for line in parts]
+    return [[_simplify_path(ring, tolerance, 4) for ring in polygon]
+            for polygon in parts]
+
+
+def _simplify_path(path, tolerance, minimum):
+    """
+    Radial-distance simplification of one line or ring.
+    """
+    if len(path) <= minimum:
+        return path
+
+    limit = tolerance * tolerance
+    kept = [path[0]]
+    for (x, y) in path[1:-1]:
+        (last_x, last_y) = kept[-1]
+        if (x - last_x) ** 2 + (y - last_y) ** 2 >= limit:
+            kept.append((x, y))
+    kept.append(path[-1])
+    return kept if len(kept) >= minimum else path
+
+
+def prepare_wkb(wkb, box, tolerance):
+    """
+    Clip and simplify a WKB feature for drawing inside box.
+
+    Returns (wkb, vertices_in, vertices_out). wkb is None if nothing is
+    left to draw, and the input itself if it needed no changes. Features
+    wholly inside or outside box are decided from their bounds alone;
+    only those crossing its edge are parsed, clipped and simplified.
+    Features that cannot be parsed are passed through for Mapnik to
+    report.
+    """
+    try:
+        (vertices, extent) = wkb_extent(wkb)
+    except ValueError:
+        return (wkb, 0, 0)
+    if extent is None:
+        return (wkb, vertices, vertices)
+
+    (min_x, min_y, max_x, max_y) = extent
+    if min_x > box[2] or max_x < box[0] or min_y > box[3] or max_y < box[1]:
+        return (None, vertices, 0)
+    if box[0] <= min_x and max_x <= box[2] and \
+       box[1] <= min_y and max_y <= box[3]:
+        return (wkb, vertices, vertices)
+
+    (kind, parts) = parse_wkb(wkb)
+    parts = simplify(kind, clip(kind, parts, box), tolerance)
+    if not parts:
+        return (None, vertices, 0)
+    return (encode_wkb(kind, parts), vertices, count_vertices(kind, parts))
+
+
+def columnar_offsets(layer):
+    """
+    Return a columnar layer's offsets as an array of ints.
+
+    Raises ValueError if they do not fit its buffer.
+    """
+    geometries = layer.get(GEOMETRIES)
+    packed = layer.get(OFFSETS)
+    if not isinstance(geometries, bytes) or not isinstance(packed, bytes):
+        raise ValueError('Columnar layers need "geometries" and "offsets" '
+                         'buffers')
+
+    offsets = array('I')
+    if offsets.itemsize != 4 or len(packed) % 4 or not packed:
+        raise ValueError('Columnar offsets must be packed 32-bit integers')
+    offsets.frombytes(packed)
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+
+    if offsets[0] != 0 or offsets[-1] != len(geometries):
+        raise ValueError('Columnar offsets must run from 0 to the length '
+                         'of the geometries')
+    properties = layer.get(PROPERTIES)
+    if properties is None:
+        return offsets
+    if not isinstance(properties, list) or \
+       not all(entry is None or isinstance(entry, dict)
+               for entry in properties):
+        raise ValueError('Columnar properties must be a list of maps or '
+                         'nils')
+    if len(properties) != len(offsets) - 1:
+        raise ValueError('Columnar properties must have one entry per '
+                         'feature')
+    return offsets
+
+
+def columnar_features(layer):
+    """
+    Iterate over a columnar layer's features as the list layout holds them.
+
+    Each WKB is a memoryview of the shared buffer rather than a copy; with
+    properties, features are (wkb, properties) pairs.
+    """
+    offsets = columnar_offsets(layer)
+    view = memoryview(layer[GEOMETRIES])
+    spans = zip(offsets, offsets[1:])
+    properties = layer.get(PROPERTIES)
+    if properties is None:
+        return (view[start:end] for (start, end) in spans)
+    return ((view[start:end], feature_properties)
+            for ((start, end), feature_properties) in zip(spans, properties))
@@ -0,0 +1,236 @@
+"""
+Lightweight in-process metrics, exposed in the Prometheus text format.
+
+Metrics are kept per process; with several prefork workers, each one
+reports its own.
+"""
+
+import threading
+from bisect import bisect_left
+
+# Seconds, from half a millisecond up to ten seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    """
+    Escape a label value.
+    """
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    """
+    Format (name, value) label pairs, or nothing if there are none.
+    """
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                          for (name, value) in pairs) + '}'
+
+
+def _number(value):
+    """
+    Format a sample value.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Value(object):
+    """
+    A single counter or gauge value.
+    """
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Add amount."""
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        """Subtract amount."""
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        """Replace the value."""
+        self.value = value
+
+    def samples(self, name, pairs):
+        """Yield the exposition lines for this value."""
+        yield '{}{} {}'.format(name, _labels(pairs), _number(self.value))
+
+
+class _Buckets(object):
+    """
+    A single histogram's bucket counts, sum and count.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one observation."""
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, pairs):
+        """Yield the exposition lines for this histogram."""
+        cumulative = 0
+        for (bound, count) in zip(self.bounds + (float('inf'),),
+                                  self.counts):
+            cumulative += count
+            yield '{}_bucket{} {}'.format(
+                name, _labels(pairs + (('le', _number(bound)),)), cumulative)
+        yield '{}_sum{} {}'.format(name, _labels(pairs), _number(self.sum))
+        yield '{}_count{} {}'.format(name, _labels(pairs), self.count)
+
+
+class Metric(object):
+    """
+    A named family of values, one per combination of label values.
+
+    Look values up with labels() once and keep them to stay off the
+    hot path's allocator; unlabelled metrics can be used directly.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._children[()] = self._child()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _child(self):
+        """Make the value for a new combination of labels."""
+        return _Value()
+
+    def labels(self, *values):
+        """
+        Return the value for these label values, creating it if needed.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError('{} takes labels {}'.format(
+                    self.name, self.label_names))
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def collect(self):
+        """
+        Yield the exposition lines for every value in the family.
+        """
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.kind)
+        for (values, child) in sorted(self._children.items()):
+            for line in child.samples(self.name,
+                                      tuple(zip(self.label_names, values))):
+                yield line
+
+
+class Counter(Metric):
+    """
+    A value that only goes up.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        """Add amount to the unlabelled value."""
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down.
+    """
+    kind = 'gauge'
+
+    def inc(self, amount=1):
+        """Add amount to the unlabelled value."""
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        """Subtract amount from the unlabelled value."""
+        self.labels().dec(amount)
+
+    def set(self, value):
+        """Replace the unlabelled value."""
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    """
+    Observations counted into buckets by upper bound.
+    """
+    kind = 'histogram'
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, documentation, labels=(), registry=None,
+                 buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labels,
+                                        registry)
+
+    def _child(self):
+        """Make the buckets for a new combination of labels."""
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        """Record an observation on the unlabelled histogram."""
+        self.labels().observe(value)
+
+
+class Registry(object):
+    """
+    The metrics one endpoint exposes.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """
+        Add metric to those exposed.
+        """
+        self.metrics.append(metric)
+
+    def expose(self, families=()):
+        """
+        Return every metric in the text format.
+
+        families are extra (name, kind, documentation, samples) tuples,
+        for values read at scrape time; samples are (label pairs, value).
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        for (name, kind, documentation, samples) in families:
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend('{}{} {}'.format(name, _labels(pairs), _number(value))
+                         for (pairs, value) in samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
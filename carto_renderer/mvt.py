@@ -0,0 +1,261 @@
+"""
+Decoder for Mapbox Vector Tile payloads (resources/vector_tile.proto).
+
+The protobuf wire format is read directly, so no generated code or
+protobuf runtime is needed.  Features come out in the same shape
+render_png accepts: a (wkb, properties) pair per feature, per layer.
+"""
+
+import struct
+
+from carto_renderer.geometry import (encode_wkb, ring_area,
+                                     LINESTRING, POINT, POLYGON)
+
+# Protobuf wire types.
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# Geometry commands.
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+DEFAULT_EXTENT = 4096
+
+# The wire types each message's fields may have; see _fields. Repeated
+# uint32 fields may be packed or not.
+PACKED = (VARINT, LENGTH_DELIMITED)
+TILE_FIELDS = {3: (LENGTH_DELIMITED,)}
+LAYER_FIELDS = {1: (LENGTH_DELIMITED,), 2: (LENGTH_DELIMITED,),
+                3: (LENGTH_DELIMITED,), 4: (LENGTH_DELIMITED,),
+                5: (VARINT,), 15: (VARINT,)}
+FEATURE_FIELDS = {1: (VARINT,), 2: PACKED, 3: (VARINT,), 4: PACKED}
+VALUE_FIELDS = {1: (LENGTH_DELIMITED,), 2: (FIXED32,), 3: (FIXED64,),
+                4: (VARINT,), 5: (VARINT,), 6: (VARINT,), 7: (VARINT,)}
+
+
+def _varint(data, pos):
+    """
+    Read a varint starting at pos, returning (value, new_pos).
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return (result, pos)
+        shift += 7
+        if shift > 63:
+            raise ValueError('Varint too long')
+
+
+def _zigzag(value):
+    """
+    Undo protobuf zigzag encoding.
+    """
+    return (value >> 1) ^ -(value & 1)
+
+
+def _fields(data, wire_types):
+    """
+    Yield (field number, wire type, value) for each field in a message.
+
+    Length-delimited values are memoryview slices of data. wire_types
+    maps field numbers to the wire types they may have; a field with
+    any other raises ValueError. Unknown fields are skipped over.
+    """
+    data = memoryview(data)
+    pos = 0
+    end = len(data)
+    while pos < end:
+        (key, pos) = _varint(data, pos)
+        (field, wire_type) = (key >> 3, key & 7)
+        if wire_type == VARINT:
+            (value, pos) = _varint(data, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            (length, pos) = _varint(data, pos)
+            if pos + length > end:
+                raise ValueError('Truncated field {}'.format(field))
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type in (FIXED64, FIXED32):
+            length = 8 if wire_type == FIXED64 else 4
+            if pos + length > end:
+                raise ValueError('Truncated field {}'.format(field))
+            value = data[pos:pos + length]
+            pos += length
+        else:
+            raise ValueError('Unsupported wire type {}'.format(wire_type))
+
+        if wire_type not in wire_types.get(field, (wire_type,)):
+            raise ValueError('Field {} has wire type {}'.format(field,
+                                                                wire_type))
+        yield (field, wire_type, value)
+
+
+def _packed(value, wire_type):
+    """
+    Decode a repeated uint32 field, packed or not.
+    """
+    if wire_type == VARINT:
+        return [value]
+
+    result = []
+    pos = 0
+    while pos < len(value):
+        (item, pos) = _varint(value, pos)
+        result.append(item)
+    return result
+
+
+def _decode_value(data):
+    """
+    Decode a Tile.Value into a Python value.
+    """
+    # pylint: disable=too-many-return-statements
+    for (field, _, value) in _fields(data, VALUE_FIELDS):
+        if field == 1:
+            return bytes(value).decode('utf-8')
+        if field == 2:
+            return struct.unpack('<f', value)[0]
+        if field == 3:
+            return struct.unpack('<d', value)[0]
+        if field == 4:
+            return value - (1 << 64) if value >= 1 << 63 else value
+        if field == 5:
+            return value
+        if field == 6:
+            return _zigzag(value)
+        if field == 7:
+            return bool(value)
+    return None
+
+
+def decode_geometry(geom_type, commands, scale, tile_size):
+    """
+    Turn an MVT command stream into a (kind, parts) geometry.
+
+    Coordinates are multiplied by scale to bring them into pixel space,
+    and y is flipped: it points down in MVT, but up in the map the WKB
+    is drawn on.
+    """
+    # pylint: disable=too-many-locals
+    paths = []
+    current = None
+    (x, y) = (0, 0)
+    pos = 0
+    while pos < len(commands):
+        command = commands[pos] & 0x7
+        count = commands[pos] >> 3
+        pos += 1
+
+        if command in (MOVE_TO, LINE_TO):
+            for _ in range(count):
+                x += _zigzag(commands[pos])
+                y += _zigzag(commands[pos + 1])
+                pos += 2
+                if command == MOVE_TO or current is None:
+                    current = []
+                    paths.append(current)
+                current.append((x * scale, tile_size - y * scale))
+        elif command == CLOSE_PATH:
+            if current:
+                current.append(current[0])
+        else:
+            raise ValueError('Unknown geometry command {}'.format(command))
+
+    if geom_type == POINT:
+        return (POINT, [point for path in paths for point in path])
+    if geom_type == LINESTRING:
+        return (LINESTRING, [path for path in paths if len(path) > 1])
+
+    # Exterior rings are clockwise in MVT's y-down space, so have
+    # negative area once flipped; interior rings follow their exterior.
+    polygons = []
+    for ring in paths:
+        area = ring_area(ring)
+        if area < 0 or not polygons:
+            polygons.append([ring])
+        elif area > 0:
+            polygons[-1].append(ring)
+    return (POLYGON, polygons)
+
+
+def _decode_feature(data, keys, values, scale, tile_size):
+    """
+    Decode a Tile.Feature into (wkb, properties).
+    """
+    tags = []
+    geom_type = 0
+    commands = []
+    for (field, wire_type, value) in _fields(data, FEATURE_FIELDS):
+        if field == 2:
+            tags.extend(_packed(value, wire_type))
+        elif field == 3:
+            geom_type = value
+        elif field == 4:
+            commands.extend(_packed(value, wire_type))
+
+    if geom_type not in (POINT, LINESTRING, POLYGON):
+        return None
+
+    properties = {keys[tags[i]]: values[tags[i + 1]]
+                  for i in range(0, len(tags) - 1, 2)}
+    wkb = encode_wkb(*decode_geometry(geom_type, commands, scale,
+                                      tile_size))
+    if wkb is None:
+        return None
+    return (wkb, properties)
+
+
+def _decode_layer(data, tile_size):
+    """
+    Decode a Tile.Layer into (name, [(wkb, properties)]).
+    """
+    name = ''
+    raw_features = []
+    keys = []
+    values = []
+    extent = DEFAULT_EXTENT
+    for (field, _, value) in _fields(data, LAYER_FIELDS):
+        if field == 1:
+            name = bytes(value).decode('utf-8')
+        elif field == 2:
+            raw_features.append(value)
+        elif field == 3:
+            keys.append(bytes(value).decode('utf-8'))
+        elif field == 4:
+            values.append(_decode_value(value))
+        elif field == 5:
+            extent = value
+
+    scale = float(tile_size) / (extent or DEFAULT_EXTENT)
+    features = []
+    for raw in raw_features:
+        feature = _decode_feature(raw, keys, values, scale, tile_size)
+        if feature is not None:
+            features.append(feature)
+    return (name, features)
+
+
+def decode_tile(data, tile_size):
+    """
+    Decode a Tile message into {layer name: [(wkb, properties)]}.
+
+    Layers with the same name are merged.  Raises ValueError on
+    malformed input.
+    """
+    tile = {}
+    try:
+        for (field, _, value) in _fields(data, TILE_FIELDS):
+            if field == 3:
+                (name, features) = _decode_layer(value, tile_size)
+                tile.setdefault(name, []).extend(features)
+    except (IndexError, KeyError, TypeError, struct.error,
+            UnicodeDecodeError) as err:
+        raise ValueError('Invalid vector tile: {}'.format(err))
+    return tile
@@ -0,0 +1,301 @@
+"""
+Pre-fork serving: several worker processes sharing one port.
+
+The parent process only supervises: it forks the workers, replaces any
+that exit (crashed, or recycled after too many requests or too much
+memory) and forwards SIGTERM so every worker drains before it exits.
+"""
+
+import logging
+import os
+import resource
+import signal
+import time
+
+from tornado import gen, httputil
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+
+from carto_renderer.util import get_logger
+
+# Exit status a worker uses when it asks to be replaced.
+RECYCLE_EXIT = 3
+# Workers that die faster than this are restarted with a delay.
+MIN_WORKER_LIFETIME = 1.0
+CHECK_INTERVAL_MS = 1000
+
+
+def current_rss():
+    """
+    Return this process's resident set size in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # Peak, not current, RSS; reported in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Worker(object):
+    """
+    Serve requests in this process until told to stop or due for recycling.
+
+    max_requests and max_rss are limits on requests served and on bytes
+    resident; 0 disables a limit. On shutdown the listening sockets are
+    closed and in-flight requests get up to grace seconds to finish, then
+    the app's executor setting, if any, is shut down.
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, app, sockets, max_requests=0, max_rss=0, grace=30):
+        self.app = app
+        self.sockets = sockets
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.grace = grace
+        self.served = 0
+        self.pending = set()
+        self.exit_code = 0
+        self.stopping = False
+        self.server = None
+
+        start_request = app.start_request
+        log_request = app.log_request
+
+        def counting_start(server_conn, request_conn):
+            """Count requests as in flight once their headers arrive."""
+            return _Counting(self, request_conn,
+                             start_request(server_conn, request_conn))
+
+        def counting_log(handler):
+            """Count the request as served."""
+            self.pending.discard(handler.request.connection)
+            self.served += 1
+            log_request(handler)
+
+        app.start_request = counting_start
+        app.log_request = counting_log
+
+    @property
+    def active(self):
+        """
+        The number of requests in flight.
+        """
+        return len(self.pending)
+
+    def run(self):
+        """
+        Serve until shut down, returning the process exit status.
+        """
+        io_loop = IOLoop.current()
+        self.server = HTTPServer(self.app)
+        self.server.add_sockets(self.sockets)
+
+        def on_signal(*_):
+            """Begin a graceful shutdown."""
+            io_loop.add_callback_from_signal(self.shutdown, 0)
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+        checker = PeriodicCallback(self.check_limits, CHECK_INTERVAL_MS)
+        checker.start()
+        io_loop.start()
+        checker.stop()
+
+        # Forked workers leave with os._exit, which would orphan the
+        # processes of a process pool.
+        executor = self.app.settings.get('executor')
+        if executor is not None:
+            executor.shutdown()
+        return self.exit_code
+
+    def check_limits(self):
+        """
+        Start recycling this worker if it has passed one of its limits.
+        """
+        logger = get_logger(self)
+
+        if self.stopping:
+            return
+
+        if self.max_requests and self.served >= self.max_requests:
+            logger.info('Recycling worker %d after %d requests',
+                        os.getpid(), self.served)
+            self.shutdown(RECYCLE_EXIT)
+        elif self.max_rss and current_rss() > self.max_rss:
+            logger.info('Recycling worker %d at %d bytes resident',
+                        os.getpid(), current_rss())
+            self.shutdown(RECYCLE_EXIT)
+
+    def shutdown(self, exit_code):
+        """
+        Stop accepting connections, drain in-flight requests, then exit.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        self.exit_code = exit_code
+        self.server.stop()
+        IOLoop.current().spawn_callback(self._drain)
+
+    async def _drain(self):
+        """
+        Wait for in-flight requests, up to the grace period.
+        """
+        logger = get_logger(self)
+
+        deadline = time.monotonic() + self.grace
+        while self.active > 0 and time.monotonic() < deadline:
+            await gen.sleep(0.1)
+
+        if self.active > 0:
+            logger.warn('Abandoning %d in-flight requests', self.active)
+
+        await self.server.close_all_connections()
+        IOLoop.current().stop()
+
+
+class _Counting(httputil.HTTPMessageDelegate):
+    """
+    Pass a request through to delegate, counting it as in flight.
+
+    A request stops counting once it is logged, or when its connection
+    closes first: handlers never finish requests whose bodies are cut
+    short.
+    """
+    def __init__(self, worker, request_conn, delegate):
+        self.worker = worker
+        self.request_conn = request_conn
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        """Count the request and pass the headers on."""
+        self.worker.pending.add(self.request_conn)
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        """Pass body data on."""
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        """Pass the end of the request on."""
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        """Pass the closed connection on."""
+        try:
+            return self.delegate.on_connection_close()
+        finally:
+            self.worker.pending.discard(self.request_conn)
+
+
+class Supervisor(object):
+    """
+    Fork and babysit worker processes.
+
+    With reuse_port each worker binds its own SO_REUSEPORT socket and the
+    kernel balances connections; otherwise one socket is bound before
+    forking and shared.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, make_app, port, workers, reuse_port=True,
+                 worker_args=None):
+        self.make_app = make_app
+        self.port = port
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.worker_args = worker_args or {}
+        self.sockets = None if reuse_port else bind_sockets(port)
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        """
+        Supervise workers until SIGTERM and all of them have exited.
+        """
+        logger = get_logger(self)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.children:
+            try:
+                (pid, status) = os.wait()
+            except ChildProcessError:
+                break
+
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) \
+                else -os.WTERMSIG(status)
+            if self.stopping:
+                logger.info('Worker %d exited (%d)', pid, code)
+                continue
+
+            if code == RECYCLE_EXIT:
+                logger.info('Worker %d recycled', pid)
+            else:
+                logger.error('Worker %d died unexpectedly (%d)', pid, code)
+                if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    time.sleep(MIN_WORKER_LIFETIME)
+            self.spawn()
+
+        logger.info('All workers exited')
+
+    def spawn(self):
+        """
+        Fork a new worker.
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+
+        # In the child: serve, then leave without running parent cleanup.
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            sockets = self.sockets or bind_sockets(self.port,
+                                                   reuse_port=True)
+            code = Worker(self.make_app(), sockets, **self.worker_args).run()
+        except Exception as err:  # pylint: disable=broad-except
+            get_logger(self).exception(err)
+        finally:
+            # Write out queued log records; _exit skips that.
+            logging.shutdown()
+            os._exit(code)  # pylint: disable=protected-access
+
+    def stop(self, *_):
+        """
+        Forward SIGTERM to every worker and stop replacing them.
+        """
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def serve(make_app, port, workers=1, reuse_port=True, **worker_args):
+    """
+    Serve make_app() on port, forking workers when there are more than
+    one, or when a worker may be recycled and needs replacing.
+
+    worker_args are passed to each Worker.
+    """
+    recycles = worker_args.get('max_requests') or worker_args.get('max_rss')
+    if workers == 1 and not recycles:
+        return Worker(make_app(), bind_sockets(port), **worker_args).run()
+
+    Supervisor(make_app, port, workers, reuse_port=reuse_port,
+               worker_args=worker_args).run()
+    return 0
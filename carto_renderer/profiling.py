@@ -0,0 +1,189 @@
+"""
+Per-request profiling, and a spool of slow requests to replay offline.
+
+A capture holds everything render_png needs to reproduce a request:
+
+    bin/replay.sh /var/spool/carto-renderer --profile --output tile.png
+"""
+
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import tempfile
+import time
+
+import msgpack
+
+from carto_renderer.util import get_logger
+
+# Lines of the cProfile report to return.
+PROFILE_LINES = 40
+CAPTURE_SUFFIX = '.msgpack'
+
+
+def profiled(func, *args):
+    """
+    Call func(*args) under cProfile, returning (result, report).
+
+    report is the text of the most expensive calls by cumulative time.
+    The profile covers the calling thread only, so this runs on the
+    thread doing the work (e.g. in the executor).
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats(
+        'cumulative').print_stats(PROFILE_LINES)
+    return (result, report.getvalue())
+
+
+class Spool(object):
+    """
+    A directory of captured requests, kept under max_bytes by removing
+    the oldest captures.
+
+    Captures are written to a temporary file and renamed into place, so
+    readers never see partial ones, and several processes can share a
+    spool.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def captures(self):
+        """
+        Return the paths of the captures, oldest first.
+        """
+        return [os.path.join(self.directory, name)
+                for name in sorted(os.listdir(self.directory))
+                if name.endswith(CAPTURE_SUFFIX)]
+
+    def write(self, capture):
+        """
+        Store capture (a dict), returning its path, or None if it is
+        bigger than the whole spool.
+        """
+        data = msgpack.packb(capture)
+        if len(data) > self.max_bytes:
+            get_logger(self).warn('Not capturing %d bytes; the spool only '
+                                  'holds %d', len(data), self.max_bytes)
+            return None
+
+        # Names sort by time, and the pid keeps processes apart.
+        name = '{:020d}-{}{}'.format(time.time_ns(), os.getpid(),
+                                     CAPTURE_SUFFIX)
+        (handle, temporary) = tempfile.mkstemp(dir=self.directory,
+                                               suffix='.tmp')
+        with os.fdopen(handle, 'wb') as output:
+            output.write(data)
+        path = os.path.join(self.directory, name)
+        os.replace(temporary, path)
+
+        self.trim()
+        return path
+
+    def trim(self):
+        """
+        Remove the oldest captures until the rest fit in max_bytes.
+        """
+        sizes = []
+        for path in self.captures():
+            try:
+                sizes.append((path, os.path.getsize(path)))
+            except OSError:
+                pass  # Already removed by another process.
+
+        total = sum(size for (_, size) in sizes)
+        for (path, size) in sizes:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def load(path):
+    """
+    Read a capture. Arrays come back as tuples, so features with
+    properties are (wkb, properties) pairs again.
+    """
+    with open(path, 'rb') as capture:
+        return msgpack.unpackb(capture.read(), raw=True, use_list=False)
+
+
+def replay(capture, profile=False):
+    """
+    Render a loaded capture with render_png, returning (png, stats,
+    report); report is None unless profile is set.
+    """
+    from carto_renderer import service
+
+    args = (capture[b'payload'][b'tile'], capture[b'zoom'],
+            capture[b'xml'].decode('utf-8'), capture[b'overscan'],
+            capture[b'format'].decode('utf-8'))
+    if profile:
+        ((png, stats), report) = profiled(service.render_with_stats,
+                                          service.render_png, *args)
+    else:
+        (png, stats) = service.render_with_stats(service.render_png, *args)
+        report = None
+    return (png, stats, report)
+
+
+def main(argv=None):
+    # pylint: disable=missing-docstring
+    parser = argparse.ArgumentParser(
+        description='Replay captured slow requests through render_png.')
+    parser.add_argument('paths', nargs='+',
+                        help='Capture files, or spool directories.')
+    parser.add_argument('--iterations', type=int, default=1)
+    parser.add_argument('--profile', action='store_true',
+                        help='Print a cProfile report of the last '
+                             'iteration to stderr.')
+    parser.add_argument('--output', help='Write the last image here.')
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            paths.extend(Spool(path, float('inf')).captures())
+        else:
+            paths.append(path)
+
+    for path in paths:
+        capture = load(path)
+        for iteration in range(args.iterations):
+            last = iteration == args.iterations - 1
+            start = time.perf_counter()
+            (png, stats, report) = replay(capture, args.profile and last)
+            elapsed = time.perf_counter() - start
+
+        print(json.dumps({'capture': path,
+                          'captured': {key.decode('utf-8'): value
+                                       for (key, value)
+                                       in capture[b'stats'].items()
+                                       if key != b'counts'},
+                          'capturedElapsed': capture[b'elapsed'],
+                          'elapsed': elapsed,
+                          'stages': {stage: value
+                                     for (stage, value) in stats.items()
+                                     if stage != 'counts'},
+                          'counts': stats.get('counts')},
+                         sort_keys=True))
+        if report:
+            sys.stderr.write(report)
+        if args.output:
+            with open(args.output, 'wb') as output:
+                output.write(png)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
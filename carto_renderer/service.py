@@ -3,18 +3,38 @@
 Service to render pngs from vector tiles using Carto CSS.
 """
 
+import asyncio
+import hashlib
+import hmac
 import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from urllib.parse import quote_plus
 
-from tornado import web, escape
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado import web
+from tornado.httpclient import HTTPRequest
 from tornado.ioloop import IOLoop
 from tornado.options import define, parse_command_line, options
 import mapnik                   # pylint: disable=import-error
 import msgpack
 
-from carto_renderer.errors import BadRequest, PayloadKeyError, ServiceError
-from carto_renderer.util import get_logger, init_logging, LogWrapper
+from carto_renderer import (metrics, mvt, prefork, profiling, upstream,
+                            warmup)
+from carto_renderer.admission import AdmissionControl
+from carto_renderer.cache import DiskCache, LRUCache
+from carto_renderer.errors import (BadRequest, PayloadKeyError,
+                                   PayloadTooLarge, RequestCancelled,
+                                   ServiceError)
+from carto_renderer.geometry import columnar_features, columnar_offsets, \
+    prepare_wkb, wkb_vertices
+from carto_renderer.style import StyleRules
+from carto_renderer.util import (REQUEST_ID, call_with_request_id,
+                                 get_logger, init_logging, LogWrapper)
 from carto_renderer.version import BUILD_TIME, SEMANTIC
 
 __package__ = 'carto_renderer'  # pylint: disable=redefined-builtin
@@ -24,88 +44,845 @@ BASE_ZOOM = 29
 TILE_ZOOM_FACTOR = 16
 TILE_SIZE = 256
 
-def render_png(tile, _zoom, xml, overscan):
+# Raw Mapbox Vector Tile bodies; other parameters come from the query.
+MVT_CONTENT_TYPES = ('application/vnd.mapbox-vector-tile',
+                     'application/x-protobuf')
+MVT_QUERY_KEYS = ('style', 'zoom', 'overscan', 'format')
+
+# Executor used for map load, feature building and rendering.
+EXECUTOR_MODES = {'thread': ThreadPoolExecutor,
+                  'process': ProcessPoolExecutor}
+MAX_RENDER_WORKERS = 64
+
+# Output formats by name: (Content-Type, base Mapnik image format).
+OUTPUT_FORMATS = {'png': ('image/png', 'png'),
+                  'png8': ('image/png', 'png8'),
+                  'png32': ('image/png', 'png32'),
+                  'jpeg': ('image/jpeg', 'jpeg'),
+                  'webp': ('image/webp', 'webp')}
+PNG_STRATEGIES = ('default', 'filtered', 'huffman', 'rle', 'fixed')
+
+STAGE_SECONDS = metrics.Histogram(
+    'carto_renderer_stage_seconds',
+    'Time spent in each stage of handling a render request.',
+    labels=['stage'])
+STAGES = {stage: STAGE_SECONDS.labels(stage)
+          for stage in ('decode', 'style_fetch', 'map_load', 'features',
+                        'render', 'encode')}
+FEATURES = metrics.Counter(
+    'carto_renderer_features_total',
+    'Features received, and features left to draw after clipping.',
+    labels=['state'])
+VERTICES = metrics.Counter(
+    'carto_renderer_vertices_total',
+    'Vertices received, and vertices left to draw after any clipping.',
+    labels=['state'])
+COUNTED = (FEATURES.labels('received'), FEATURES.labels('drawn'),
+           VERTICES.labels('received'), VERTICES.labels('drawn'))
+ERRORS = metrics.Counter(
+    'carto_renderer_errors_total',
+    'Failed requests by error class.',
+    labels=['error'])
+FAST_PATHS = metrics.Counter(
+    'carto_renderer_fast_path_total',
+    'Responses that skipped rendering, by shortcut taken.',
+    labels=['path'])
+CANCELLED = metrics.Counter(
+    'carto_renderer_cancelled_total',
+    'Requests abandoned because the client left or the deadline passed, '
+    'by whether they were still queued.',
+    labels=['reason', 'stage'])
+IN_FLIGHT = metrics.Gauge(
+    'carto_renderer_requests_in_flight',
+    'Render requests being handled.')
+
+
+def make_executor(mode, workers, initializer=None, initargs=()):
+    """
+    Build the pool that render_png runs in, keeping it off the IOLoop.
+    """
+    if mode not in EXECUTOR_MODES:
+        raise ValueError('Invalid render_mode "{}"; expected one of {}'.format(
+            mode, ', '.join(sorted(EXECUTOR_MODES))))
+
+    if not 1 <= workers <= MAX_RENDER_WORKERS:
+        raise ValueError('render_workers must be between 1 and {}'.format(
+            MAX_RENDER_WORKERS))
+
+    return EXECUTOR_MODES[mode](max_workers=workers,
+                                initializer=initializer,
+                                initargs=initargs)
+
+
+def make_formats(png8_colors=256, png_compression=-1, png_strategy='default',
+                 jpeg_quality=85, webp_quality=90):
+    """
+    Build {name: (Content-Type, Mapnik format string)} for the output formats.
+
+    png_compression is a zlib level (0-9, or -1 for the default) and,
+    like png_strategy, applies to every PNG format. Formats this Mapnik
+    was built without are left out.
+    """
+    # mapnik is installed in a non-standard way.
+    # It confuses pylint.
+    # pylint: disable=no-member
+    if not 2 <= png8_colors <= 256:
+        raise ValueError('png8_colors must be between 2 and 256')
+    if not -1 <= png_compression <= 9:
+        raise ValueError('png_compression must be between -1 and 9')
+    if png_strategy not in PNG_STRATEGIES:
+        raise ValueError('png_strategy must be one of: {}'.format(
+            ', '.join(PNG_STRATEGIES)))
+    if not (0 <= jpeg_quality <= 100 and 0 <= webp_quality <= 100):
+        raise ValueError('jpeg_quality and webp_quality must be 0-100')
+
+    png_options = ''
+    if png_compression >= 0:
+        png_options += ':z={}'.format(png_compression)
+    if png_strategy != 'default':
+        png_options += ':s={}'.format(png_strategy)
+
+    formats = {'png': 'png' + png_options,
+               'png8': 'png8:c={}{}'.format(png8_colors, png_options),
+               'png32': 'png32' + png_options}
+    if mapnik.has_jpeg():
+        formats['jpeg'] = 'jpeg{}'.format(jpeg_quality)
+    if mapnik.has_webp():
+        formats['webp'] = 'webp:quality={}'.format(webp_quality)
+
+    return {name: (OUTPUT_FORMATS[name][0], fmt)
+            for (name, fmt) in formats.items()}
+
+
+class MapPool(object):
+    """
+    Parsed mapnik.Map templates, keyed by style XML and map size.
+
+    Each style keeps up to max_idle idle maps; at most max_styles styles
+    are kept, least recently used first out. The analysed rules of the
+    same styles are kept alongside.
+    """
+    def __init__(self, max_styles, max_idle):
+        self.templates = LRUCache(max_styles)
+        self.analysed = LRUCache(max_styles)
+        self.max_idle = max_idle
+        self.parsed = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def borrow(self, xml, size):
+        """
+        Lend out a map for xml, parsing a new one if none are idle.
+
+        Layers added while borrowed are removed when it is returned.
+        """
+        # mapnik is installed in a non-standard way.
+        # It confuses pylint.
+        # pylint: disable=no-member
+        key = (xml, size)
+        with self._lock:
+            idle = self.templates.get(key)
+            if idle is None:
+                idle = []
+                self.templates.put(key, idle)
+            map_tile = idle.pop() if idle else None
+
+        if map_tile is None:
+            map_tile = mapnik.Map(size, size)
+            mapnik.load_map_from_string(map_tile, xml)
+            self.parsed += 1
+
+        base_layers = len(map_tile.layers)
+        try:
+            yield map_tile
+        finally:
+            del map_tile.layers[base_layers:]
+            with self._lock:
+                if len(idle) < self.max_idle:
+                    idle.append(map_tile)
+
+    def rules(self, xml):
+        """
+        Return the StyleRules for xml, analysing it on first use.
+        """
+        rules = self.analysed.get(xml)
+        if rules is None:
+            rules = StyleRules(xml)
+            self.analysed.put(xml, rules)
+        return rules
+
+    def stats(self):
+        """
+        Return the counters for this pool.
+        """
+        return dict(self.templates.stats(), parsed=self.parsed)
+
+
+# Per-process render settings; see configure_renderer.
+MAP_POOL = MapPool(64, 4)
+CLIP_FEATURES = False
+SIMPLIFY_TOLERANCE = 0.5
+
+# Pre-encoded blank tiles by (format, background colour).
+BLANK_TILES = LRUCache(64)
+
+# Features are clipped this many pixels outside the rendered box, so the
+# cut edges (and the strokes along them) are never visible.
+CLIP_BUFFER = 8
+
+
+def configure_renderer(max_styles, max_idle, clip_features=False,
+                       simplify_tolerance=0.5):
+    """
+    Set this process's render settings; used as the executor initializer.
+    """
+    # pylint: disable=global-statement
+    global MAP_POOL, CLIP_FEATURES, SIMPLIFY_TOLERANCE
+    MAP_POOL = MapPool(max_styles, max_idle)
+    CLIP_FEATURES = clip_features
+    SIMPLIFY_TOLERANCE = simplify_tolerance
+
+
+def to_text(name):
+    """
+    Names and strings arrive as bytes from msgpack and as str from MVT.
+    """
+    return name.decode('utf-8', 'replace') if isinstance(name, bytes) else name
+
+
+def layer_features(features):
+    """
+    Iterate over a layer's features, in either layout (see geometry).
+    """
+    if isinstance(features, dict):
+        return columnar_features(features)
+    return features
+
+
+def layer_size(features):
+    """
+    Count a layer's features, in either layout.
+    """
+    if isinstance(features, dict):
+        return len(columnar_offsets(features)) - 1
+    return len(features)
+
+
+def tile_digest(*fields):
+    """
+    Content address of a render request, used for caching and ETags.
+    """
+    return hashlib.sha1(msgpack.packb(fields)).hexdigest()
+
+
+def scale_denominator(zoom):
+    """
+    The scale denominator style rules are matched against at zoom.
+
+    Zoom 0 is 2 ** BASE_ZOOM, close to the usual 559082264 for 256 pixel
+    web mercator tiles, and each zoom level halves it.
+    """
+    return float(1 << (BASE_ZOOM - min(max(int(zoom), 0), BASE_ZOOM)))
+
+
+def blank_tile(fmt='png', background=None):
+    """
+    Return an empty tile in the Mapnik image format fmt, encoding it once.
+    """
+    # mapnik is installed in a non-standard way.
+    # It confuses pylint.
+    # pylint: disable=no-member
+    key = (fmt, background)
+    blank = BLANK_TILES.get(key)
+    if blank is None:
+        map_tile = mapnik.Map(TILE_SIZE, TILE_SIZE)
+        if background is not None:
+            map_tile.background = mapnik.Color(background)
+        map_tile.zoom_to_box(mapnik.Box2d(0, 0, TILE_SIZE - 1, TILE_SIZE - 1))
+        image = mapnik.Image(TILE_SIZE, TILE_SIZE)
+        mapnik.render(map_tile, image)
+        blank = image.tostring(fmt)
+        BLANK_TILES.put(key, blank)
+    return blank
+
+
+def render_blank(tile, zoom, xml, fmt='png'):
+    """
+    Return the blank tile if nothing in tile can draw at zoom, else None.
+
+    That is the case when the tile has no features, or its only features
+    are in layers that no rule draws at this zoom.
+    """
+    rules = MAP_POOL.rules(xml)
+    if rules.fixed:
+        return None
+
+    scale = scale_denominator(zoom)
+    if any(layer_size(features) and rules.visible(to_text(name), scale)
+           for (name, features) in tile.items()):
+        return None
+    return blank_tile(fmt, rules.background)
+
+
+def tile_weight(entry):
+    """
+    Weigh a tile cache entry, an (image, fast path) pair, by its bytes.
+    """
+    return len(entry[0])
+
+
+def render_with_stats(render, *args):
+    """
+    Call render(*args), returning (result, stats).
+
+    Executor processes cannot reach this process's metrics, so stage
+    timings and counts travel back with the result; see record_stats.
+    """
+    stats = {}
+    return (render(*args, stats=stats), stats)
+
+
+def record_stats(stats):
+    """
+    Add the stats of a render_with_stats call to the metrics.
+    """
+    for stage in ('map_load', 'features', 'render', 'encode'):
+        if stage in stats:
+            STAGES[stage].observe(stats[stage])
+    for (counter, count) in zip(COUNTED, stats.get('counts', ())):
+        counter.inc(count)
+
+
+def render_png(tile, zoom, xml, overscan, fmt='png', stats=None):
+    """
+    Render the tile as a .png, or in the Mapnik image format fmt.
+
+    Features are WKB bytes or (wkb, properties) pairs. Stage timings and
+    counts are stored in stats, if given.
+    """
+    logger = get_logger()
+
+    start = time.monotonic()
+    image = _render_image(tile, zoom, xml, TILE_SIZE, overscan, stats)
+    rendered = time.monotonic()
+    encoded = image.tostring(fmt)
+    encode_time = time.monotonic() - rendered
+    logger.info('Rendered in %.1fms; encoded %d bytes as %s in %.1fms',
+                (rendered - start) * 1000, len(encoded), fmt,
+                encode_time * 1000)
+    if stats is not None:
+        stats['encode'] = encode_time
+    return encoded
+
+
+def render_metatile(tile, zoom, xml, overscan, size, fmt='png', stats=None):
+    """
+    Render a size x size block of tiles in one pass and slice it up.
+
+    The block is drawn as one big tile: feature coordinates run from 0
+    to size * TILE_SIZE and, as for a single tile, y grows upwards, so
+    the top row (dy 0) holds the largest y values. Returns (dx, dy, png)
+    for each tile, where dx/dy are the tile's offset within the block,
+    and png is encoded in the Mapnik image format fmt.
+    """
+    logger = get_logger()
+
+    start = time.monotonic()
+    image = _render_image(tile, zoom, xml, size * TILE_SIZE, overscan, stats)
+    rendered = time.monotonic()
+    tiles = [(dx, dy, image.view(dx * TILE_SIZE, dy * TILE_SIZE,
+                                 TILE_SIZE, TILE_SIZE).tostring(fmt))
+             for dy in range(size)
+             for dx in range(size)]
+    encode_time = time.monotonic() - rendered
+    logger.info('Rendered in %.1fms; encoded %d tiles as %s in %.1fms',
+                (rendered - start) * 1000, len(tiles), fmt,
+                encode_time * 1000)
+    if stats is not None:
+        stats['encode'] = encode_time
+    return tiles
+
+
+def _render_image(tile, zoom, xml, image_size, overscan, stats=None):
     """
-    Render the tile as a .png
+    Render the tile's features into an image_size square mapnik.Image.
+
+    Only rules that draw at zoom are kept, and layers without a style
+    that draws are skipped before any of their features are read. If
+    enabled with configure_renderer, features crossing the rendered box
+    are then clipped to it and simplified to SIMPLIFY_TOLERANCE pixels,
+    and those wholly outside it dropped.
 
-    TODO: Actually handling zoom levels.
+    If stats is given, the map_load, features and render timings and the
+    feature/vertex counts are stored in it.
     """
     # mapnik is installed in a non-standard way.
     # It confuses pylint.
     # pylint: disable=no-member,too-many-locals
 
-    map_tile_size = TILE_SIZE + (overscan * 2)
+    map_tile_size = image_size + (overscan * 2)
     logger = get_logger()
     ctx = mapnik.Context()
 
-    map_tile = mapnik.Map(map_tile_size, map_tile_size)
-    # scale_denom = 1 << (BASE_ZOOM - int(zoom or 1))
-    # scale_factor = scale_denom / map_tile.scale_denominator()
-    # map_tile.zoom(scale_factor)  # Is overriden by zoom_to_box.
+    box_min = -overscan
+    box_max = image_size + overscan - 1
+    clip_box = (box_min - CLIP_BUFFER, box_min - CLIP_BUFFER,
+                box_max + CLIP_BUFFER, box_max + CLIP_BUFFER)
+    # features in/out, vertices in/out
+    counts = [0, 0, 0, 0]
 
-    mapnik.load_map_from_string(map_tile, xml)
+    # The map is zoomed to a pixel box, so its own scale denominator
+    # means nothing; rules are matched against the requested zoom here.
+    scale = scale_denominator(zoom)
+    rules = MAP_POOL.rules(xml)
+    layers = [(name, features) for (name, features) in tile.items()
+              if rules.visible(to_text(name), scale)]
+    if len(layers) < len(tile):
+        logger.debug('Skipping %d of %d layers with nothing to draw at '
+                     'zoom %d', len(tile) - len(layers), len(tile), zoom)
 
-    box_min = -overscan
-    box_max = TILE_SIZE + overscan - 1
-    map_tile.zoom_to_box(mapnik.Box2d(box_min, box_min, box_max, box_max))
+    start = time.monotonic()
+    with MAP_POOL.borrow(rules.at_scale(scale), map_tile_size) as map_tile:
+        map_tile.zoom_to_box(mapnik.Box2d(box_min, box_min, box_max, box_max))
+        loaded = time.monotonic()
 
-    for (name, features) in list(tile.items()):
-        source = mapnik.MemoryDatasource()
-        map_layer = mapnik.Layer(name)
-        map_layer.datasource = source
+        for (name, features) in layers:
+            source = mapnik.MemoryDatasource()
+            map_layer = mapnik.Layer(name)
+            map_layer.datasource = source
 
-        for feature in features:
-            feat = mapnik.Feature(ctx, 0)
+            for feature in layer_features(features):
+                properties = None
+                if isinstance(feature, tuple):
+                    (feature, properties) = feature
 
-            try:
-                feat.geometry = mapnik.Geometry.from_wkb(feature)
-            except RuntimeError:
+                counts[0] += 1
+                if CLIP_FEATURES:
+                    (feature, vertices_in, vertices_out) = prepare_wkb(
+                        feature, clip_box, SIMPLIFY_TOLERANCE)
+                    counts[2] += vertices_in
+                    counts[3] += vertices_out
+                    if feature is None:
+                        continue
+                else:
+                    try:
+                        vertices_in = wkb_vertices(feature)
+                    except ValueError:
+                        # Left for Mapnik to report, as prepare_wkb does.
+                        vertices_in = 0
+                    counts[2] += vertices_in
+                    counts[3] += vertices_in
+                counts[1] += 1
+
+                feat = mapnik.Feature(ctx, 0)
+
+                if properties:
+                    for (key, value) in properties.items():
+                        feat[to_text(key)] = to_text(value)
+
+                if isinstance(feature, memoryview):
+                    # A columnar feature: a view of the layer's buffer.
+                    feature = feature.tobytes()
                 try:
-                    wkt = mapnik.Geometry.from_wkb(feature).to_wkt()
-                    logger.error('Invalid feature: %s', wkt)
+                    feat.geometry = mapnik.Geometry.from_wkb(feature)
                 except RuntimeError:
-                    logger.error('Corrupt feature: %s', feature.encode('hex'))
+                    try:
+                        wkt = mapnik.Geometry.from_wkb(feature).to_wkt()
+                        logger.error('Invalid feature: %s', wkt)
+                    except RuntimeError:
+                        logger.error('Corrupt feature: %r', feature[:64])
+
+                source.add_feature(feat)
+
+            map_layer.styles.append(name)
+            map_tile.layers.append(map_layer)
+
+        image = mapnik.Image(image_size, image_size)
+        decoded = time.monotonic()
+        # tile, image, scale, offset_x, offset_y
+        mapnik.render(map_tile, image, 1, overscan, overscan)
+        if stats is not None:
+            stats.update(map_load=loaded - start,
+                         features=decoded - loaded,
+                         render=time.monotonic() - decoded,
+                         counts=counts)
+
+    if counts[0] != counts[1] or counts[2] != counts[3]:
+        logger.info('Preprocessing removed %d of %d features and '
+                    '%d of %d vertices', counts[0] - counts[1], counts[0],
+                    counts[2] - counts[3], counts[2])
+
+    return image
+
+
+async def fetch_style(http_client, style_host, style_port, style,
+                      style_cache=None, stats=None, style_store=None):
+    """
+    Return the Mapnik XML the style renderer compiles style into,
+    through style_cache if given.
+
+    A style_cache miss next tries style_store (a DiskCache shared with
+    the other processes on this host), and only then the style renderer,
+    whose answer is written to style_store in the background.
+
+    If stats is given, the time the style renderer took is stored in it.
+    """
+    logger = get_logger()
+
+    path = 'http://{host}:{port}/style?style={css}'.format(
+        host=style_host,
+        port=style_port,
+        css=quote_plus(style))
+
+    def handle_response(response):
+        """
+        Process the XML returned by the style renderer.
+        """
+        if response.body is None:
+            raise ServiceError(
+                "Failed to contact style-renderer at '{url}'".format(
+                    url=path),
+                503)
+
+        return response.body
+
+    request_id = REQUEST_ID.get()
+    headers = {'X-Socrata-RequestId': request_id} \
+        if request_id is not None else {}
+
+    def store(xml):
+        """
+        Write the compiled style to style_store, off the IOLoop.
+        """
+        try:
+            style_store.put(style, xml)
+        except (IOError, OSError) as err:
+            logger.error('Could not store compiled style: %s', err)
+
+    async def fetch():
+        """
+        Read the compiled style from disk, or ask the style renderer to
+        compile the CartoCSS.
+        """
+        if style_store is not None:
+            # A page-cache read of one small file; not worth a thread.
+            xml = style_store.get(style)
+            if xml is not None:
+                return xml
+
+        req = HTTPRequest(path, headers=headers)
+        start = time.monotonic()
+        response = await http_client.fetch(req)
+        elapsed = time.monotonic() - start
+        if stats is not None:
+            stats['style_fetch'] = elapsed
+        STAGES['style_fetch'].observe(elapsed)
+        xml = handle_response(response)
+        if style_store is not None:
+            IOLoop.current().run_in_executor(None, store, xml)
+        return xml
+
+    if style_cache is None:
+        return await fetch()
+    return await style_cache.fetch(style, fetch)
+
+
+def preload(formats):
+    """
+    Render and encode the sample tile once in each of formats, so that
+    Mapnik's fonts, plugins and symbolizers are set up.
+
+    Run before forking, the workers share the result.
+    """
+    xml = warmup.sample_xml()
+    tile = warmup.sample_tile()
+    for (_, fmt) in formats.values():
+        render_png(tile, warmup.SAMPLE_ZOOM, xml, 0, fmt)
+
+
+def init_render_process(renderer_args, formats=None):
+    """
+    Configure a render process and, given formats, preload it; used as
+    the process pool initializer, so each process warms its own map pool
+    before taking any work.
+    """
+    configure_renderer(*renderer_args)
+    if formats is not None:
+        preload(formats)
+
+
+async def warm_up(readiness, render_args, workers=1, payloads=(),
+                  timeout=60):
+    """
+    Warm this worker up, then mark readiness warmed.
+
+    The executor gets one sample render per worker, which starts all of
+    a process pool's processes (each preloads itself as it starts; see
+    init_render_process). Then the style of each payload is compiled
+    into the style cache and payloads with a tile are rendered. Failed
+    steps are logged and skipped; after timeout seconds the worker is
+    ready regardless.
+    """
+    logger = get_logger()
+    executor = render_args['executor']
+    formats = render_args['formats']
+    default_format = render_args['default_format']
+    io_loop = IOLoop.current()
+
+    async def render(tile, zoom, xml, overscan, fmt):
+        """
+        Render in the executor, logging failures.
+        """
+        try:
+            await io_loop.run_in_executor(executor, render_png, tile, zoom,
+                                          xml, overscan, fmt)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.warn('Warm-up render failed: %s', err)
+
+    async def run():
+        """
+        Render the sample, then replay the payloads.
+        """
+        sample = (warmup.sample_tile(), warmup.SAMPLE_ZOOM,
+                  warmup.sample_xml(), 0, formats[default_format][1])
+        await asyncio.gather(*[render(*sample) for _ in range(workers)])
+
+        for payload in payloads:
+            try:
+                xml = await fetch_style(render_args['http_client'],
+                                        render_args['style_host'],
+                                        render_args['style_port'],
+                                        payload[b'style'],
+                                        render_args['style_cache'],
+                                        style_store=render_args.get(
+                                            'style_store'))
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warn('Warm-up style fetch failed: %s', err)
+                continue
+            if b'tile' in payload:
+                name = to_text(payload.get(b'format', default_format))
+                await render(payload[b'tile'], payload.get(b'zoom', 0), xml,
+                             payload.get(b'overscan', 0),
+                             formats.get(name, formats[default_format])[1])
+
+    try:
+        await asyncio.wait_for(run(), timeout)
+    except asyncio.TimeoutError:
+        logger.warn('Warm-up took over %ds; serving anyway', timeout)
+    readiness.warmed()
+    logger.info('Warmed up in %.2fs', readiness.warm_seconds)
 
-            source.add_feature(feat)
 
-        map_layer.styles.append(name)
-        map_tile.layers.append(map_layer)
+def count_features(payload):
+    """
+    Count the features in a payload's tile, or in all its batch tiles.
+    """
+    tiles = [payload.get(b'tile')]
+    if isinstance(payload.get(b'tiles'), list):
+        tiles.extend(entry.get(b'tile') for entry in payload[b'tiles']
+                     if isinstance(entry, dict))
+    return sum(layer_size(features)
+               for tile in tiles if isinstance(tile, dict)
+               for features in tile.values()
+               if isinstance(features, (list, dict)))
 
-    image = mapnik.Image(TILE_SIZE, TILE_SIZE)
-    # tile, image, scale, offset_x, offset_y
-    mapnik.render(map_tile, image, 1, overscan, overscan)
 
-    return image.tostring('png')
+class BodyDecoder(object):
+    """
+    Decode a msgpack request body as it arrives.
+
+    Each chunk is fed to an incremental Unpacker and decoded as far as it
+    goes, so decoding overlaps with receiving and only the undecoded
+    remainder is buffered, never the whole body. Vector tiles cannot be
+    decoded piecemeal; their chunks are collected until the end.
+
+    Errors are kept until payload() is called, since they cannot be
+    reported in the middle of reading the body. A max_size or
+    max_features of 0 disables that limit.
+    """
+    def __init__(self, raw=False, max_size=0, max_features=0):
+        self.max_size = max_size
+        self.max_features = max_features
+        self.size = 0
+        self.seconds = 0.0
+        self.error = None
+        self.chunks = [] if raw else None
+        self.unpacker = None if raw else msgpack.Unpacker(
+            raw=True, max_buffer_size=max_size)
+        self.payloads = []
+
+    def feed(self, chunk):
+        """
+        Decode chunk, the next part of the body.
+        """
+        if self.error is not None:
+            return
+
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            self.error = PayloadTooLarge(
+                'Request body is over {} bytes.'.format(self.max_size))
+            (self.chunks, self.unpacker) = (None, None)
+            return
+
+        if self.chunks is not None:
+            self.chunks.append(chunk)
+            return
+
+        start = time.monotonic()
+        try:
+            self.unpacker.feed(chunk)
+            self.payloads.extend(self.unpacker)
+        except Exception as err:  # pylint: disable=broad-except
+            get_logger(self).warn('Invalid message: %s', err)
+            self.error = BadRequest('Could not parse message.', chunk)
+            self.unpacker = None
+        self.seconds += time.monotonic() - start
+
+    def body(self):
+        """
+        Return the collected raw body.
+        """
+        if self.error is not None:
+            raise self.error
+        return b''.join(self.chunks)
+
+    def payload(self):
+        """
+        Return the decoded payload, or raise the error that stopped it.
+        """
+        if self.error is not None:
+            raise self.error
+        if len(self.payloads) != 1:
+            raise BadRequest('Could not parse message; expected one value, '
+                             'got {}.'.format(len(self.payloads)))
+
+        (payload,) = self.payloads
+        if not isinstance(payload, dict):
+            raise BadRequest('Could not parse message; expected a map.',
+                             payload)
+        self.check_features(payload)
+        STAGES['decode'].observe(self.seconds)
+        return payload
+
+    def check_features(self, payload):
+        """
+        Raise PayloadTooLarge if payload holds too many features, or
+        BadRequest if a columnar layer is malformed.
+        """
+        try:
+            features = count_features(payload)
+        except ValueError as err:
+            raise BadRequest(str(err))
+        if self.max_features and features > self.max_features:
+            raise PayloadTooLarge('Request holds {} features; at most {} '
+                                  'are allowed.'.format(features,
+                                                        self.max_features))
 
 
 class BaseHandler(web.RequestHandler):
     # pylint: disable=abstract-method
     """
     Convert ServiceErrors to HTTP errors.
+
+    Subclasses that stream their bodies (see web.stream_request_body)
+    decode them as they arrive; otherwise the buffered body is decoded.
+    Either way, max_body_size and max_features (0 for no limit) bound
+    what is accepted. Raw vector tiles are decoded in executor (the
+    IOLoop's default one if None), not on the IOLoop.
     """
-    def extract_body(self):
+    max_body_size = 0
+    max_features = 0
+    body_decoder = None
+    executor = None
+
+    def prepare(self):
+        """
+        Tag the request's log records with its request id.
+        """
+        REQUEST_ID.set(self.request.headers.get('x-socrata-requestid', ''))
+
+    def content_type(self):
+        """
+        Return the request's Content-Type, lower-cased.
+        """
+        return self.request.headers.get('content-type', '').lower()
+
+    def make_body_decoder(self):
+        """
+        Return a BodyDecoder suited to the request's Content-Type.
+        """
+        return BodyDecoder(self.content_type().startswith(MVT_CONTENT_TYPES),
+                           self.max_body_size, self.max_features)
+
+    def data_received(self, chunk):
+        """
+        Decode part of a streamed body.
+        """
+        if self.body_decoder is None:
+            # Bodies are read outside the request's own task.
+            BaseHandler.prepare(self)
+            self.body_decoder = self.make_body_decoder()
+        self.body_decoder.feed(chunk)
+
+    def received_body(self):
+        """
+        Return the BodyDecoder that has seen the whole body.
+        """
+        if self.body_decoder is None:
+            self.body_decoder = self.make_body_decoder()
+            self.body_decoder.feed(self.request.body or b'')
+        return self.body_decoder
+
+    async def extract_body(self):
         """
         Extract the body from self.request as a dictionary.
         """
         logger = get_logger(self)
 
-        request_id = self.request.headers.get('x-socrata-requestid', '')
-        LogWrapper.ENV['X-Socrata-RequestId'] = request_id
+        content_type = self.content_type()
+        if content_type.startswith(MVT_CONTENT_TYPES):
+            return await self.extract_mvt_body()
 
-        content_type = self.request.headers.get('content-type', '').lower()
         if not content_type.startswith('application/octet-stream'):
             message = 'Invalid Content-Type: "{ct}"; ' + \
                       'expected"application/octet-stream"'
             logger.warn('Invalid Content-Type: "%s"', content_type)
             raise BadRequest(message.format(ct=content_type))
 
-        body = self.request.body
-
         try:
-            extracted = msgpack.loads(body, raw=True)
-        except Exception:
+            return self.received_body().payload()
+        except BadRequest:
             logger.warn('Invalid message')
-            raise BadRequest('Could not parse message.', escape.to_unicode(body))
+            raise
+
+    async def extract_mvt_body(self):
+        """
+        Build the payload dictionary from a raw vector tile body.
+
+        'style', 'zoom', 'overscan' and 'format' are read from the query
+        string.
+        """
+        logger = get_logger(self)
+
+        decoder = self.received_body()
+        body = decoder.body()
+        start = time.monotonic()
+        try:
+            tile = await IOLoop.current().run_in_executor(
+                self.executor, mvt.decode_tile, body, TILE_SIZE)
+        except ValueError as err:
+            logger.warn('Invalid vector tile: %s', err)
+            raise BadRequest('Could not parse vector tile.')
+        decoder.check_features({b'tile': tile})
+        decoder.seconds += time.monotonic() - start
+        STAGES['decode'].observe(decoder.seconds)
+
+        extracted = {b'tile': tile}
+        for key in MVT_QUERY_KEYS:
+            value = self.get_query_argument(key, None)
+            if value is not None:
+                extracted[key.encode('utf-8')] = value
         return extracted
 
     def _handle_request_exception(self, err):
@@ -115,7 +892,12 @@ class BaseHandler(web.RequestHandler):
         logger = get_logger(self)
 
         payload = {}
-        logger.exception(err)
+        # Shed and cancelled requests are expected under load, and were
+        # logged where they were turned away; a traceback each would
+        # make logging heaviest just when the service is busiest.
+        if not getattr(err, 'expected', False):
+            logger.exception(err)
+        ERRORS.labels(type(err).__name__).inc()
         if isinstance(err, ServiceError):
             status_code = err.status_code
             payload['message'] = err.message
@@ -127,16 +909,38 @@ class BaseHandler(web.RequestHandler):
 
         payload['resultCode'] = status_code
 
+        # pylint: disable=protected-access
+        if self._headers_written:
+            self.write_late_error(payload)
+            return
+
         self.clear()
         self.set_status(status_code)
+        if isinstance(err, ServiceError):
+            for (name, value) in err.headers.items():
+                self.set_header(name, value)
         self.write(json.dumps(payload))
         self.finish()
 
+    def write_late_error(self, payload):
+        """
+        Report an error once the status line has already been sent.
+
+        The status can no longer say so, and appending the JSON error
+        would corrupt the body, so the connection is closed to show the
+        response was cut short.
+        """
+        get_logger(self).warn('Error after the response started: %s',
+                              payload['message'])
+        self.request.connection.close()
+
 
 class VersionHandler(BaseHandler):
     # pylint: disable=abstract-method
     """
     Return the version of the service, currently hardcoded.
+
+    Also reports the counters of any caches it is given.
     """
     import sys
 
@@ -147,34 +951,298 @@ class VersionHandler(BaseHandler):
                'version': SEMANTIC,
                'buildTime': BUILD_TIME}
 
+    def initialize(self, caches=None):
+        """Magic Tornado __init__ replacement."""
+        self.caches = caches or {}
+
     def get(self):
         """
         Return the version of the service, currently hardcoded.
         """
-        request_id = self.request.headers.get('x-socrata-requestid', '')
-        LogWrapper.ENV['X-Socrata-RequestId'] = request_id
-
         logger = get_logger(self)
 
         logger.info('Alive!')
-        self.write(VersionHandler.version)
+        caches = {name: cache.stats() for (name, cache) in self.caches.items()}
+        self.write(dict(VersionHandler.version, caches=caches))
         self.finish()
 
 
+class MetricsHandler(BaseHandler):
+    # pylint: disable=abstract-method
+    """
+    Expose this process's metrics in the Prometheus text format.
+
+    The counters of any caches it is given are read at scrape time.
+    """
+    # Cache stats() keys: (metric suffix, kind).
+    cache_stats = {'size': ('entries', 'gauge'),
+                   'weight': ('weight', 'gauge'),
+                   'inFlight': ('in_flight', 'gauge'),
+                   'hits': ('hits_total', 'counter'),
+                   'misses': ('misses_total', 'counter'),
+                   'evictions': ('evictions_total', 'counter'),
+                   'coalesced': ('coalesced_total', 'counter'),
+                   'parsed': ('parsed_total', 'counter')}
+
+    def initialize(self, registry=None, caches=None):
+        """Magic Tornado __init__ replacement."""
+        self.registry = registry or metrics.REGISTRY
+        self.caches = caches or {}
+
+    def get(self):
+        """
+        Write out every metric.
+        """
+        stats = {name: cache.stats() for (name, cache) in self.caches.items()}
+        families = []
+        for (key, (suffix, kind)) in sorted(self.cache_stats.items()):
+            samples = [((('cache', name),), values[key])
+                       for (name, values) in sorted(stats.items())
+                       if values.get(key) is not None]
+            if samples:
+                families.append(('carto_renderer_cache_' + suffix, kind,
+                                 'Cache {} by cache.'.format(key), samples))
+
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(self.registry.expose(families))
+        self.finish()
+
+
+class ReadyHandler(BaseHandler):
+    # pylint: disable=abstract-method
+    """
+    Report whether this worker should be sent traffic: 200 once it has
+    warmed up and while it is not overloaded, 503 otherwise.
+
+    /version says the process is alive; this says it is worth routing to.
+    """
+    def initialize(self, readiness):
+        """Magic Tornado __init__ replacement."""
+        self.readiness = readiness
+
+    def get(self):
+        """
+        Write {"ready": ..., "reasons": [...]}.
+        """
+        reasons = self.readiness.reasons()
+        if reasons:
+            get_logger(self).debug('Not ready: %s', ', '.join(reasons))
+            self.set_status(503)
+        self.write({'ready': not reasons,
+                    'reasons': reasons,
+                    'warmUpSeconds': self.readiness.warm_seconds})
+        self.finish()
+
+
+@web.stream_request_body
 class RenderHandler(BaseHandler):
     # pylint: disable=abstract-method, arguments-differ
     """
     Actually render the png.
 
-    Expects a dictionary with 'style', 'zoom', and 'tile' values.
+    Expects a dictionary with 'style', 'zoom', and 'tile' values. Each
+    layer of 'tile' is a list of WKB features or, for large layers, one
+    buffer of them plus offsets; see the geometry module.
+    Responses carry an ETag derived from those values, so repeated
+    requests can be answered with 304 Not Modified. Tiles with nothing to
+    draw skip rendering and get a pre-encoded blank tile, labelled with
+    an X-Render-Fast-Path: blank header.
+
+    The image format is the payload's 'format' value if it has one, or
+    else the best match for the Accept header; see make_formats.
+
+    With admission control, requests wait for a slot before any work is
+    done. An X-Render-Deadline-Ms header (or the default deadline) caps
+    how long, in milliseconds from arrival, the request is worth serving.
+    If the client disconnects or the deadline passes, the work is
+    cancelled: shared fetches and renders are only dropped once nobody
+    is waiting on them, and renders still queued for the executor never
+    start.
+
+    Bodies are streamed and decoded as they arrive, once the request is
+    admitted; a Content-Length over max_body_size is refused up front.
+
+    Compiled styles come from style_cache, then style_store, then the
+    style renderer; see fetch_style.
+
+    A request whose X-Render-Profile header matches profile_token skips
+    the tile cache and gets a JSON breakdown of its stage timings and a
+    cProfile report instead of the image. With a spool, a slow_sample
+    fraction of renders taking slow_ms or more are captured for replay;
+    see the profiling module.
     """
     keys = [b'tile', b'zoom', b'style']
 
-    def initialize(self, http_client, style_host, style_port):
+    # pylint: disable=too-many-arguments
+    def initialize(self, http_client, style_host, style_port, executor,
+                   style_cache=None, tile_cache=None, formats=None,
+                   default_format='png', admission=None, deadline_ms=0,
+                   max_body_size=0, max_features=0, profile_token='',
+                   spool=None, slow_ms=0, slow_sample=1.0,
+                   style_store=None):
         """Magic Tornado __init__ replacement."""
         self.http_client = http_client  # pragma: no cover
         self.style_host = style_host    # pragma: no cover
         self.style_port = style_port    # pragma: no cover
+        self.executor = executor        # pragma: no cover
+        self.style_cache = style_cache  # pragma: no cover
+        self.tile_cache = tile_cache    # pragma: no cover
+        self.formats = formats or make_formats()  # pragma: no cover
+        self.default_format = default_format      # pragma: no cover
+        self.fast_path = None                     # pragma: no cover
+        self.admission = admission                # pragma: no cover
+        self.deadline_ms = deadline_ms            # pragma: no cover
+        self.deadline = None                      # pragma: no cover
+        self.admitted = False                     # pragma: no cover
+        self.disconnected = False                 # pragma: no cover
+        self.guarded = set()                      # pragma: no cover
+        self.max_body_size = max_body_size        # pragma: no cover
+        self.max_features = max_features          # pragma: no cover
+        self.profile_token = profile_token        # pragma: no cover
+        self.spool = spool                        # pragma: no cover
+        self.slow_ms = slow_ms                    # pragma: no cover
+        self.slow_sample = slow_sample            # pragma: no cover
+        self.style_store = style_store            # pragma: no cover
+        self.profile = False                      # pragma: no cover
+        self.stats = {}                           # pragma: no cover
+        self.xml = None                           # pragma: no cover
+        self.capture = None                       # pragma: no cover
+
+    async def prepare(self):
+        """
+        Count the request as in flight and wait for admission.
+        """
+        super(RenderHandler, self).prepare()
+        IN_FLIGHT.inc()
+
+        if self.max_body_size:
+            length = self.request.headers.get('content-length', '')
+            if length.isdigit() and int(length) > self.max_body_size:
+                raise PayloadTooLarge('Request body is over {} bytes.'.format(
+                    self.max_body_size))
+            # Also bounds chunked bodies, which give no length up front.
+            self.request.connection.set_max_body_size(self.max_body_size)
+
+        header = self.request.headers.get('x-render-deadline-ms')
+        deadline_ms = self.deadline_ms
+        if header is not None:
+            try:
+                deadline_ms = int(header)
+            except ValueError:
+                raise BadRequest('"X-Render-Deadline-Ms" must be an integer.')
+        if deadline_ms > 0:
+            self.deadline = time.monotonic() + deadline_ms / 1000.0
+
+        if self.admission is not None:
+            # The deadline is left to unless_cancelled, so a request that
+            # runs out of time gets the same 504 whether it was queued or
+            # working.
+            await self.unless_cancelled(self.admission.acquire(), 'queue')
+            self.admitted = True
+
+    def on_connection_close(self):
+        """
+        Cancel whatever the request is waiting on.
+        """
+        super(RenderHandler, self).on_connection_close()
+        self.disconnected = True
+        for task in list(self.guarded):
+            task.cancel()
+
+    async def unless_cancelled(self, awaitable, stage='work'):
+        """
+        Await awaitable, cancelling it if the client disconnects or the
+        deadline passes, in which case RequestCancelled is raised.
+        """
+        logger = get_logger(self)
+
+        reason = None
+        if self.disconnected:
+            reason = 'disconnect'
+        task = asyncio.ensure_future(awaitable)
+        self.guarded.add(task)
+        try:
+            if reason is None:
+                if self.deadline is None:
+                    return await task
+                return await asyncio.wait_for(
+                    task, max(self.deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            reason = 'deadline'
+        except asyncio.CancelledError:
+            if not self.disconnected:
+                raise
+            reason = 'disconnect'
+        finally:
+            self.guarded.discard(task)
+
+        task.cancel()
+        logger.info('Cancelled while in %s: %s', stage, reason)
+        CANCELLED.labels(reason, stage).inc()
+        raise RequestCancelled(reason)
+
+    def profile_requested(self):
+        """
+        Whether the request asks for, and may have, a profile.
+        """
+        token = self.request.headers.get('x-render-profile')
+        if token is None:
+            return False
+        # compare_digest only takes ASCII strs; headers may be anything.
+        if not self.profile_token or \
+           not hmac.compare_digest(token.encode('utf-8'),
+                                   self.profile_token.encode('utf-8')):
+            get_logger(self).warn('Ignoring X-Render-Profile with the '
+                                  'wrong token')
+            return False
+        return True
+
+    def capture_if_slow(self):
+        """
+        Spool the request for replay if it rendered slowly.
+        """
+        if self.spool is None or self.capture is None or \
+           self.xml is None or 'render' not in self.stats:
+            return
+        elapsed = self.request.request_time()
+        if elapsed * 1000 < self.slow_ms or \
+           random.random() >= self.slow_sample:
+            return
+
+        (geobody, zoom, overscan, fmt) = self.capture
+        capture = {'payload': geobody,
+                   'xml': self.xml,
+                   'zoom': zoom,
+                   'overscan': overscan,
+                   'format': fmt,
+                   'stats': self.stats,
+                   'elapsed': elapsed,
+                   'requestId': REQUEST_ID.get(),
+                   'time': time.time()}
+        logger = get_logger(self)
+        logger.info('Capturing slow request (%.1fms)', elapsed * 1000)
+
+        def write():
+            """
+            Write the capture, off the IOLoop: it can be megabytes.
+            """
+            try:
+                self.spool.write(capture)
+            except (IOError, OSError) as err:
+                logger.error('Could not capture request: %s', err)
+
+        IOLoop.current().run_in_executor(None, write)
+
+    def on_finish(self):
+        """
+        Count the request as done, give back its slot and capture it
+        if it was slow.
+        """
+        IN_FLIGHT.dec()
+        if self.admitted:
+            self.admitted = False
+            self.admission.release()
+        self.capture_if_slow()
 
 #    @web.asynchronous
     async def post(self):
@@ -185,7 +1253,9 @@ class RenderHandler(BaseHandler):
         """
         logger = get_logger(self)
 
-        geobody = self.extract_body()
+        geobody = await self.extract_body()
+        if self.body_decoder is not None:
+            self.stats['decode'] = self.body_decoder.seconds
 
         if not all([k in geobody for k in self.keys]):
             logger.warn('Invalid JSON: %s', geobody)
@@ -207,74 +1277,600 @@ class RenderHandler(BaseHandler):
                 raise BadRequest('"zoom" must be an integer.',
                                  request_body=geobody)
 
-            path = 'http://{host}:{port}/style?style={css}'.format(
-                host=self.style_host,
-                port=self.style_port,
-                css=quote_plus(geobody[b'style']))
-
+            style = geobody[b'style']
             tile = geobody[b'tile']
+            (content_type, fmt) = self.formats[self.output_format(geobody)]
+            self.profile = self.profile_requested()
+            self.capture = (geobody, zoom, overscan, fmt)
+
+            etag = '"{}"'.format(tile_digest(style, tile, zoom, overscan,
+                                             fmt))
+            self.set_header('ETag', etag)
+            self.set_header('Vary', 'Accept')
+            if self.etag_matches(etag) and not self.profile:
+                self.set_status(304)
+                self.finish()
+                return
+
+            if self.tile_cache is None or self.profile:
+                (png, self.fast_path) = await self.unless_cancelled(
+                    self.render(style, tile, zoom, overscan, fmt))
+            else:
+                (png, self.fast_path) = await self.unless_cancelled(
+                    self.tile_cache.fetch(
+                        etag,
+                        lambda: self.render(style, tile, zoom, overscan,
+                                            fmt)))
 
-            def handle_response(response):
+            if self.profile:
+                self.write_profile(png)
+                return
+
+            self.set_header('Content-Type', content_type)
+            if self.fast_path is not None:
+                self.set_header('X-Render-Fast-Path', self.fast_path)
+            self.write(png)
+            self.finish()
+
+    def write_profile(self, png):
+        """
+        Answer with the request's stage timings and profile.
+
+        The report is not the tile, so it must not be cached or
+        revalidated as one.
+        """
+        self.clear_header('ETag')
+        self.set_header('Cache-Control', 'no-store')
+        stats = dict(self.stats)
+        report = stats.pop('profile', None)
+        counts = stats.pop('counts', None)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'stages': stats,
+                               'counts': counts,
+                               'fastPath': self.fast_path,
+                               'bytes': len(png),
+                               'elapsed': self.request.request_time(),
+                               'profile': report}))
+        self.finish()
+
+    def output_format(self, geobody):
+        """
+        Name the output format for this request.
+
+        An explicit 'format' in the payload must be one we can produce;
+        otherwise the most preferred Accept entry we can produce wins,
+        falling back to the default format.
+        """
+        logger = get_logger(self)
+
+        name = geobody.get(b'format')
+        if name is not None:
+            name = to_text(name)
+            if name not in self.formats:
+                logger.warn('Invalid format: %s', name)
+                raise BadRequest('"format" must be one of: {}.'.format(
+                    ', '.join(sorted(self.formats))))
+            return name
+
+        default_type = self.formats[self.default_format][0]
+        best = (0.0, self.default_format)
+        for entry in self.request.headers.get('accept', '').split(','):
+            params = [param.strip() for param in entry.split(';')]
+            media_type = params[0].lower()
+            quality = 1.0
+            for param in params[1:]:
+                if param.startswith('q='):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0.0
+
+            if media_type in ('*/*', 'image/*', default_type):
+                candidate = self.default_format
+            else:
+                candidate = next((name for (name, (ctype, _))
+                                  in sorted(self.formats.items())
+                                  if ctype == media_type), None)
+            if candidate is not None and quality > best[0]:
+                best = (quality, candidate)
+        return best[1]
+
+    def etag_matches(self, etag):
+        """
+        Whether the request's If-None-Match header covers etag.
+        """
+        header = self.request.headers.get('if-none-match', '').strip()
+        if header == '*':
+            return True
+
+        tags = [tag.strip() for tag in header.split(',')]
+        return etag in [tag[2:] if tag.startswith('W/') else tag
+                        for tag in tags]
+
+    async def fetch_style(self, style):
+        """
+        Return the Mapnik XML the style renderer compiles style into.
+        """
+        self.xml = await fetch_style(self.http_client, self.style_host,
+                                     self.style_port, style,
+                                     self.style_cache, self.stats,
+                                     self.style_store)
+        return self.xml
+
+    async def render(self, style, tile, zoom, overscan, fmt='png'):
+        """
+        Fetch the style and render the tile in the executor, returning
+        (image, fast path) as render_xml does.
+        """
+        xml = await self.fetch_style(style)
+        return await self.render_xml(xml, tile, zoom, overscan, fmt)
+
+    async def render_blank(self, tile, zoom, xml, fmt='png'):
+        """
+        render_blank, analysing a new style's rules off the IOLoop.
+
+        That happens in the IOLoop's own thread pool rather than the
+        executor, as the rules must be kept in this process's MAP_POOL.
+        """
+        if MAP_POOL.analysed.get(xml) is None:
+            await IOLoop.current().run_in_executor(None, MAP_POOL.rules, xml)
+        return render_blank(tile, zoom, xml, fmt)
+
+    async def render_xml(self, xml, tile, zoom, overscan, fmt='png'):
+        """
+        Render the tile with already-compiled style XML in the executor.
+
+        Returns (image, fast path), where the fast path is None or names
+        the shortcut taken. It is cached with the image, so cache hits
+        and coalesced requests are labelled too. Blank tiles are answered
+        here without going to the executor.
+        """
+        logger = get_logger(self)
+
+        blank = await self.render_blank(tile, zoom, xml, fmt)
+        if blank is not None:
+            logger.info('zoom: %d, nothing to draw; using the blank tile',
+                        zoom)
+            FAST_PATHS.labels('blank').inc()
+            return (blank, 'blank')
+
+        logger.info('zoom: %d, num features: %s, len(xml): %d',
+                    zoom,
+                    LogWrapper.Lazy(lambda: sum(layer_size(layer)
+                                                for layer in tile.values())),
+                    len(xml))
+        logger.debug('xml: %s',
+                     LogWrapper.Lazy(lambda: xml.replace('\n', ' ')))
+
+        # Render in the executor so the IOLoop keeps serving requests.
+        args = (render_with_stats, render_png, tile, zoom, xml, overscan, fmt)
+        if self.profile:
+            args = (profiling.profiled,) + args
+        result = await IOLoop.current().run_in_executor(
+            self.executor, call_with_request_id, REQUEST_ID.get(), *args)
+        if self.profile:
+            ((png, stats), self.stats['profile']) = result
+        else:
+            (png, stats) = result
+        record_stats(stats)
+        self.stats.update(stats)
+        return (png, None)
+
+
+class BatchRenderHandler(RenderHandler):
+    # pylint: disable=abstract-method, arguments-differ
+    """
+    Render many tiles that share one style.
+
+    Expects a dictionary with 'style' and 'tiles' values, where each
+    entry of 'tiles' has 'tile', 'zoom', 'overscan', 'x' and 'y' values.
+    The style is resolved once and the tiles render concurrently; each
+    result is streamed back as soon as it is ready, as a msgpack map with
+    'x', 'y', 'zoom' and either 'png' or 'error'. Despite its name, 'png'
+    holds the image in whichever format the batch asked for.
+
+    If the whole batch fails once streaming has started (e.g. at its
+    deadline), a last frame holds just 'error' and 'resultCode', the
+    status the response would have had.
+    """
+    keys = [b'tiles', b'style']
+    entry_keys = [b'tile', b'zoom', b'overscan', b'x', b'y']
+
+    def initialize(self, max_tiles=64, **kwargs):
+        """Magic Tornado __init__ replacement."""
+        super(BatchRenderHandler, self).initialize(**kwargs)
+        self.max_tiles = max_tiles  # pragma: no cover
+
+    async def post(self):
+        """
+        Render every tile in the batch, streaming the results.
+        """
+        logger = get_logger(self)
+
+        geobody = await self.extract_body()
+
+        if not all([k in geobody for k in self.keys]):
+            logger.warn('Invalid JSON: %s', geobody)
+            raise PayloadKeyError(self.keys, geobody)
+
+        entries = geobody[b'tiles']
+        if not isinstance(entries, list):
+            raise BadRequest('"tiles" must be a list.', request_body=geobody)
+        if len(entries) > self.max_tiles:
+            raise BadRequest('A batch may hold at most {} tiles.'.format(
+                self.max_tiles))
+
+        entries = [self.parse_entry(entry) for entry in entries]
+        style = geobody[b'style']
+        (_, fmt) = self.formats[self.output_format(geobody)]
+        xml = await self.unless_cancelled(self.fetch_style(style))
+
+        async def render_entry(entry):
+            """
+            Render one entry into a framed result.
+            """
+            (tile, zoom, overscan, x, y) = entry
+            result = {'x': x, 'y': y, 'zoom': zoom}
+            etag = '"{}"'.format(tile_digest(style, tile, zoom, overscan,
+                                             fmt))
+
+            def render():
                 """
-                Process the XML returned by the style renderer.
+                Render the entry with the shared XML.
                 """
-                if response.body is None:
-                    raise ServiceError(
-                        "Failed to contact style-renderer at '{url}'".format(
-                            url=path),
-                        503)
-
-                xml = response.body
-
-                logger.info('zoom: %d, num features: %d, len(xml): %d',
-                            zoom,
-                            sum([len(layer) for layer in list(tile.values())]),
-                            len(xml))
-                logger.debug('xml: %s',
-                             LogWrapper.Lazy(lambda: xml.replace('\n', ' ')))
-
-                self.write(render_png(tile, zoom, xml, overscan))
-                self.finish()
+                return self.render_xml(xml, tile, zoom, overscan, fmt)
+
+            try:
+                if self.tile_cache is None:
+                    (result['png'], _) = await self.unless_cancelled(render())
+                else:
+                    (result['png'], _) = await self.unless_cancelled(
+                        self.tile_cache.fetch(etag, render))
+            except RequestCancelled:
+                raise
+            except Exception as err:  # pylint: disable=broad-except
+                logger.exception(err)
+                result['error'] = str(err)
+            return msgpack.packb(result)
+
+        self.set_header('Content-Type', 'application/x-msgpack')
+        tasks = [asyncio.ensure_future(render_entry(entry))
+                 for entry in entries]
+        try:
+            for rendered in asyncio.as_completed(tasks):
+                self.write(await rendered)
+                await self.flush()
+        finally:
+            # Stop the rest of the batch if one entry failed it.
+            for task in tasks:
+                task.cancel()
+        self.finish()
 
-            headers = LogWrapper.ENV \
-                if LogWrapper.ENV['X-Socrata-RequestId'] is not None \
-                else {}
+    def write_late_error(self, payload):
+        """
+        End the stream with a frame holding the error.
+        """
+        if self.disconnected:
+            return
+        self.write(msgpack.packb({'error': payload['message'],
+                                  'resultCode': payload['resultCode']}))
+        self.finish()
+
+    def parse_entry(self, entry):
+        """
+        Validate a batch entry, returning (tile, zoom, overscan, x, y).
+        """
+        logger = get_logger(self)
 
-            req = HTTPRequest(path, headers=headers)
-            resp = await self.http_client.fetch(req)
-            handle_response(resp)
+        if not isinstance(entry, dict) or \
+           not all([k in entry for k in self.entry_keys]):
+            logger.warn('Invalid batch entry: %s', entry)
+            raise PayloadKeyError(self.entry_keys, entry)
+
+        return tuple([entry[b'tile']] +
+                     parse_ints(entry, self.entry_keys[1:], logger))
+
+
+class MetatileHandler(RenderHandler):
+    # pylint: disable=abstract-method, arguments-differ
+    """
+    Render an NxN block of tiles in one Mapnik pass and slice it up.
+
+    Expects a dictionary with 'style', 'zoom', 'tile', 'overscan', 'size',
+    'x' and 'y' values. 'size' is N, 'x'/'y' address the block's top-left
+    tile, and feature coordinates span the whole block. The response is
+    a msgpack map per tile with 'x', 'y', 'zoom' and 'png' values, where
+    'png' holds the image in the requested format as for batches.
+    """
+    keys = [b'tile', b'style', b'zoom', b'overscan', b'size', b'x', b'y']
+
+    def initialize(self, max_size=8, **kwargs):
+        """Magic Tornado __init__ replacement."""
+        super(MetatileHandler, self).initialize(**kwargs)
+        self.max_size = max_size  # pragma: no cover
+
+    async def post(self):
+        """
+        Render the metatile, returning every tile in it.
+        """
+        logger = get_logger(self)
+
+        geobody = await self.extract_body()
+
+        if not all([k in geobody for k in self.keys]):
+            logger.warn('Invalid JSON: %s', geobody)
+            raise PayloadKeyError(self.keys, geobody)
+
+        (zoom, overscan, size, x, y) = parse_ints(geobody, self.keys[2:],
+                                                  logger)
+        if not 1 <= size <= self.max_size:
+            raise BadRequest('"size" must be between 1 and {}.'.format(
+                self.max_size), request_body=geobody)
+
+        style = geobody[b'style']
+        tile = geobody[b'tile']
+        (_, fmt) = self.formats[self.output_format(geobody)]
+
+        etag = '"{}"'.format(tile_digest(style, tile, zoom, overscan,
+                                         size, x, y, fmt))
+        self.set_header('ETag', etag)
+        self.set_header('Vary', 'Accept')
+        if self.etag_matches(etag):
+            self.set_status(304)
+            self.finish()
+            return
+
+        async def render():
+            """
+            Render the block and frame its tiles, returning (body, fast
+            path) as render_xml does.
+            """
+            xml = await self.fetch_style(style)
+            blank = await self.render_blank(tile, zoom, xml, fmt)
+            fast_path = None
+            if blank is not None:
+                logger.info('zoom: %d, nothing to draw in the metatile; '
+                            'using the blank tile', zoom)
+                fast_path = 'blank'
+                FAST_PATHS.labels('blank').inc()
+                tiles = [(dx, dy, blank)
+                         for dy in range(size) for dx in range(size)]
+            else:
+                logger.info('zoom: %d, metatile size: %d, len(xml): %d',
+                            zoom, size, len(xml))
+                (tiles, stats) = await IOLoop.current().run_in_executor(
+                    self.executor, call_with_request_id, REQUEST_ID.get(),
+                    render_with_stats, render_metatile,
+                    tile, zoom, xml, overscan, size, fmt)
+                record_stats(stats)
+            return (b''.join(msgpack.packb({'x': x + dx,
+                                            'y': y + dy,
+                                            'zoom': zoom,
+                                            'png': png})
+                             for (dx, dy, png) in tiles), fast_path)
+
+        if self.tile_cache is None:
+            (body, self.fast_path) = await self.unless_cancelled(render())
+        else:
+            (body, self.fast_path) = await self.unless_cancelled(
+                self.tile_cache.fetch(etag, render))
+
+        self.set_header('Content-Type', 'application/x-msgpack')
+        if self.fast_path is not None:
+            self.set_header('X-Render-Fast-Path', self.fast_path)
+        self.write(body)
+        self.finish()
+
+
+def parse_ints(body, keys, logger):
+    """
+    Return the values of keys in body as integers, or raise BadRequest.
+    """
+    values = []
+    for key in keys:
+        try:
+            values.append(int(body[key]))
+        except (TypeError, ValueError):
+            logger.warn('Invalid JSON; %s must be an integer: %s', key, body)
+            raise BadRequest('"{}" must be an integer.'.format(
+                key.decode('utf-8')), request_body=body)
+    return values
+
+
+def renderer_settings():  # pragma: no cover
+    """
+    Return the configure_renderer arguments and the output formats set
+    by options.
+    """
+    renderer_args = (options.map_cache_styles, options.map_cache_idle,
+                     options.clip_features, options.simplify_tolerance)
+    formats = make_formats(options.png8_colors, options.png_compression,
+                           options.png_strategy, options.jpeg_quality,
+                           options.webp_quality)
+    return (renderer_args, formats)
+
+
+def make_app():  # pragma: no cover
+    """
+    Build the application, its caches and its executor from options.
+
+    The renderer of this process is configured (and preloaded) by main,
+    before forking. Warm-up starts once the IOLoop runs; until it
+    finishes, /ready answers 503 while /version already reports the
+    worker alive.
+    """
+    style_cache = LRUCache(options.style_cache_size,
+                           ttl=options.style_cache_ttl)
+    tile_cache = LRUCache(None,
+                          ttl=options.tile_cache_ttl,
+                          max_weight=options.tile_cache_mb << 20,
+                          weigher=tile_weight)
+    (renderer_args, formats) = renderer_settings()
+    if options.output_format not in formats:
+        raise ValueError('output_format must be one of: {}'.format(
+            ', '.join(sorted(formats))))
+
+    caches = {'style': style_cache, 'tiles': tile_cache}
+    style_store = None
+    if options.style_store:
+        style_store = DiskCache(options.style_store,
+                                options.style_store_mb << 20,
+                                ttl=options.style_store_ttl or None)
+        caches['style_store'] = style_store
+    if options.render_mode == 'thread':
+        caches['maps'] = MAP_POOL
+        executor = make_executor(options.render_mode, options.render_workers)
+    else:
+        # Process workers each keep their own pool, and warm it.
+        warm_formats = formats if options.warmup_timeout > 0 else None
+        executor = make_executor(options.render_mode,
+                                 options.render_workers,
+                                 initializer=init_render_process,
+                                 initargs=(renderer_args, warm_formats))
+
+    admission = None
+    if options.max_in_flight > 0:
+        admission = AdmissionControl(options.max_in_flight,
+                                     options.max_queue,
+                                     retry_after=options.retry_after)
+
+    render_args = {
+        'style_cache': style_cache,
+        'style_store': style_store,
+        'tile_cache': tile_cache,
+        'style_host': options.style_host,
+        'style_port': options.style_port,
+        'http_client': upstream.StyleClient(
+            upstream.make_http_client(options.style_max_concurrent),
+            max_concurrent=options.style_max_concurrent,
+            connect_timeout=options.style_connect_timeout,
+            request_timeout=options.style_request_timeout,
+            retries=options.style_retries,
+            backoff=options.style_retry_backoff,
+            failure_threshold=options.style_breaker_failures,
+            reset_timeout=options.style_breaker_reset),
+        'executor': executor,
+        'formats': formats,
+        'default_format': options.output_format,
+        'admission': admission,
+        'deadline_ms': options.deadline_ms,
+        'max_body_size': options.max_body_mb << 20,
+        'max_features': options.max_features,
+        'profile_token': options.profile_token,
+        'spool': profiling.Spool(options.slow_spool,
+                                 options.slow_spool_mb << 20)
+                 if options.slow_spool else None,
+        'slow_ms': options.slow_ms,
+        'slow_sample': options.slow_sample
+    }
+
+    readiness = warmup.Readiness(admission, options.ready_max_queued)
+    if options.warmup_timeout > 0:
+        payloads = warmup.read_payloads(options.warmup_file) \
+            if options.warmup_file else []
+        IOLoop.current().spawn_callback(warm_up, readiness, render_args,
+                                        options.render_workers, payloads,
+                                        options.warmup_timeout)
+    else:
+        readiness.warmed()
+
+    routes = [
+        web.url(r'/', web.RedirectHandler, {'url': '/version'}),
+        web.url(r'/version', VersionHandler, {
+            'caches': caches
+        }),
+        web.url(r'/ready', ReadyHandler, {
+            'readiness': readiness
+        }),
+        web.url(r'/metrics', MetricsHandler, {
+            'caches': caches
+        }),
+        web.url(r'/render', RenderHandler, render_args),
+        web.url(r'/render/batch', BatchRenderHandler,
+                dict(render_args, max_tiles=options.batch_max_tiles)),
+        web.url(r'/render/metatile', MetatileHandler,
+                dict(render_args, max_size=options.metatile_max_size)),
+    ]
+
+    return web.Application(routes, executor=executor)
 
 
 def main():  # pragma: no cover
     """
     Actually fire up the web server.
 
-    Listens on 4096.
+    Listens on 4096. Mapnik is preloaded before any workers are forked.
     """
     define('port', default=4096)
     define('style_host', default='localhost')
     define('style_port', default=4097)
+    define('style_max_concurrent', default=32)
+    define('style_connect_timeout', default=1.0)
+    define('style_request_timeout', default=5.0)
+    define('style_retries', default=2)
+    define('style_retry_backoff', default=0.05)
+    define('style_breaker_failures', default=5)
+    define('style_breaker_reset', default=10.0)
+    define('workers', default=1)
+    define('reuse_port', default=True)
+    define('max_requests', default=0)
+    define('max_rss_mb', default=0)
+    define('shutdown_grace', default=30)
+    define('max_in_flight', default=16)
+    define('max_queue', default=64)
+    define('retry_after', default=1)
+    define('deadline_ms', default=0)
+    define('max_body_mb', default=64)
+    define('max_features', default=0)
+    define('profile_token', default='')
+    define('slow_spool', default='')
+    define('slow_spool_mb', default=256)
+    define('slow_ms', default=1000)
+    define('slow_sample', default=1.0)
+    define('warmup_file', default='')
+    define('warmup_timeout', default=60)
+    define('ready_max_queued', default=32)
+    define('render_mode', default='thread')
+    define('render_workers', default=4)
+    define('style_cache_size', default=1024)
+    define('style_cache_ttl', default=300)
+    define('style_store', default='')
+    define('style_store_mb', default=64)
+    define('style_store_ttl', default=86400)
+    define('map_cache_styles', default=64)
+    define('map_cache_idle', default=4)
+    define('clip_features', default=False)
+    define('simplify_tolerance', default=0.5)
+    define('tile_cache_mb', default=256)
+    define('tile_cache_ttl', default=300)
+    define('output_format', default='png')
+    define('png8_colors', default=256)
+    define('png_compression', default=-1)
+    define('png_strategy', default='default')
+    define('jpeg_quality', default=85)
+    define('webp_quality', default=90)
+    define('batch_max_tiles', default=64)
+    define('metatile_max_size', default=8)
     define('log_level', default='INFO')
     define('log_format', default='%(asctime)s %(levelname)s [%(thread)d] ' +
            '[%(X-Socrata-RequestId)s] %(name)s %(message)s')
     parse_command_line()
     init_logging()
 
-    routes = [
-        web.url(r'/', web.RedirectHandler, {'url': '/version'}),
-        web.url(r'/version', VersionHandler),
-        web.url(r'/render', RenderHandler, {
-            'style_host': options.style_host,
-            'style_port': options.style_port,
-            'http_client': AsyncHTTPClient()
-        }),
-    ]
-
-    app = web.Application(routes)
-    app.listen(options.port)
     logger = get_logger()
-    logger.info('Listening on localhost:4096...')
-    IOLoop.instance().start()
+    (renderer_args, formats) = renderer_settings()
+    configure_renderer(*renderer_args)
+    if options.warmup_timeout > 0:
+        preload(formats)
+    workers = options.workers or os.cpu_count()
+    logger.info('Listening on localhost:%d with %d worker(s)...',
+                options.port, workers)
+    sys.exit(prefork.serve(make_app, options.port,
+                           workers=workers,
+                           reuse_port=options.reuse_port,
+                           max_requests=options.max_requests,
+                           max_rss=options.max_rss_mb << 20,
+                           grace=options.shutdown_grace))
 
 if __name__ == '__main__':  # pragma: no cover
     main()
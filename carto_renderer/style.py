@@ -0,0 +1,90 @@
+"""
+Static analysis of the Mapnik style XML returned by the style renderer.
+"""
+
+import xml.etree.ElementTree as ET
+
+# Mapnik's tolerance when comparing rule scale denominators.
+SCALE_EPSILON = 1e-6
+
+
+def _denominator(rule, tag, default):
+    """
+    Read a rule's scale denominator, or default if it has none.
+    """
+    element = rule.find(tag)
+    if element is None or not (element.text or '').strip():
+        return default
+    return float(element.text)
+
+
+class StyleRules(object):
+    """
+    The scale ranges at which each named <Style> in a map can draw.
+
+    The tile maps are zoomed to pixel boxes, so Mapnik's own scale
+    denominator says nothing about the requested zoom. Instead, at_scale
+    rewrites the XML for a given denominator: rules that cannot draw are
+    removed and the remaining rules lose their scale limits.
+
+    background is the map's background colour, if any; fixed is set when
+    the map draws something without any tile features (a background image
+    or a layer with its own datasource).
+    """
+    def __init__(self, xml):
+        self.xml = xml
+        self.root = ET.fromstring(xml)
+        self.styles = {}
+        self.background = self.root.get('background-color')
+        self.fixed = self.root.get('background-image') is not None or \
+            self.root.find('Layer/Datasource') is not None
+        self.scaled = any(rule.find('MinScaleDenominator') is not None or
+                          rule.find('MaxScaleDenominator') is not None
+                          for rule in self.root.iter('Rule'))
+        self._by_scale = {}
+
+        for style in self.root.findall('Style'):
+            self.styles[style.get('name')] = [
+                (_denominator(rule, 'MinScaleDenominator', 0.0),
+                 _denominator(rule, 'MaxScaleDenominator', float('inf')))
+                for rule in style.findall('Rule')]
+
+    @staticmethod
+    def _active(scale_range, scale):
+        """
+        Whether a rule with scale_range draws at scale, as Mapnik decides.
+        """
+        (min_scale, max_scale) = scale_range
+        return min_scale - SCALE_EPSILON <= scale < max_scale + SCALE_EPSILON
+
+    def visible(self, name, scale):
+        """
+        Whether the style called name has any rule that draws at scale.
+        """
+        return any(self._active(scale_range, scale)
+                   for scale_range in self.styles.get(name, ()))
+
+    def at_scale(self, scale):
+        """
+        Return the map XML with only the rules that draw at scale.
+        """
+        if not self.scaled:
+            return self.xml
+
+        if scale not in self._by_scale:
+            root = ET.fromstring(self.xml)
+            for style in root.findall('Style'):
+                for rule in style.findall('Rule'):
+                    scale_range = (
+                        _denominator(rule, 'MinScaleDenominator', 0.0),
+                        _denominator(rule, 'MaxScaleDenominator',
+                                     float('inf')))
+                    if not self._active(scale_range, scale):
+                        style.remove(rule)
+                        continue
+                    for tag in ('MinScaleDenominator', 'MaxScaleDenominator'):
+                        for element in rule.findall(tag):
+                            rule.remove(element)
+            self._by_scale[scale] = ET.tostring(root, encoding='unicode')
+
+        return self._by_scale[scale]
@@ -0,0 +1,269 @@
+# pylint: disable=missing-docstring,import-error
+"""
+Micro-benchmarks for extract_body, render_png and the render handler.
+
+render_png_clipped is render_png with clip_features on, to show which
+tiles clipping pays off for. Tiles are generated from a fixed seed, so
+runs are comparable across machines and Mapnik versions:
+
+    bin/bench.sh --output baseline.json
+    bin/bench.sh --compare baseline.json --threshold 0.15
+
+Results are JSON; with --compare, the exit status is 1 if any benchmark's
+median regressed by more than the threshold.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+import msgpack
+
+from carto_renderer import service
+from carto_renderer.test.test_service import (BaseStrHandler, MockClient,
+                                              RenderStrHandler, to_wkb)
+
+CSS = '#bench{}'
+
+# name, geometry type, features, vertices per feature, layers, rules,
+# overscan
+CASES = [
+    ('points-small', 'point', 100, 1, 1, 1, 0),
+    ('points-large', 'point', 5000, 1, 1, 1, 0),
+    ('lines-sparse', 'line', 200, 8, 1, 1, 0),
+    ('lines-dense', 'line', 200, 500, 1, 1, 0),
+    ('polygons', 'polygon', 500, 32, 1, 1, 0),
+    ('polygons-overscan', 'polygon', 500, 32, 1, 1, 32),
+    ('layers', 'polygon', 500, 32, 8, 1, 0),
+    ('complex-style', 'polygon', 500, 32, 1, 16, 0),
+    ('lines-long', 'long-line', 5, 10000, 1, 1, 0),
+]
+BENCHMARKS = ('extract_body', 'render_png', 'render_png_clipped', 'handler')
+
+
+def make_geometry(rng, kind, vertices, spread):
+    """
+    One random WKT geometry with about vertices points within spread.
+    """
+    (low, high) = spread
+    if kind == 'point':
+        return 'POINT({:.2f} {:.2f})'.format(rng.uniform(low, high),
+                                             rng.uniform(low, high))
+
+    if kind == 'long-line':
+        # Zig-zags across the tile and far beyond it, as roads and
+        # boundaries do in overzoomed tiles.
+        reach = (high - low) * 20
+        xs = [low - reach + 2 * reach * index / max(vertices - 1, 1)
+              for index in range(max(vertices, 2))]
+        return 'LINESTRING({})'.format(','.join(
+            '{:.2f} {:.2f}'.format(x, rng.uniform(low - reach, high + reach))
+            for x in xs))
+
+    (cx, cy) = (rng.uniform(low, high), rng.uniform(low, high))
+    size = (high - low) / 8.0
+
+    if kind == 'line':
+        # A random walk, so denser lines are more detailed, not longer.
+        step = size / max(vertices, 2)
+        line = [(cx, cy)]
+        for _ in range(max(vertices, 2) - 1):
+            angle = rng.uniform(0, 2 * math.pi)
+            (x, y) = line[-1]
+            line.append((x + step * math.cos(angle),
+                         y + step * math.sin(angle)))
+        return 'LINESTRING({})'.format(
+            ','.join('{:.2f} {:.2f}'.format(*point) for point in line))
+
+    # A star-shaped ring around its centre never self-intersects.
+    ring = []
+    for index in range(max(vertices, 3)):
+        angle = 2 * math.pi * index / max(vertices, 3)
+        radius = rng.uniform(0.25, 0.5) * size
+        ring.append((cx + radius * math.cos(angle),
+                     cy + radius * math.sin(angle)))
+    ring.append(ring[0])
+    return 'POLYGON(({}))'.format(
+        ','.join('{:.2f} {:.2f}'.format(*point) for point in ring))
+
+
+def make_tile(seed, kind, features, vertices, layers, overscan=0):
+    """
+    A {layer name: [wkb]} tile. As in real tiles, some features lie
+    partly or wholly outside the tile.
+    """
+    rng = random.Random(seed)
+    spread = (-overscan - 64, service.TILE_SIZE + overscan + 64)
+    tile = {}
+    for layer in range(layers):
+        wkts = [make_geometry(rng, kind, vertices, spread)
+                for _ in range(features // layers)]
+        tile['bench{}'.format(layer)] = to_wkb(*wkts)
+    return tile
+
+
+def make_style(layers, rules):
+    """
+    Map XML with one style per layer, each with rules filtered on a
+    property, plus a catch-all rule.
+    """
+    symbolizers = ('<MarkersSymbolizer fill="#{0}" width="4" />'
+                   '<LineSymbolizer stroke="#{0}" stroke-width="1" />'
+                   '<PolygonSymbolizer fill="#{0}" />')
+    styles = []
+    for layer in range(layers):
+        rule_xml = ['<Rule><Filter>[class] = {}</Filter>{}</Rule>'.format(
+            rule, symbolizers.format('{:06x}'.format(rule * 0x0f0f0f)))
+                    for rule in range(1, rules)]
+        rule_xml.append('<Rule>{}</Rule>'.format(symbolizers.format('0000cc')))
+        styles.append('<Style name="bench{}">{}</Style>'.format(
+            layer, ''.join(rule_xml)))
+    return '<?xml version="1.0" encoding="utf-8"?><Map>{}</Map>'.format(
+        ''.join(styles))
+
+
+def time_calls(call, iterations, warmup, setup=lambda: None):
+    """
+    Time iterations calls of call(setup()), after warmup untimed ones.
+
+    setup is not timed.
+    """
+    for _ in range(warmup):
+        call(setup())
+    times = []
+    for _ in range(iterations):
+        arg = setup()
+        start = time.perf_counter()
+        call(arg)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {'iterations': iterations,
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+            'mean': sum(times) / len(times)}
+
+
+def bench_case(case, iterations, warmup, benchmarks=BENCHMARKS):
+    """
+    Run the benchmarks for one case, returning {benchmark: timings}.
+    """
+    (_, kind, features, vertices, layers, rules, overscan) = case
+    tile = make_tile(0, kind, features, vertices, layers, overscan)
+    xml = make_style(layers, rules)
+    payload = {b'tile': tile, b'zoom': 14, b'style': CSS,
+               b'overscan': overscan}
+    body = msgpack.packb(payload)
+    loop = asyncio.new_event_loop()
+
+    # Building the test handlers is slow, so it happens in untimed setup.
+    def extract_handler():
+        handler = BaseStrHandler()
+        handler.headers = {'content-type': 'application/octet-stream'}
+        handler.body = body
+        return handler
+
+    def render_handler():
+        handler = RenderStrHandler()
+        handler.body = payload
+        handler.http_client = MockClient(CSS, xml)
+        return handler
+
+    def render_png(clip_features):
+        def call(_):
+            service.CLIP_FEATURES = clip_features
+            service.render_png(tile, 14, xml, overscan)
+        return call
+
+    def handle(handler):
+        loop.run_until_complete(handler.post())
+        assert handler.written
+
+    calls = {
+        'extract_body': (lambda handler: loop.run_until_complete(
+            handler.extract_body()),
+                         extract_handler),
+        'render_png': (render_png(False), lambda: None),
+        'render_png_clipped': (render_png(True), lambda: None),
+        'handler': (handle, render_handler)
+    }
+    clip_features = service.CLIP_FEATURES
+    try:
+        return {name: time_calls(calls[name][0], iterations, warmup,
+                                 calls[name][1])
+                for name in benchmarks}
+    finally:
+        service.CLIP_FEATURES = clip_features
+        loop.close()
+
+
+def run(iterations, warmup, only=None):
+    """
+    Run every case (or those named in only), returning the JSON report.
+    """
+    import mapnik
+    results = {}
+    for case in CASES:
+        if only and case[0] not in only:
+            continue
+        for (name, timings) in bench_case(case, iterations, warmup).items():
+            results['{}/{}'.format(case[0], name)] = timings
+            sys.stderr.write('{:40} {:10.3f}ms\n'.format(
+                '{}/{}'.format(case[0], name), timings['median'] * 1000))
+
+    return {'python': platform.python_version(),
+            'mapnik': getattr(mapnik, 'mapnik_version', lambda: None)(),
+            'platform': platform.platform(),
+            'results': results}
+
+
+def compare(report, baseline, threshold):
+    """
+    Return (name, baseline median, median) for every regression.
+    """
+    regressions = []
+    for (name, timings) in sorted(report['results'].items()):
+        before = baseline['results'].get(name)
+        if before and timings['median'] > before['median'] * (1 + threshold):
+            regressions.append((name, before['median'], timings['median']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--case', action='append',
+                        help='Only run this case; may be repeated.')
+    parser.add_argument('--output', help='Write the JSON report here.')
+    parser.add_argument('--compare', help='Baseline JSON report.')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Allowed slowdown of the median (0.10 = 10%%).')
+    args = parser.parse_args(argv)
+
+    report = run(args.iterations, args.warmup, args.case)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(report, json.load(baseline),
+                                  args.threshold)
+        for (name, before, after) in regressions:
+            sys.stderr.write('REGRESSION {}: {:.3f}ms -> {:.3f}ms\n'.format(
+                name, before * 1000, after * 1000))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
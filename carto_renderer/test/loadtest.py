@@ -0,0 +1,238 @@
+# pylint: disable=missing-docstring,import-error
+"""
+End-to-end load test against a real service process.
+
+Starts the service (service.main, with any extra arguments passed on)
+and a stand-in style renderer that answers every /style request with
+canned XML after a configurable delay, then replays recorded payloads
+at each concurrency level, once the service reports itself ready:
+
+    bin/loadtest.sh --replay payloads.msgpack --concurrency 1,8,32 \\
+        -- --render_workers=8 --tile_cache_mb=0
+
+A replay file is a sequence of msgpack-encoded /render payloads, one
+after another; --generate writes a synthetic one. Each level reports
+RPS, p50/p95/p99 latency and the error rate as a JSON line.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import msgpack
+from tornado import gen, web
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+
+DEFAULT_XML = """<?xml version="1.0" encoding="utf-8"?>
+<Map>
+  <Style name="bench0">
+    <Rule>
+      <MarkersSymbolizer fill="#0000cc" width="4" />
+      <LineSymbolizer stroke="#cc0000" stroke-width="1" />
+      <PolygonSymbolizer fill="#00cc00" />
+    </Rule>
+  </Style>
+</Map>
+"""
+
+
+class StyleHandler(web.RequestHandler):
+    # pylint: disable=abstract-method,arguments-differ
+    """
+    Stand-in style renderer: canned XML after a fixed delay.
+    """
+    def initialize(self, xml, latency):
+        self.xml = xml
+        self.latency = latency
+
+    async def get(self):
+        if self.latency:
+            await gen.sleep(self.latency)
+        self.write(self.xml)
+
+
+def free_port():
+    """
+    A port nothing is listening on right now.
+    """
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def read_replay(path):
+    """
+    Return the packed payloads in a replay file.
+    """
+    with open(path, 'rb') as replay:
+        unpacker = msgpack.Unpacker(replay, raw=True)
+        return [msgpack.packb(payload) for payload in unpacker]
+
+
+def write_replay(path, count, seed=0):
+    """
+    Write count synthetic payloads (see benchmark.make_tile) to path.
+    """
+    from carto_renderer.test import benchmark
+
+    cases = [case for case in benchmark.CASES if case[4] == 1]
+    with open(path, 'wb') as replay:
+        for index in range(count):
+            (_, kind, features, vertices, _, _, overscan) = \
+                cases[index % len(cases)]
+            tile = benchmark.make_tile(seed + index, kind, features,
+                                       vertices, 1, overscan)
+            replay.write(msgpack.packb({'tile': tile,
+                                        'zoom': 14,
+                                        'style': '#bench0{}',
+                                        'overscan': overscan}))
+
+
+def percentile(ordered, fraction):
+    """
+    The fraction percentile of an ordered list, or None if it is empty.
+    """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_level(url, payloads, concurrency, duration):
+    """
+    Drive concurrency parallel request loops at url for duration seconds.
+    """
+    client = AsyncHTTPClient(force_instance=True,
+                             max_clients=concurrency)
+    latencies = []
+    errors = [0]
+    position = [0]
+    deadline = time.monotonic() + duration
+
+    async def loop():
+        while time.monotonic() < deadline:
+            body = payloads[position[0] % len(payloads)]
+            position[0] += 1
+            request = HTTPRequest(url, method='POST', body=body,
+                                  headers={'Content-Type':
+                                           'application/octet-stream'},
+                                  request_timeout=60)
+            start = time.monotonic()
+            response = await client.fetch(request, raise_error=False)
+            latencies.append(time.monotonic() - start)
+            if response.code != 200:
+                errors[0] += 1
+
+    start = time.monotonic()
+    await gen.multi([loop() for _ in range(concurrency)])
+    elapsed = time.monotonic() - start
+    client.close()
+
+    latencies.sort()
+    return {'concurrency': concurrency,
+            'requests': len(latencies),
+            'errors': errors[0],
+            'errorRate': errors[0] / float(len(latencies) or 1),
+            'rps': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99)}
+
+
+async def wait_until_up(url, timeout):
+    """
+    Poll url until it answers 200, or raise after timeout seconds.
+    """
+    client = AsyncHTTPClient()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            response = await client.fetch(url, raise_error=False)
+            if response.code == 200:
+                return
+        except (IOError, OSError):
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError('Service was not up at {}'.format(url))
+        await gen.sleep(0.1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='End-to-end load test against a real service process.')
+    parser.add_argument('--replay', required=True,
+                        help='File of msgpack /render payloads.')
+    parser.add_argument('--generate', type=int, default=0, metavar='N',
+                        help='First write N synthetic payloads to --replay.')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='Comma-separated concurrency levels.')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds per level.')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='Untimed seconds before the first level.')
+    parser.add_argument('--style_latency', type=float, default=0.005,
+                        help='Seconds the stand-in style renderer waits.')
+    parser.add_argument('--xml', help='Mapnik XML the style renderer returns.')
+    parser.add_argument('service_args', nargs='*',
+                        help='Passed on to the service, after "--".')
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        write_replay(args.replay, args.generate)
+    payloads = read_replay(args.replay)
+    if not payloads:
+        parser.error('{} holds no payloads'.format(args.replay))
+
+    xml = DEFAULT_XML
+    if args.xml:
+        with open(args.xml) as xml_file:
+            xml = xml_file.read()
+
+    style_port = free_port()
+    port = free_port()
+    web.Application([
+        (r'/style', StyleHandler, {'xml': xml, 'latency': args.style_latency})
+    ]).listen(style_port, 'localhost')
+
+    service = subprocess.Popen(
+        [sys.executable, '-m', 'carto_renderer.service',
+         '--port={}'.format(port),
+         '--style_host=localhost',
+         '--style_port={}'.format(style_port),
+         '--log_level=WARNING'] + args.service_args,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.getcwd()] + [os.environ.get('PYTHONPATH', '')])))
+
+    url = 'http://localhost:{}'.format(port)
+
+    async def run():
+        # /version answers at once; /ready only once warm-up is over, so
+        # the first level does not measure cold renders.
+        await wait_until_up(url + '/ready', 90)
+        if args.warmup:
+            await run_level(url + '/render', payloads, 1, args.warmup)
+        results = []
+        for level in [int(level) for level in args.concurrency.split(',')]:
+            result = await run_level(url + '/render', payloads, level,
+                                     args.duration)
+            print(json.dumps(result, sort_keys=True))
+            sys.stdout.flush()
+            results.append(result)
+        return results
+
+    try:
+        IOLoop.current().run_sync(run)
+    finally:
+        service.terminate()
+        service.wait()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+# pylint: disable=missing-docstring
+import asyncio
+import time
+
+import pytest
+from pytest import raises
+
+from carto_renderer.admission import AdmissionControl
+from carto_renderer.errors import ServiceUnavailable
+
+
+@pytest.mark.asyncio
+async def test_admits_then_queues_then_sheds():
+    control = AdmissionControl(2, 1, retry_after=7)
+    await control.acquire()
+    await control.acquire()
+    assert control.in_flight == 2
+
+    queued = asyncio.ensure_future(control.acquire())
+    await asyncio.sleep(0)
+    assert not queued.done()
+
+    with raises(ServiceUnavailable) as shed:
+        await control.acquire()
+    assert shed.value.status_code == 503
+    assert shed.value.headers == {'Retry-After': '7'}
+
+    control.release()
+    await queued
+    assert control.in_flight == 2
+
+    control.release()
+    control.release()
+    assert control.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_deadline_while_queued():
+    control = AdmissionControl(1, 4)
+    await control.acquire()
+
+    with raises(ServiceUnavailable) as late:
+        await control.acquire(time.monotonic() + 0.01)
+    assert 'Deadline' in late.value.message
+
+    control.release()
+    assert control.in_flight == 0
+    await control.acquire()
+    assert control.in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_fifo_and_cancelled_waiters():
+    control = AdmissionControl(1, 4)
+    await control.acquire()
+    order = []
+
+    async def wait(name):
+        await control.acquire()
+        order.append(name)
+
+    first = asyncio.ensure_future(wait('first'))
+    second = asyncio.ensure_future(wait('second'))
+    third = asyncio.ensure_future(wait('third'))
+    await asyncio.sleep(0)
+    second.cancel()
+
+    control.release()
+    await first
+    control.release()
+    await third
+    assert order == ['first', 'third']
+    assert control.in_flight == 1
@@ -0,0 +1,43 @@
+# pylint: disable=missing-docstring,import-error
+from hypothesis import given, settings
+from hypothesis.strategies import integers, sampled_from
+
+from carto_renderer.geometry import parse_wkb, count_vertices
+from carto_renderer.test import benchmark
+
+
+@settings(deadline=None)
+@given(integers(min_value=0, max_value=2 ** 32),
+       sampled_from(['point', 'line', 'polygon']),
+       integers(min_value=1, max_value=50),
+       integers(min_value=1, max_value=4))
+def test_make_tile(seed, kind, vertices, layers):
+    tile = benchmark.make_tile(seed, kind, layers * 2, vertices, layers)
+
+    assert len(tile) == layers
+    assert tile == benchmark.make_tile(seed, kind, layers * 2, vertices,
+                                       layers)
+    for features in tile.values():
+        assert len(features) == 2
+        for wkb in features:
+            assert count_vertices(*parse_wkb(wkb)) >= 1
+
+
+def test_bench_case():
+    case = ('tiny', 'polygon', 4, 8, 2, 3, 16)
+    timings = benchmark.bench_case(case, 2, 1)
+
+    assert set(timings) == set(benchmark.BENCHMARKS)
+    for result in timings.values():
+        assert result['iterations'] == 2
+        assert 0 < result['min'] <= result['median'] <= result['p95']
+
+
+def test_compare():
+    def report(median):
+        return {'results': {'a/render_png': {'median': median}}}
+
+    assert benchmark.compare(report(1.05), report(1.0), 0.10) == []
+    assert benchmark.compare(report(1.2), report(1.0), 0.10) == \
+        [('a/render_png', 1.0, 1.2)]
+    assert benchmark.compare(report(1.2), {'results': {}}, 0.10) == []
@@ -0,0 +1,108 @@
+# pylint: disable=missing-docstring
+import io
+import json
+import os
+import sqlite3
+
+import msgpack
+
+from carto_renderer import bulk
+from carto_renderer.test.test_service import to_wkb
+
+XML = """<?xml version="1.0" encoding="utf-8"?>
+<Map>
+  <Style name="main">
+    <Rule>
+      <MarkersSymbolizer fill="#0000cc" width="10" />
+    </Rule>
+  </Style>
+</Map>
+"""
+
+
+def job(z, x, y, wkt='POINT(50 50)'):
+    return {'z': z, 'x': x, 'y': y, 'style': 'main',
+            'tile': {'main': to_wkb(wkt)}}
+
+
+def test_read_jobs():
+    packed = msgpack.packb(job(1, 0, 1)) + msgpack.packb(job(2, 3, 1))
+    jobs = list(bulk.read_jobs(io.BufferedReader(io.BytesIO(packed))))
+    assert [(j[b'z'], j[b'x'], j[b'y']) for j in jobs] == [(1, 0, 1),
+                                                           (2, 3, 1)]
+
+    [wkb] = to_wkb('POINT(1 2)')
+    lines = '\n'.join([
+        json.dumps({'z': 1, 'x': 0, 'y': 1, 'style': 'main',
+                    'tile': {'main': [wkb.hex(), [wkb.hex(), {'a': 'b'}]]}}),
+        ''])
+    [decoded] = bulk.read_jobs(io.BufferedReader(
+        io.BytesIO(lines.encode('utf-8'))))
+    assert decoded[b'style'] == 'main'
+    assert decoded[b'tile'] == {b'main': [wkb, (wkb, {'a': 'b'})]}
+
+
+def write_inputs(tmpdir):
+    styles = tmpdir.mkdir('styles')
+    styles.join('main.xml').write(XML)
+    jobs = str(tmpdir.join('jobs.msgpack'))
+    with open(jobs, 'wb') as output:
+        for packed in (job(3, 1, 2), job(3, 2, 2), job(3, 1, 3, 'POINT(9 9)'),
+                       job(3, 1, 4)):
+            output.write(msgpack.packb(packed))
+        output.write(msgpack.packb(dict(job(3, 1, 5), style='missing')))
+    return (jobs, str(styles))
+
+
+def run_main(capsys, *argv):
+    code = bulk.main(list(argv) + ['--workers', '2'])
+    return (code, json.loads(capsys.readouterr()[0]))
+
+
+def test_main_writes_mbtiles(tmpdir, capsys):
+    (jobs, styles) = write_inputs(tmpdir)
+    output = str(tmpdir.join('seed.mbtiles'))
+
+    (code, summary) = run_main(capsys, jobs, '--styles', styles,
+                               '--output', output, '--batch', '2')
+    assert code == 1
+    assert (summary['rendered'], summary['failed'],
+            summary['deduplicated']) == (4, 1, 2)
+
+    connection = sqlite3.connect(output)
+    rows = connection.execute('SELECT zoom_level, tile_column, tile_row, '
+                              'tile_data FROM tiles').fetchall()
+    assert sorted(row[:3] for row in rows) == [(3, 1, 3), (3, 1, 4),
+                                               (3, 1, 5), (3, 2, 5)]
+    assert all(row[3].startswith(b'\x89PNG') for row in rows)
+    assert connection.execute('SELECT COUNT(*) FROM images').fetchone() == \
+        (2,)
+    assert dict(connection.execute('SELECT * FROM metadata'))['maxzoom'] == \
+        '3'
+    connection.close()
+
+    # Resuming skips what is already there.
+    (_, summary) = run_main(capsys, jobs, '--styles', styles,
+                            '--output', output)
+    assert (summary['rendered'], summary['skipped']) == (0, 4)
+
+
+def test_main_writes_directories(tmpdir, capsys):
+    (jobs, styles) = write_inputs(tmpdir)
+    output = tmpdir.join('tiles')
+
+    (_, summary) = run_main(capsys, jobs, '--styles',
+                            os.path.join(styles, 'main.xml'),
+                            '--output', str(output))
+    assert summary['rendered'] == 5
+    assert summary['deduplicated'] == 3
+
+    assert output.join('3', '1', '2.png').read_binary() == \
+        output.join('3', '2', '2.png').read_binary()
+    assert os.stat(str(output.join('3', '1', '2.png'))).st_nlink == 4
+    assert not [path for path in output.visit() if '.tmp' in path.basename]
+
+    (_, summary) = run_main(capsys, jobs, '--styles',
+                            os.path.join(styles, 'main.xml'),
+                            '--output', str(output))
+    assert summary['skipped'] == 5
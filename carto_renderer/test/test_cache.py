@@ -0,0 +1,187 @@
+# pylint: disable=missing-docstring
+import asyncio
+import os
+import time
+
+import pytest
+from hypothesis import given
+from hypothesis.strategies import integers, lists
+from pytest import raises
+
+from carto_renderer.cache import DiskCache, LRUCache
+
+
+class FakeClock(object):
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@given(lists(integers()), integers(min_value=1, max_value=10))
+def test_lru_cache_is_bounded(keys, size):
+    cache = LRUCache(size)
+    for key in keys:
+        cache.put(key, str(key))
+
+    assert len(cache) <= size
+    for key in keys[-1:]:
+        assert cache.get(key) == str(key)
+
+
+def test_lru_cache_evicts_least_recent():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_lru_cache_ttl():
+    clock = FakeClock()
+    cache = LRUCache(2, ttl=10, clock=clock)
+    cache.put('a', 1)
+
+    clock.now = 9
+    assert cache.get('a') == 1
+    clock.now = 10
+    assert cache.get('a') is None
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['size'] == 0
+
+
+def test_lru_cache_weight_budget():
+    cache = LRUCache(None, max_weight=10, weigher=len)
+    cache.put('a', b'12345')
+    cache.put('b', b'1234')
+    cache.put('c', b'12')
+
+    assert cache.get('a') is None
+    assert cache.stats()['weight'] == 6
+
+    cache.put('b', b'1')
+    assert cache.stats()['weight'] == 3
+
+    cache.put('huge', b'x' * 11)
+    assert cache.get('huge') is None
+    assert cache.stats()['weight'] == 0
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_fetch_is_single_flight():
+    cache = LRUCache(2)
+    calls = []
+
+    async def thunk():
+        calls.append(None)
+        await asyncio.sleep(0)
+        return 'xml'
+
+    results = await asyncio.gather(*[cache.fetch('a', thunk)
+                                     for _ in range(5)])
+
+    assert results == ['xml'] * 5
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 4
+    assert await cache.fetch('a', thunk) == 'xml'
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_fetch_does_not_cache_errors():
+    cache = LRUCache(2)
+
+    async def fail():
+        raise RuntimeError('boom')
+
+    with raises(RuntimeError):
+        await cache.fetch('a', fail)
+
+    async def succeed():
+        return 'xml'
+
+    assert await cache.fetch('a', succeed) == 'xml'
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_fetch_cancels_when_abandoned():
+    cache = LRUCache(2)
+    started = asyncio.Event()
+    cancelled = []
+
+    async def thunk():
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    first = asyncio.ensure_future(cache.fetch('a', thunk))
+    second = asyncio.ensure_future(cache.fetch('a', thunk))
+    await started.wait()
+
+    first.cancel()
+    await asyncio.sleep(0)
+    assert not cancelled
+
+    second.cancel()
+    with raises(asyncio.CancelledError):
+        await second
+    await asyncio.sleep(0)
+    assert cancelled
+    assert cache.get('a') is None
+
+
+def test_disk_cache_is_shared(tmpdir):
+    first = DiskCache(str(tmpdir), 1 << 20)
+    second = DiskCache(str(tmpdir), 1 << 20)
+
+    assert second.get('#main{}') is None
+    first.put('#main{}', b'<Map />')
+    assert second.get('#main{}') == b'<Map />'
+    assert second.get(b'#main{}') == b'<Map />'
+    assert second.stats()['hits'] == 2
+    assert second.stats()['misses'] == 1
+    assert os.listdir(str(tmpdir)) == [os.path.basename(first.path('#main{}'))]
+
+    # Survives a restart.
+    assert DiskCache(str(tmpdir), 1 << 20).stats()['size'] == 1
+
+
+def test_disk_cache_ttl(tmpdir):
+    clock = FakeClock()
+    clock.now = time.time()
+    cache = DiskCache(str(tmpdir), 1 << 20, ttl=10, clock=clock)
+    cache.put('key', b'value')
+
+    clock.now += 5
+    assert cache.get('key') == b'value'
+    clock.now += 10
+    assert cache.get('key') is None
+
+
+def test_disk_cache_evicts_least_recently_read(tmpdir):
+    clock = FakeClock()
+    clock.now = time.time() + 60
+    cache = DiskCache(str(tmpdir), 250, clock=clock)
+    cache.put('a', b'a' * 100)
+    cache.put('b', b'b' * 100)
+    assert cache.get('a') == b'a' * 100
+
+    cache.put('c', b'c' * 100)
+    assert cache.get('b') is None
+    assert cache.get('a') == b'a' * 100
+    assert cache.get('c') == b'c' * 100
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['weight'] == 200
@@ -0,0 +1,168 @@
+# pylint: disable=missing-docstring,import-error
+import struct
+
+from hypothesis import given
+from hypothesis.strategies import floats, lists, tuples
+from pytest import raises
+
+from carto_renderer import geometry
+from carto_renderer.geometry import LINESTRING, POINT, POLYGON
+
+BOX = (0, 0, 100, 100)
+
+
+def wkb_of(wkt, order):
+    from mapnik import Geometry, wkbByteOrder  # pylint: disable=no-name-in-module
+    return Geometry.from_wkt(wkt).to_wkb(getattr(wkbByteOrder, order))
+
+
+def test_parse_wkb_both_byte_orders():
+    cases = [
+        ('POINT(1 2)', (POINT, [(1, 2)])),
+        ('LINESTRING(0 0,1 1)', (LINESTRING, [[(0, 0), (1, 1)]])),
+        ('POLYGON((0 0,1 0,1 1,0 0))',
+         (POLYGON, [[[(0, 0), (1, 0), (1, 1), (0, 0)]]])),
+        ('MULTIPOINT(1 2,3 4)', (POINT, [(1, 2), (3, 4)])),
+    ]
+    for (wkt, expected) in cases:
+        for order in ('XDR', 'NDR'):
+            assert geometry.parse_wkb(wkb_of(wkt, order)) == expected
+
+
+def test_encode_wkb_roundtrip():
+    parts = [[[(0, 0), (4, 0), (4, 4), (0, 0)]], [[(5, 5), (6, 5), (6, 6), (5, 5)]]]
+    wkb = geometry.encode_wkb(POLYGON, parts)
+    assert geometry.parse_wkb(wkb) == (POLYGON, parts)
+    assert geometry.encode_wkb(POINT, []) is None
+
+
+def test_clip_line_splits_at_edges():
+    line = [(-50, 50), (50, 50), (50, 150), (60, 150), (60, 50)]
+    assert geometry.clip(LINESTRING, [line], BOX) == \
+        [[(0.0, 50), (50, 50), (50, 100.0)], [(60, 100.0), (60, 50)]]
+
+
+def test_clip_polygon():
+    square = [(-50, -50), (150, -50), (150, 150), (-50, 150), (-50, -50)]
+    far = [(200, 200), (300, 200), (300, 300), (200, 200)]
+    clipped = geometry.clip(POLYGON, [[square], [far]], BOX)
+
+    assert len(clipped) == 1
+    assert sorted(set(clipped[0][0])) == [(0, 0), (0, 100), (100, 0), (100, 100)]
+
+
+@given(lists(tuples(floats(-500, 500), floats(-500, 500)), min_size=3))
+def test_clip_polygon_stays_in_box(points):
+    ring = points + points[:1]
+    for polygon in geometry.clip(POLYGON, [[ring]], BOX):
+        for (x, y) in polygon[0]:
+            assert 0 <= x <= 100 and 0 <= y <= 100
+
+
+def test_simplify_drops_close_vertices():
+    line = [(0, 0), (0.1, 0), (0.2, 0), (1, 0), (1.1, 0)]
+    assert geometry.simplify(LINESTRING, [line], 0.5) == [[(0, 0), (1, 0), (1.1, 0)]]
+
+    tiny = [(0, 0), (0.1, 0), (0.1, 0.1), (0, 0)]
+    assert geometry.simplify(POLYGON, [[tiny]], 0.5) == [[tiny]]
+
+
+def test_wkb_extent():
+    for order in ('XDR', 'NDR'):
+        wkb = wkb_of('MULTIPOLYGON(((0 0,10 0,10 5,0 0),(1 1,20 1,1 2,1 1)),'
+                     '((-3 4,1 4,1 8,-3 4)))', order)
+        assert geometry.wkb_extent(wkb) == (12, (-3, 0, 10, 8))
+        assert geometry.wkb_extent(wkb_of('POINT(1 2)', order)) == \
+            (1, (1, 2, 1, 2))
+
+    mixed = struct.pack('<BII', 1, 4, 2) + wkb_of('POINT(1 2)', 'NDR') + \
+        wkb_of('LINESTRING(0 0,1 1)', 'NDR')
+    for invalid in (b'INVALID', mixed, wkb_of('POINT(1 2)', 'NDR')[:-1]):
+        with raises(ValueError):
+            geometry.wkb_extent(invalid)
+
+
+def test_wkb_vertices():
+    for order in ('XDR', 'NDR'):
+        wkb = wkb_of('MULTIPOLYGON(((0 0,10 0,10 5,0 0),(1 1,20 1,1 2,1 1)),'
+                     '((-3 4,1 4,1 8,-3 4)))', order)
+        assert geometry.wkb_vertices(wkb) == 12
+        assert geometry.wkb_vertices(wkb_of('POINT(1 2)', order)) == 1
+
+    line = wkb_of('LINESTRING(0 0,1 1)', 'NDR')
+    for invalid in (b'INVALID', line[:-1]):
+        with raises(ValueError):
+            geometry.wkb_vertices(invalid)
+
+
+def test_prepare_wkb():
+    inside = wkb_of('POINT(50 50)', 'NDR')
+    assert geometry.prepare_wkb(inside, BOX, 0.5) == (inside, 1, 1)
+
+    # Features inside the box are left alone, however detailed.
+    detailed = wkb_of('LINESTRING(50 50,50 50.1,50 50.2,60 60)', 'NDR')
+    assert geometry.prepare_wkb(detailed, BOX, 0.5) == (detailed, 4, 4)
+
+    outside = wkb_of('LINESTRING(200 200,300 300)', 'NDR')
+    assert geometry.prepare_wkb(outside, BOX, 0.5) == (None, 2, 0)
+
+    crossing = wkb_of('LINESTRING(50 50,50 60,50 60.1,50 500)', 'NDR')
+    (wkb, before, after) = geometry.prepare_wkb(crossing, BOX, 0.5)
+    assert (before, after) == (4, 3)
+    assert geometry.parse_wkb(wkb) == (LINESTRING, [[(50, 50), (50, 60), (50, 100)]])
+
+    assert geometry.prepare_wkb(b'INVALID', BOX, 0.5) == (b'INVALID', 0, 0)
+
+
+def test_prepare_wkb_empty_parts():
+    ring = [(50, 50), (500, 50), (500, 60), (50, 50)]
+    for parts in ([[ring], []], [[ring], [[]]]):
+        wkb = geometry.encode_wkb(POLYGON, parts)
+        (prepared, _, _) = geometry.prepare_wkb(wkb, BOX, 0.5)
+        (_, [[clipped]]) = geometry.parse_wkb(prepared)
+        assert max(x for (x, _) in clipped) == 100
+
+    # Nothing to bound; left for Mapnik.
+    for parts in ([[]], [[[]]]):
+        wkb = geometry.encode_wkb(POLYGON, parts)
+        assert geometry.prepare_wkb(wkb, BOX, 0.5) == (wkb, 0, 0)
+
+
+def columnar(*wkbs):
+    offsets = [0]
+    for wkb in wkbs:
+        offsets.append(offsets[-1] + len(wkb))
+    return {b'geometries': b''.join(wkbs),
+            b'offsets': struct.pack('<{}I'.format(len(offsets)), *offsets)}
+
+
+def test_columnar_features():
+    wkbs = [wkb_of(wkt, 'NDR') for wkt in ('POINT(1 2)', 'LINESTRING(0 0,1 1)')]
+
+    features = list(geometry.columnar_features(columnar(*wkbs)))
+    assert [bytes(feature) for feature in features] == wkbs
+    assert all(isinstance(feature, memoryview) for feature in features)
+    assert geometry.parse_wkb(features[1]) == (LINESTRING, [[(0, 0), (1, 1)]])
+
+    layer = columnar(*wkbs)
+    layer[b'properties'] = [{b'a': 1}, None]
+    [(_, first), (_, second)] = geometry.columnar_features(layer)
+    assert (first, second) == ({b'a': 1}, None)
+
+    assert not list(geometry.columnar_features(columnar()))
+
+
+def test_columnar_offsets_are_checked():
+    wkb = wkb_of('POINT(1 2)', 'NDR')
+    bad = [{b'geometries': wkb},
+           {b'geometries': wkb, b'offsets': b'\x00\x00'},
+           {b'geometries': wkb, b'offsets': struct.pack('<2I', 0, 5)},
+           {b'geometries': wkb, b'offsets': struct.pack('>2I', 0, len(wkb))},
+           {**columnar(wkb), b'properties': []},
+           {**columnar(wkb), b'properties': 5},
+           {**columnar(wkb), b'properties': {b'a': 1}},
+           {**columnar(wkb), b'properties': [5]},
+           {b'geometries': b'', b'offsets': b'\x00' * 4, b'properties': 5}]
+    for layer in bad:
+        with raises(ValueError):
+            geometry.columnar_offsets(layer)
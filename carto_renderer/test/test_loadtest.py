@@ -0,0 +1,46 @@
+# pylint: disable=missing-docstring,import-error
+import msgpack
+import pytest
+from tornado import web
+
+from carto_renderer.test import loadtest
+
+
+def test_replay_round_trip(tmpdir):
+    path = str(tmpdir.join('replay.msgpack'))
+    loadtest.write_replay(path, 3)
+
+    payloads = [msgpack.unpackb(body, raw=True)
+                for body in loadtest.read_replay(path)]
+    assert len(payloads) == 3
+    for payload in payloads:
+        assert set(payload) == {b'tile', b'zoom', b'style', b'overscan'}
+        assert payload[b'tile'][b'bench0']
+
+
+def test_percentile():
+    ordered = list(range(100))
+    assert loadtest.percentile(ordered, 0.5) == 50
+    assert loadtest.percentile(ordered, 0.99) == 99
+    assert loadtest.percentile([3], 0.99) == 3
+    assert loadtest.percentile([], 0.5) is None
+
+
+@pytest.mark.asyncio
+async def test_wait_until_up_waits_for_ready():
+    answers = [503, 503, 200]
+
+    class ReadyHandler(web.RequestHandler):
+        # pylint: disable=abstract-method
+        def get(self):
+            self.set_status(answers.pop(0))
+
+    port = loadtest.free_port()
+    server = web.Application([(r'/ready', ReadyHandler)]).listen(
+        port, 'localhost')
+    try:
+        await loadtest.wait_until_up(
+            'http://localhost:{}/ready'.format(port), 5)
+        assert not answers
+    finally:
+        server.stop()
@@ -0,0 +1,54 @@
+# pylint: disable=missing-docstring
+from hypothesis import given
+from hypothesis.strategies import floats, lists
+from pytest import raises
+
+from carto_renderer.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_and_gauge():
+    registry = Registry()
+    requests = Counter('requests_total', 'Requests.', labels=['code'],
+                       registry=registry)
+    in_flight = Gauge('in_flight', 'In flight.', registry=registry)
+
+    ok = requests.labels('200')
+    ok.inc()
+    ok.inc(2)
+    requests.labels('a"b').inc()
+    in_flight.inc()
+    in_flight.inc()
+    in_flight.dec()
+
+    text = registry.expose()
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{code="200"} 3' in text
+    assert 'requests_total{code="a\\"b"} 1' in text
+    assert 'in_flight 1' in text.splitlines()
+    assert requests.labels('200') is ok
+
+    with raises(ValueError):
+        requests.labels()
+
+
+@given(lists(floats(min_value=0, max_value=100)))
+def test_histogram(values):
+    registry = Registry()
+    latency = Histogram('latency_seconds', 'Latency.', registry=registry,
+                        buckets=(0.1, 1, 10))
+    for value in values:
+        latency.observe(value)
+
+    lines = registry.expose().splitlines()
+    buckets = [int(line.split()[-1]) for line in lines
+               if line.startswith('latency_seconds_bucket')]
+    assert buckets == [len([v for v in values if v <= bound])
+                       for bound in (0.1, 1, 10, float('inf'))]
+    assert 'latency_seconds_count {}'.format(len(values)) in lines
+    assert lines[-2].startswith('latency_seconds_sum ')
+
+
+def test_extra_families():
+    text = Registry().expose([('cache_hits_total', 'counter', 'Hits.',
+                               [((('cache', 'style'),), 4)])])
+    assert text.endswith('cache_hits_total{cache="style"} 4\n')
@@ -0,0 +1,148 @@
+# pylint: disable=missing-docstring
+import struct
+
+from hypothesis import given
+from hypothesis.strategies import integers
+from pytest import raises
+
+from carto_renderer import geometry, mvt
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def field(number, payload):
+    if isinstance(payload, int):
+        return varint(number << 3) + varint(payload)
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def packed(number, values):
+    return field(number, b''.join(varint(v) for v in values))
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+
+def mvt_layer(name, features, keys=(), values=(), extent=4096):
+    return field(3, b''.join([field(15, 2),
+                              field(1, name.encode('utf-8'))] +
+                             [field(2, feat) for feat in features] +
+                             [field(3, k.encode('utf-8')) for k in keys] +
+                             [field(4, v) for v in values] +
+                             [field(5, extent)]))
+
+
+def mvt_feature(geom_type, commands, tags=()):
+    return packed(2, tags) + field(3, geom_type) + packed(4, commands)
+
+
+def parse_wkb(wkb):
+    (order, kind) = struct.unpack_from('<BI', wkb)
+    assert order == 1
+    return kind
+
+
+@given(integers(min_value=-2 ** 31, max_value=2 ** 31 - 1))
+def test_zigzag_roundtrip(value):
+    # pylint: disable=protected-access
+    assert mvt._zigzag(zigzag(value) & 0xffffffff) == value
+
+
+def test_decode_geometry_spec_example():
+    # MoveTo(3, 6), LineTo(8, 12), LineTo(20, 34), ClosePath
+    commands = [9, 6, 12, 18, 10, 12, 24, 44, 15]
+    (kind, parts) = mvt.decode_geometry(geometry.POLYGON, commands, 1, 256)
+    assert kind == geometry.POLYGON
+    assert parts == [[[(3, 250), (8, 244), (20, 222), (3, 250)]]]
+
+
+def test_decode_geometry_polygon_holes():
+    outer = [9, 0, 0, 26, 20, 0, 0, 20, 19, 0, 15]
+    inner = [9, 10, 10, 26, 0, 6, 6, 0, 0, 5, 15]
+    (_, parts) = mvt.decode_geometry(geometry.POLYGON, outer + inner, 1,
+                                     256)
+    assert len(parts) == 1
+    assert len(parts[0]) == 2
+
+
+def test_decode_tile():
+    point = mvt_feature(geometry.POINT, [9, zigzag(100), zigzag(200)],
+                        tags=[0, 0, 1, 1])
+    line = mvt_feature(geometry.LINESTRING,
+                       [9, 0, 0, 18, zigzag(10), 0, 0, zigzag(10)])
+    multipoint = mvt_feature(geometry.POINT, [17, 2, 2, 2, 2])
+    values = [field(1, b'name'), field(4, 7)]
+    data = mvt_layer('main', [point, line, multipoint],
+                     keys=['label', 'count'], values=values,
+                     extent=512) + \
+        mvt_layer('empty', [])
+
+    tile = mvt.decode_tile(data, 256)
+
+    assert set(tile) == {'main', 'empty'}
+    assert tile['empty'] == []
+    [(point_wkb, props), (line_wkb, _), (multi_wkb, _)] = tile['main']
+    assert props == {'label': 'name', 'count': 7}
+    assert point_wkb == struct.pack('<BIdd', 1, 1, 50.0, 156.0)
+    assert parse_wkb(line_wkb) == 2
+    assert parse_wkb(multi_wkb) == 4
+
+
+def test_decode_tile_rejects_garbage():
+    with raises(ValueError):
+        mvt.decode_tile(b'\x1a\xff\x01', 256)
+
+    with raises(ValueError):
+        mvt.decode_tile(mvt_layer('main', [mvt_feature(1, [9, 0, 0],
+                                                       tags=[3, 3])]), 256)
+
+
+def test_decode_tile_checks_wire_types():
+    for data in (field(3, field(1, 1 << 40)),   # Varint layer name.
+                 field(3, field(4, 5)),         # Varint layer value.
+                 field(3, field(4, field(1, 7))),  # Varint string value.
+                 field(3, field(5, b'x')),      # Message as the extent.
+                 field(3, field(2, field(3, b'x'))),  # Message geom type.
+                 field(3, field(4, b'\x15\x00')),  # Truncated float.
+                 field(3, 1)):                  # Varint layer.
+        with raises(ValueError):
+            mvt.decode_tile(data, 256)
+
+    # Unknown fields of any type are skipped.
+    assert mvt.decode_tile(field(9, 1) + field(3, field(99, b'x')), 256) == \
+        {'': []}
+
+
+def test_decoded_tiles_render_upright():
+    from carto_renderer import service
+
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main">
+        <Rule>
+          <PolygonSymbolizer fill="#0000cc" />
+        </Rule>
+      </Style>
+    </Map>
+    """
+    # A band along the bottom eighth of the tile: MVT y points down.
+    band = mvt_feature(geometry.POLYGON,
+                       [9, 0, zigzag(3584), 26, zigzag(4096), 0, 0,
+                        zigzag(512), zigzag(-4096), 0, 15])
+    tile = mvt.decode_tile(mvt_layer('main', [band]), service.TILE_SIZE)
+
+    # pylint: disable=protected-access
+    image = service._render_image(tile, 14, xml, service.TILE_SIZE, 0)
+    assert image.get_pixel(128, 250) != 0
+    assert image.get_pixel(128, 5) == 0
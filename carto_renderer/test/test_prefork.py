@@ -0,0 +1,104 @@
+# pylint: disable=missing-docstring,abstract-method
+import asyncio
+import signal
+
+import mock
+
+from tornado import web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+from carto_renderer import prefork
+
+
+class HelloHandler(web.RequestHandler):
+    def get(self):
+        self.write('hello')
+
+
+def run_worker(requests, settings=None, **worker_args):
+    handlers = (signal.getsignal(signal.SIGTERM),
+                signal.getsignal(signal.SIGINT))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        sockets = bind_sockets(0, '127.0.0.1')
+        port = sockets[0].getsockname()[1]
+        worker = prefork.Worker(web.Application([(r'/', HelloHandler)],
+                                                **(settings or {})),
+                                sockets, **worker_args)
+        bodies = []
+
+        async def client():
+            http = AsyncHTTPClient()
+            for _ in range(requests):
+                resp = await http.fetch('http://127.0.0.1:{}/'.format(port))
+                bodies.append(resp.body)
+            if not worker.max_requests:
+                worker.shutdown(0)
+
+        IOLoop.current().spawn_callback(client)
+        code = worker.run()
+        return (worker, code, bodies)
+    finally:
+        signal.signal(signal.SIGTERM, handlers[0])
+        signal.signal(signal.SIGINT, handlers[1])
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_worker_recycles_after_max_requests():
+    (worker, code, bodies) = run_worker(3, max_requests=3, grace=1)
+
+    assert code == prefork.RECYCLE_EXIT
+    assert bodies == [b'hello'] * 3
+    assert worker.served == 3
+    assert worker.active == 0
+
+
+def test_worker_clean_shutdown():
+    (worker, code, bodies) = run_worker(1, grace=1)
+
+    assert code == 0
+    assert bodies == [b'hello']
+    assert worker.active == 0
+
+
+def test_worker_shuts_down_executor():
+    executor = mock.MagicMock()
+    run_worker(1, settings={'executor': executor}, grace=1)
+
+    executor.shutdown.assert_called_once_with()
+
+
+def test_serve_supervises_recycled_workers():
+    with mock.patch.object(prefork, 'Supervisor') as supervisor, \
+            mock.patch.object(prefork, 'Worker') as worker, \
+            mock.patch.object(prefork, 'bind_sockets'):
+        assert prefork.serve(mock.Mock(), 0, workers=1, max_requests=10) == 0
+        supervisor.assert_called_once()
+        worker.assert_not_called()
+
+        worker.return_value.run.return_value = 0
+        assert prefork.serve(mock.Mock(), 0, workers=1, grace=5) == 0
+        worker.assert_called_once()
+        supervisor.assert_called_once()
+
+def test_counting_forgets_closed_connections():
+    # pylint: disable=protected-access
+    class FakeWorker(object):
+        # pylint: disable=too-few-public-methods
+        pending = set()
+
+    delegate = mock.MagicMock()
+    counting = prefork._Counting(FakeWorker, 'conn', delegate)
+    counting.headers_received(None, None)
+    assert FakeWorker.pending == {'conn'}
+
+    counting.on_connection_close()
+    assert not FakeWorker.pending
+    delegate.on_connection_close.assert_called_once_with()
+
+def test_current_rss():
+    assert prefork.current_rss() > 0
@@ -0,0 +1,55 @@
+# pylint: disable=missing-docstring
+import json
+import os
+
+from carto_renderer import profiling
+
+
+def test_profiled():
+    (result, report) = profiling.profiled(sorted, [3, 1, 2])
+    assert result == [1, 2, 3]
+    assert 'function calls' in report
+
+
+def test_spool_is_bounded(tmpdir):
+    spool = profiling.Spool(str(tmpdir), 2500)
+    paths = [spool.write({'index': index, 'data': b'x' * 1000})
+             for index in range(4)]
+
+    assert spool.captures() == paths[2:]
+    assert profiling.load(paths[3])[b'index'] == 3
+    assert not [name for name in os.listdir(str(tmpdir))
+                if not name.endswith(profiling.CAPTURE_SUFFIX)]
+
+    assert spool.write({'data': b'x' * 3000}) is None
+    assert spool.captures() == paths[2:]
+
+
+def test_main_replays_captures(tmpdir, capsys):
+    from carto_renderer.test.test_service import to_wkb
+
+    xml = ('<?xml version="1.0" encoding="utf-8"?><Map><Style name="main">'
+           '<Rule><MarkersSymbolizer fill="#0000cc" width="10" /></Rule>'
+           '</Style></Map>')
+    spool = profiling.Spool(str(tmpdir.join('spool')), 1 << 20)
+    spool.write({'payload': {b'tile': {b'main': [(to_wkb('POINT(50 50)')[0],
+                                                  {'kind': 'dot'})]}},
+                 'xml': xml,
+                 'zoom': 14,
+                 'overscan': 0,
+                 'format': 'png',
+                 'stats': {'render': 0.5, 'counts': [1, 1, 1, 1]},
+                 'elapsed': 0.75})
+
+    output = str(tmpdir.join('tile.png'))
+    assert profiling.main([spool.directory, '--profile', '--iterations', '2',
+                           '--output', output]) == 0
+
+    (out, err) = capsys.readouterr()
+    result = json.loads(out)
+    assert result['captured'] == {'render': 0.5}
+    assert result['capturedElapsed'] == 0.75
+    assert result['counts'] == [1, 1, 1, 1]
+    assert 'render_png' in err
+    with open(output, 'rb') as image:
+        assert image.read().startswith(b'\x89PNG')
@@ -2,9 +2,15 @@
 import string
 from urllib.parse import quote_plus
 from base64 import b64encode
+from io import BytesIO
 
 import json
+import logging
+import struct
+import threading
+import time
 import mock
+import msgpack
 import asyncio
 import pytest
 from hypothesis import given
@@ -13,6 +19,7 @@ from pytest import raises
 from tornado.web import RequestHandler
 
 from carto_renderer import service, errors
+from carto_renderer.cache import LRUCache
 
 def tile_encode(layer):
     return {k: [b64encode(f) for f in feats] for k, feats in list(layer.items())}
@@ -23,6 +30,11 @@ def to_wkb(*wkts):
     return [Geometry.from_wkt(wkt).to_wkb(wkbByteOrder.XDR) for wkt in wkts]
 
 
+def to_wkt(wkb):
+    from mapnik import Geometry  # pylint: disable=no-name-in-module
+    return Geometry.from_wkb(wkb).to_wkt()
+
+
 def render_pair(pair):
     assert len(pair) == 2
     return "{} {}".format(pair[0], pair[1])
@@ -37,10 +49,12 @@ class MockClient(object):
     def __init__(self, style, xml):
         self.resp = MockClient.MockResp(xml)
         self.style = style
+        self.fetches = 0
 
     async def fetch(self, req):
         path = req.url
         assert path.endswith(quote_plus(self.style))
+        self.fetches += 1
         return self.resp
 
 
@@ -56,6 +70,7 @@ class StringHandler(RequestHandler):
         self.status_reason = None
         self.request = self
         self.headers = {}
+        self.response_headers = {}
         self.body = None
 
     # Stop @web.asynchronous from swallowing exceptions!
@@ -73,6 +88,16 @@ class StringHandler(RequestHandler):
         self.write(chunk)
         self.finished = True
 
+    def set_header(self, name, value):
+        self.response_headers[name] = value
+
+    def clear_header(self, name):
+        self.response_headers.pop(name, None)
+
+    async def flush(self, include_footers=False):
+        self.flushes = getattr(self, 'flushes', 0) + 1
+        self._headers_written = True
+
     def set_status(self, code, reason=None):
         self.status_code = code
         self.status_reason = reason
@@ -92,6 +117,14 @@ class VersionStrHandler(service.VersionHandler, StringHandler):
     pass
 
 
+class MetricsStrHandler(service.MetricsHandler, StringHandler):
+    pass
+
+
+class ReadyStrHandler(service.ReadyHandler, StringHandler):
+    pass
+
+
 class RenderStrHandler(service.RenderHandler, StringHandler):
     def initialize(self):
         pass
@@ -102,14 +135,47 @@ class RenderStrHandler(service.RenderHandler, StringHandler):
         self.http_client = None
         self.style_host = None
         self.style_port = None
-
-    def extract_body(self):
+        self.executor = None
+        self.style_cache = None
+        self.style_store = None
+        self.tile_cache = None
+        self.formats = service.make_formats()
+        self.default_format = 'png'
+        self.fast_path = None
+        self.admission = None
+        self.deadline_ms = 0
+        self.deadline = None
+        self.admitted = False
+        self.disconnected = False
+        self.guarded = set()
+        self.profile_token = ''
+        self.spool = None
+        self.slow_ms = 0
+        self.slow_sample = 1.0
+        self.profile = False
+        self.stats = {}
+        self.xml = None
+        self.capture = None
+
+    async def extract_body(self):
         if self.body is None:
-            return service.RenderHandler.extract_body(self)
+            return await service.RenderHandler.extract_body(self)
         else:
             return self.body
 
 
+class BatchRenderStrHandler(service.BatchRenderHandler, RenderStrHandler):
+    def __init__(self):
+        RenderStrHandler.__init__(self)
+        self.max_tiles = 4
+
+
+class MetatileStrHandler(service.MetatileHandler, RenderStrHandler):
+    def __init__(self):
+        RenderStrHandler.__init__(self)
+        self.max_size = 4
+
+
 @given(text(), integers(), text())
 def test_base_handler(message, status, body):
     # pylint: disable=no-member,protected-access
@@ -129,6 +195,17 @@ def test_base_handler(message, status, body):
     assert json.dumps(message) in base.was_written()
 
 
+def test_base_handler_abbreviates_body():
+    # pylint: disable=protected-access
+    base = BaseStrHandler()
+    body = {b'tile': {b'main': [b'\xff' * 100000]}, b'zoom': 14}
+    base._handle_request_exception(errors.BadRequest('Nope', body))
+
+    written = json.loads(base.was_written())
+    assert written['request_body'].startswith("{b'tile'")
+    assert len(written['request_body']) <= errors.MAX_ECHO + 3
+    assert len(errors.summarise(b'\xff' * 5000)) == errors.MAX_ECHO + 3
+
 def test_version_handler():
     ver = VersionStrHandler()
     ver.get()                   # pylint: disable=no-member
@@ -137,29 +214,332 @@ def test_version_handler():
     assert 'version' in ver.was_written()
     assert 'pythonVersion' in ver.was_written()
     assert 'buildTime' in ver.was_written()
+    assert 'caches' in ver.was_written()
     assert ver.finished
 
 
-def test_base_handler_bad_req():
+def test_ready_handler():
+    from carto_renderer.warmup import Readiness
+
+    readiness = Readiness()
+    handler = ReadyStrHandler(readiness=readiness)
+    handler.get()               # pylint: disable=no-member
+    assert handler.status_code == 503
+    assert handler.written == [{'ready': False, 'reasons': ['warming up'],
+                                'warmUpSeconds': None}]
+
+    readiness.warmed()
+    handler = ReadyStrHandler(readiness=readiness)
+    handler.get()               # pylint: disable=no-member
+    assert handler.status_code is None
+    assert handler.written[0]['ready']
+    assert handler.finished
+
+
+def test_base_handler_logs_shed_requests_quietly(caplog):
+    # pylint: disable=protected-access
+    base = BaseStrHandler()
+    with caplog.at_level(logging.INFO, logger='carto_renderer'):
+        base._handle_request_exception(errors.ServiceUnavailable('Busy', 3))
+        base._handle_request_exception(errors.RequestCancelled('disconnect'))
+    assert base.status_code == 499
+    assert not caplog.records
+
+    with caplog.at_level(logging.INFO, logger='carto_renderer'):
+        base._handle_request_exception(RuntimeError('Broken'))
+    assert [record.exc_info is not None for record in caplog.records] == \
+        [True]
+
+
+def test_base_handler_error_headers():
+    base = BaseStrHandler()
+    base._handle_request_exception(errors.ServiceUnavailable('Busy', 3))
+    assert base.status_code == 503
+    assert base.response_headers['Retry-After'] == '3'
+
+
+@pytest.mark.asyncio
+async def test_render_handler_admission():
+    from carto_renderer.admission import AdmissionControl
+
+    control = AdmissionControl(1, 0)
+    first = RenderStrHandler()
+    first.admission = control
+    await first.prepare()
+    assert first.admitted
+
+    second = RenderStrHandler()
+    second.admission = control
+    with raises(errors.ServiceUnavailable):
+        await second.prepare()
+    second.on_finish()
+    assert control.in_flight == 1
+
+    first.on_finish()
+    assert control.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_render_handler_deadline_header():
+    handler = RenderStrHandler()
+    handler.request.headers['x-render-deadline-ms'] = 'soon'
+    with raises(errors.BadRequest):
+        await handler.prepare()
+
+    handler = RenderStrHandler()
+    handler.request.headers['x-render-deadline-ms'] = '250'
+    await handler.prepare()
+    assert 0 < handler.deadline - time.monotonic() <= 0.25
+
+
+@pytest.mark.asyncio
+async def test_render_handler_deadline_while_queued():
+    from carto_renderer.admission import AdmissionControl
+
+    # Its clock runs ahead, so a deadline it was given would pass first.
+    control = AdmissionControl(1, 1, clock=lambda: time.monotonic() + 1)
+    first = RenderStrHandler()
+    first.admission = control
+    await first.prepare()
+
+    queued = RenderStrHandler()
+    queued.admission = control
+    queued.request.headers['x-render-deadline-ms'] = '10'
+    with raises(errors.RequestCancelled) as err:
+        await queued.prepare()
+    queued.on_finish()
+
+    # The same status as a deadline passing once admitted.
+    assert err.value.status_code == 504
+    assert not queued.admitted
+    assert control.in_flight == 1
+    assert control.queued == 0
+    first.on_finish()
+
+
+@pytest.mark.asyncio
+async def test_render_handler_cancels_past_deadline():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    handler = RenderStrHandler()
+    handler.deadline = time.monotonic() + 0.01
+    with raises(errors.RequestCancelled) as err:
+        await handler.unless_cancelled(slow())
+    assert err.value.status_code == 504
+    assert cancelled
+    assert not handler.guarded
+
+
+@pytest.mark.asyncio
+async def test_render_handler_cancels_on_disconnect():
+    handler = RenderStrHandler()
+    handler.request._body_future = asyncio.Future()
+    waiting = asyncio.ensure_future(
+        handler.unless_cancelled(asyncio.sleep(10)))
+    await asyncio.sleep(0)
+    assert len(handler.guarded) == 1
+
+    handler.on_connection_close()
+    with raises(errors.RequestCancelled) as err:
+        await waiting
+    assert err.value.status_code == 499
+
+    with raises(errors.RequestCancelled):
+        await handler.unless_cancelled(asyncio.sleep(0))
+
+def test_metrics_handler():
+    cache = LRUCache(4)
+    cache.get('missing')
+    base = BaseStrHandler()
+    base._handle_request_exception(errors.BadRequest('Nope'))
+
+    handler = MetricsStrHandler(caches={'style': cache})
+    handler.get()                   # pylint: disable=no-member
+
+    text = handler.was_written()
+    assert handler.response_headers['Content-Type'].startswith('text/plain')
+    assert 'carto_renderer_cache_misses_total{cache="style"} 1' in text
+    assert 'carto_renderer_cache_entries{cache="style"} 0' in text
+    assert 'carto_renderer_errors_total{error="BadRequest"}' in text
+    assert '# TYPE carto_renderer_stage_seconds histogram' in text
+    assert handler.finished
+
+
+def test_render_with_stats():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map><Style name="main"><Rule><MarkersSymbolizer /></Rule></Style></Map>
+    """
+    tile = {"main": to_wkb("POINT(50 50)", "POINT(5000 5000)")}
+    drawn = service.COUNTED[1].value
+    rendered = service.STAGES['render'].count
+
+    service.configure_renderer(64, 4, clip_features=True)
+    try:
+        (png, stats) = service.render_with_stats(service.render_png,
+                                                 tile, 14, xml, 0)
+        service.record_stats(stats)
+
+        assert png == service.render_png(tile, 14, xml, 0)
+    finally:
+        service.configure_renderer(64, 4)
+    assert set(stats) == {'map_load', 'features', 'render', 'encode',
+                          'counts'}
+    assert stats['counts'] == [2, 1, 2, 1]
+    assert service.COUNTED[1].value == drawn + 1
+    assert service.STAGES['render'].count == rendered + 1
+
+    # Without clipping, vertices are still counted.
+    (_, stats) = service.render_with_stats(service.render_png,
+                                           tile, 14, xml, 0)
+    assert stats['counts'] == [2, 2, 2, 2]
+
+
+@pytest.mark.asyncio
+async def test_base_handler_bad_req():
     # pylint: disable=no-member
 
     with raises(errors.BadRequest) as no_ct:
         base = BaseStrHandler()
-        base.extract_body()
+        await base.extract_body()
     assert "invalid content-type" in no_ct.value.message.lower()
 
     with raises(errors.BadRequest) as bad_ct:
         base = BaseStrHandler()
         base.request.headers['content-type'] = 'unexpected type!'
-        base.extract_body()
+        await base.extract_body()
     assert "invalid content-type" in bad_ct.value.message.lower()
 
     with raises(errors.BadRequest) as bad_json:
         base = BaseStrHandler()
         base.request.headers['content-type'] = 'application/octet-stream'
-        base.extract_body()
+        await base.extract_body()
     assert "could not parse" in bad_json.value.message.lower()
 
+@pytest.mark.asyncio
+async def test_base_handler_mvt():
+    # pylint: disable=no-member
+    # One layer, 'main', holding POINT(100 100) in a 4096 extent; y
+    # points down in MVT, up in the map.
+    body = (b'\x1a\x13\x78\x02\x0a\x04main'
+            b'\x12\x09\x18\x01\x22\x05\x09\xc8\x01\xc8\x01')
+
+    base = BaseStrHandler()
+    base.request.headers['content-type'] = 'application/x-protobuf'
+    base.body = body
+    base.query_arguments = {'style': [b'#main{}'], 'zoom': [b'14'],
+                            'overscan': [b'0']}
+    extracted = await base.extract_body()
+
+    assert extracted[b'style'] == '#main{}'
+    assert extracted[b'zoom'] == '14'
+    assert extracted[b'overscan'] == '0'
+    [(wkb, properties)] = extracted[b'tile']['main']
+    assert to_wkt(wkb) == 'POINT(6.25 249.75)'
+    assert properties == {}
+
+    with raises(errors.BadRequest) as bad_mvt:
+        base = BaseStrHandler()
+        base.request.headers['content-type'] = 'application/vnd.mapbox-vector-tile'
+        base.body = b'\x1a\xff'
+        base.query_arguments = {}
+        await base.extract_body()
+    assert "vector tile" in bad_mvt.value.message.lower()
+
+    # A varint where the layer's name belongs.
+    with raises(errors.BadRequest):
+        base = BaseStrHandler()
+        base.request.headers['content-type'] = 'application/x-protobuf'
+        base.body = b'\x1a\x07\x08\x80\x80\x80\x80\x80\x20'
+        base.query_arguments = {}
+        await base.extract_body()
+
+
+@pytest.mark.asyncio
+async def test_base_handler_mvt_decodes_in_executor():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    threads = []
+    decode_tile = service.mvt.decode_tile
+
+    def recording(*args):
+        threads.append(threading.current_thread())
+        return decode_tile(*args)
+
+    base = BaseStrHandler()
+    base.request.headers['content-type'] = 'application/x-protobuf'
+    base.body = b''
+    base.query_arguments = {}
+    with mock.patch.object(service.mvt, 'decode_tile', recording), \
+            ThreadPoolExecutor(1) as executor:
+        base.executor = executor
+        assert (await base.extract_body())[b'tile'] == {}
+    assert threads and threads[0] is not threading.current_thread()
+
+@pytest.mark.asyncio
+async def test_body_decoder_streams():
+    payload = {b'tile': {b'main': to_wkb('POINT(1 1)', 'POINT(2 2)')},
+               b'zoom': 14, b'style': b'#main{}'}
+    body = msgpack.packb(payload)
+
+    decoder = service.BodyDecoder()
+    decoder.feed(body[:-7])
+    # Everything but the incomplete tail has already been decoded.
+    assert decoder.unpacker.tell() > len(body) / 2
+    assert not decoder.payloads
+    decoder.feed(body[-7:])
+    assert decoder.payload() == payload
+
+    base = BaseStrHandler()
+    base.request.headers['content-type'] = 'application/octet-stream'
+    base.data_received(body[:10])
+    base.data_received(body[10:])
+    assert await base.extract_body() == payload
+
+
+def test_body_decoder_limits():
+    payload = msgpack.packb({b'tile': {b'main': [b'x'] * 3},
+                             b'tiles': [{b'tile': {b'main': [b'y'] * 2}}]})
+
+    decoder = service.BodyDecoder(max_size=len(payload) - 1)
+    decoder.feed(payload)
+    with raises(errors.PayloadTooLarge):
+        decoder.payload()
+
+    decoder = service.BodyDecoder(max_features=4)
+    decoder.feed(payload)
+    with raises(errors.PayloadTooLarge) as too_many:
+        decoder.payload()
+    assert '5 features' in too_many.value.message
+
+    decoder = service.BodyDecoder()
+    decoder.feed(payload + payload)
+    with raises(errors.BadRequest):
+        decoder.payload()
+
+    decoder = service.BodyDecoder()
+    decoder.feed(b'\xc1' + b'\xff' * 4096)
+    with raises(errors.BadRequest) as garbage:
+        decoder.payload()
+    assert len(garbage.value.request_body) <= errors.MAX_ECHO + 3
+
+
+@pytest.mark.asyncio
+async def test_render_handler_body_too_large():
+    handler = RenderStrHandler()
+    handler.max_body_size = 100
+    handler.request.headers['content-length'] = '101'
+    with raises(errors.PayloadTooLarge) as too_large:
+        await handler.prepare()
+    assert too_large.value.status_code == 413
+
 @pytest.mark.asyncio
 async def test_render_handler_bad_req():
     keys = ["tile", "zoom", "style"]
@@ -255,6 +635,438 @@ async def test_render_handler(host, port):
     assert handler.was_written_b64() == expected
 
 
+@pytest.mark.asyncio
+async def test_render_handler_caches_style():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <!DOCTYPE Map[]>
+    <Map>
+      <Style name="main" filter-mode="first">
+        <Rule>
+          <MarkersSymbolizer stroke="#0000cc" width="1" />
+        </Rule>
+      </Style>
+    </Map>
+    """
+    css = '#main{marker-line-color:#00C;marker-width:1}'
+    client = MockClient(css, xml)
+    cache = LRUCache(4)
+
+    for _ in range(3):
+        handler = RenderStrHandler()
+        handler.body = {b'zoom': 14, b'style': css, b'tile': {}, b'overscan': 0}
+        handler.http_client = client
+        handler.style_cache = cache
+        await handler.post()
+        assert handler.finished
+
+    assert client.fetches == 1
+    assert cache.stats()['hits'] == 2
+
+
+@pytest.mark.asyncio
+async def test_render_handler_shares_style_store(tmpdir):
+    from carto_renderer.cache import DiskCache
+
+    css = '#main{}'
+    client = MockClient(css, b'<Map />')
+    store = DiskCache(str(tmpdir), 1 << 20)
+
+    # Separate style caches, as in separate or restarted processes.
+    for _ in range(2):
+        handler = RenderStrHandler()
+        handler.http_client = client
+        handler.style_cache = LRUCache(4)
+        handler.style_store = store
+        assert await handler.fetch_style(css) == b'<Map />'
+        for _ in range(100):
+            if store.get(css) is not None:
+                break
+            await asyncio.sleep(0.01)
+
+    assert client.fetches == 1
+    assert store.stats()['hits'] >= 2
+
+
+PROFILE_XML = """<?xml version="1.0" encoding="utf-8"?>
+<Map>
+  <Style name="main">
+    <Rule>
+      <MarkersSymbolizer fill="#0000cc" width="10" />
+    </Rule>
+  </Style>
+</Map>
+"""
+
+
+def profile_handler(**attributes):
+    handler = RenderStrHandler()
+    handler.body = {b'zoom': 14, b'style': '#main{}', b'overscan': 0,
+                    b'tile': {b'main': to_wkb('POINT(50 50)')}}
+    handler.http_client = MockClient('#main{}', PROFILE_XML)
+    handler.request_time = lambda: 0.5
+    for (name, value) in attributes.items():
+        setattr(handler, name, value)
+    return handler
+
+
+@pytest.mark.asyncio
+async def test_render_handler_profile():
+    handler = profile_handler(profile_token='secret')
+    handler.request.headers['x-render-profile'] = 'secret'
+    await handler.post()
+
+    profile = json.loads(handler.was_written())
+    assert handler.response_headers['Content-Type'] == 'application/json'
+    assert handler.response_headers['Cache-Control'] == 'no-store'
+    assert 'ETag' not in handler.response_headers
+    assert {'style_fetch', 'map_load', 'features', 'render',
+            'encode'} <= set(profile['stages'])
+    assert profile['counts'][:2] == [1, 1]
+    assert 'render_png' in profile['profile']
+
+    for (token, header) in (('guess', 'secret'), (None, 'secret'),
+                            ('secret', 'sécret'), ('sécret', 'secret')):
+        handler = profile_handler(profile_token=token or '')
+        handler.request.headers['x-render-profile'] = header
+        await handler.post()
+        assert handler.response_headers['Content-Type'] == 'image/png'
+        assert 'ETag' in handler.response_headers
+
+
+@pytest.mark.asyncio
+async def test_render_handler_captures_slow_requests(tmpdir):
+    from carto_renderer import profiling
+
+    spool = profiling.Spool(str(tmpdir), 1 << 20)
+    handler = profile_handler(spool=spool, slow_ms=1000)
+    await handler.post()
+    handler.on_finish()
+    await asyncio.sleep(0.05)
+    assert not spool.captures()
+
+    handler = profile_handler(spool=spool, slow_ms=100)
+    await handler.post()
+    handler.on_finish()
+    for _ in range(100):
+        if spool.captures():
+            break
+        await asyncio.sleep(0.01)
+
+    [path] = spool.captures()
+    capture = profiling.load(path)
+    assert capture[b'elapsed'] == 0.5
+    assert b'render' in capture[b'stats']
+    (png, _, _) = profiling.replay(capture)
+    assert png == handler.written[0]
+
+@pytest.mark.asyncio
+async def test_render_handler_etag():
+    css = '#main{marker-line-color:#00C;marker-width:1}'
+    body = {b'zoom': 14, b'style': css, b'tile': {}, b'overscan': 0}
+    client = MockClient(css, '<Map />')
+
+    handler = RenderStrHandler()
+    handler.body = body
+    handler.http_client = client
+    await handler.post()
+    etag = handler.response_headers['ETag']
+    assert handler.status_code is None
+
+    handler = RenderStrHandler()
+    handler.body = dict(body)
+    handler.body[b'zoom'] = 15
+    handler.http_client = client
+    await handler.post()
+    assert handler.response_headers['ETag'] != etag
+
+    for header in [etag, 'W/' + etag, '"other", ' + etag, '*']:
+        handler = RenderStrHandler()
+        handler.body = body
+        handler.http_client = client
+        handler.request.headers['if-none-match'] = header
+        await handler.post()
+        assert handler.status_code == 304
+        assert handler.finished
+        assert handler.written == []
+
+    assert client.fetches == 2
+
+
+@pytest.mark.asyncio
+async def test_render_handler_formats():
+    css = '#main{marker-line-color:#00C;marker-width:1}'
+    body = {b'zoom': 14, b'style': css, b'tile': {}, b'overscan': 0}
+    client = MockClient(css, '<Map />')
+    cases = [({}, {}, 'image/png', b'\x89PNG'),
+             ({b'format': b'png8'}, {}, 'image/png', b'\x89PNG'),
+             ({b'format': b'jpeg'}, {}, 'image/jpeg', b'\xff\xd8'),
+             ({}, {'accept': 'image/jpeg'}, 'image/jpeg', b'\xff\xd8'),
+             ({}, {'accept': 'image/jpeg;q=0.5, image/png'}, 'image/png',
+              b'\x89PNG'),
+             ({}, {'accept': 'text/html, */*;q=0.1'}, 'image/png', b'\x89PNG'),
+             ({b'format': b'webp'}, {'accept': 'image/png'}, 'image/webp',
+              b'RIFF')]
+
+    etags = set()
+    for (extra, headers, content_type, magic) in cases:
+        handler = RenderStrHandler()
+        handler.body = dict(body)
+        handler.body.update(extra)
+        handler.http_client = client
+        handler.request.headers.update(headers)
+        await handler.post()
+        assert handler.response_headers['Content-Type'] == content_type
+        assert handler.written[0].startswith(magic)
+        etags.add(handler.response_headers['ETag'])
+
+    assert len(etags) == 4
+
+
+@pytest.mark.asyncio
+async def test_render_handler_bad_format():
+    handler = RenderStrHandler()
+    handler.body = {b'zoom': 14, b'style': '', b'tile': {}, b'overscan': 0,
+                    b'format': b'gif'}
+    with raises(errors.BadRequest) as bad:
+        await handler.post()
+    assert 'format' in bad.value.message
+
+
+def test_make_formats():
+    formats = service.make_formats(png8_colors=16, png_compression=9,
+                                   png_strategy='rle', jpeg_quality=50)
+    assert formats['png'] == ('image/png', 'png:z=9:s=rle')
+    assert formats['png8'] == ('image/png', 'png8:c=16:z=9:s=rle')
+    assert formats['jpeg'] == ('image/jpeg', 'jpeg50')
+    assert service.make_formats()['png'] == ('image/png', 'png')
+
+    for kwargs in [{'png8_colors': 1}, {'png_compression': 10},
+                   {'png_strategy': 'best'}, {'webp_quality': 101}]:
+        with raises(ValueError):
+            service.make_formats(**kwargs)
+
+
+def test_render_png_png8_is_smaller():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main">
+        <Rule><PolygonSymbolizer fill="#0000cc" /></Rule>
+      </Style>
+    </Map>
+    """
+    tile = {"main": to_wkb("POLYGON((10 10,200 30,120 240,10 10))")}
+
+    full = service.render_png(tile, 1, xml, 0, 'png32')
+    paletted = service.render_png(tile, 1, xml, 0, 'png8:c=4')
+    assert len(paletted) < len(full)
+
+
+@pytest.mark.asyncio
+async def test_render_handler_shares_renders():
+    css = '#main{marker-line-color:#00C;marker-width:1}'
+    body = {b'zoom': 14, b'style': css, b'tile': {}, b'overscan': 0}
+    client = MockClient(css, '<Map />')
+    cache = LRUCache(None, max_weight=1 << 20, weigher=service.tile_weight)
+
+    handlers = [RenderStrHandler() for _ in range(3)]
+    for handler in handlers:
+        handler.body = body
+        handler.http_client = client
+        handler.tile_cache = cache
+
+    await asyncio.gather(*[handler.post() for handler in handlers])
+
+    assert client.fetches == 1
+    assert cache.stats()['coalesced'] == 2
+    assert len({handler.was_written() for handler in handlers}) == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_render_handler():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main"><Rule><MarkersSymbolizer /></Rule></Style>
+    </Map>
+    """
+    css = '#main{marker-width:1}'
+    client = MockClient(css, xml)
+    tiles = [{b'tile': {'main': to_wkb('POINT({} 50)'.format(x))},
+              b'zoom': 14, b'overscan': 0, b'x': x, b'y': 7}
+             for x in range(3)]
+
+    handler = BatchRenderStrHandler()
+    handler.body = {b'style': css, b'tiles': tiles}
+    handler.http_client = client
+    await handler.post()
+
+    assert handler.finished
+    assert handler.flushes == 3
+    assert client.fetches == 1
+    frames = list(msgpack.Unpacker(BytesIO(b''.join(handler.written)),
+                                   raw=False))
+    assert sorted(frame['x'] for frame in frames) == [0, 1, 2]
+    for frame in frames:
+        assert frame['y'] == 7
+        expected = service.render_png(tiles[frame['x']][b'tile'], 14, xml, 0)
+        assert frame['png'] == expected
+
+
+@pytest.mark.asyncio
+async def test_batch_render_handler_fails_mid_stream():
+    # pylint: disable=protected-access
+    entry = {b'tile': {}, b'zoom': 14, b'overscan': 0, b'y': 0}
+    renders = []
+
+    async def render_xml(*_):
+        renders.append(len(renders))
+        if len(renders) > 1:
+            await asyncio.sleep(0.01)
+            raise errors.RequestCancelled('deadline')
+        return (b'png', None)
+
+    handler = BatchRenderStrHandler()
+    handler.body = {b'style': '#main{}',
+                    b'tiles': [{b'x': x, **entry} for x in range(3)]}
+    handler.http_client = MockClient('#main{}', '<Map />')
+    handler.render_xml = render_xml
+    with raises(errors.RequestCancelled) as cancelled:
+        await handler.post()
+    handler._handle_request_exception(cancelled.value)
+
+    assert handler.status_code is None
+    assert handler.finished
+    frames = list(msgpack.Unpacker(BytesIO(b''.join(handler.written)),
+                                   raw=False))
+    assert frames == [{'x': 0, 'y': 0, 'zoom': 14, 'png': b'png'},
+                      {'error': 'Request cancelled: deadline',
+                       'resultCode': 504}]
+
+
+@pytest.mark.asyncio
+async def test_batch_render_handler_bad_req():
+    css = '#main{marker-width:1}'
+    entry = {b'tile': {}, b'zoom': 14, b'overscan': 0, b'x': 0, b'y': 0}
+
+    with raises(errors.PayloadKeyError):
+        handler = BatchRenderStrHandler()
+        handler.body = {b'style': css}
+        await handler.post()
+
+    with raises(errors.BadRequest) as too_many:
+        handler = BatchRenderStrHandler()
+        handler.body = {b'style': css, b'tiles': [entry] * 5}
+        await handler.post()
+    assert "at most 4" in too_many.value.message
+
+    with raises(errors.BadRequest) as bad_x:
+        handler = BatchRenderStrHandler()
+        bad_entry = dict(entry)
+        bad_entry[b'x'] = 'a'
+        handler.body = {b'style': css, b'tiles': [bad_entry]}
+        await handler.post()
+    assert '"x"' in bad_x.value.message
+
+    with raises(errors.PayloadKeyError):
+        handler = BatchRenderStrHandler()
+        handler.body = {b'style': css, b'tiles': [{b'tile': {}}]}
+        await handler.post()
+
+
+def test_render_metatile():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main"><Rule><MarkersSymbolizer /></Rule></Style>
+    </Map>
+    """
+    # Only the top-left tile of the block has a feature.
+    block = {"main": to_wkb("POINT(50 306)")}
+    blank = service.render_png({"main": []}, 1, xml, 0)
+
+    tiles = {(dx, dy): png
+             for (dx, dy, png) in service.render_metatile(block, 1, xml, 0, 2)}
+
+    assert sorted(tiles) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert tiles[(0, 0)] != blank
+    assert tiles[(0, 1)] == blank
+    assert tiles[(1, 0)] == blank
+    assert tiles[(1, 1)] == blank
+
+
+@pytest.mark.asyncio
+async def test_metatile_handler():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main"><Rule><MarkersSymbolizer /></Rule></Style>
+    </Map>
+    """
+    css = '#main{marker-width:1}'
+    body = {b'style': css, b'tile': {"main": to_wkb("POINT(50 50)")},
+            b'zoom': 14, b'overscan': 8, b'size': 2, b'x': 10, b'y': 20}
+
+    handler = MetatileStrHandler()
+    handler.body = body
+    handler.http_client = MockClient(css, xml)
+    await handler.post()
+
+    frames = list(msgpack.Unpacker(BytesIO(b''.join(handler.written)),
+                                   raw=False))
+    assert sorted((f['x'], f['y']) for f in frames) == \
+        [(10, 20), (10, 21), (11, 20), (11, 21)]
+    assert 'ETag' in handler.response_headers
+
+    with raises(errors.BadRequest) as too_big:
+        handler = MetatileStrHandler()
+        handler.body = dict(body)
+        handler.body[b'size'] = 5
+        await handler.post()
+    assert "size" in too_big.value.message
+
+
+def test_map_pool_reuses_templates():
+    # pylint: disable=no-member
+    import mapnik
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main"><Rule><MarkersSymbolizer /></Rule></Style>
+    </Map>
+    """
+    pool = service.MapPool(1, 1)
+
+    with pool.borrow(xml, 256) as first:
+        first.layers.append(mapnik.Layer('main'))
+    with pool.borrow(xml, 256) as second:
+        assert second is first
+        assert len(second.layers) == 0
+        with pool.borrow(xml, 256) as third:
+            assert third is not second
+
+    assert pool.parsed == 2
+
+    with pool.borrow(xml, 320):
+        pass
+    assert pool.parsed == 3
+    assert pool.stats()['evictions'] == 1
+
+
+def test_make_executor():
+    with raises(ValueError) as bad_mode:
+        service.make_executor('fiber', 1)
+    assert 'render_mode' in str(bad_mode.value)
+
+    with raises(ValueError) as no_workers:
+        service.make_executor('thread', 0)
+    assert 'render_workers' in str(no_workers.value)
+
+    with raises(ValueError):
+        service.make_executor('process', service.MAX_RENDER_WORKERS + 1)
+
+    executor = service.make_executor('thread', 2)
+    try:
+        assert executor.submit(sum, [1, 2]).result() == 3
+    finally:
+        executor.shutdown()
+
+
 @given(text(alphabet=string.printable),
        text(alphabet=string.printable))
 @pytest.mark.asyncio
@@ -302,3 +1114,257 @@ def test_render_png_ignores_bad_wkb():
     actual = service.render_png(tile, 1, xml, 0)
 
     assert b64encode(actual) == expected
+
+
+def test_render_png_clipping_is_invisible():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main">
+        <Rule>
+          <PolygonSymbolizer fill="#0000cc" />
+          <LineSymbolizer stroke="#cc0000" stroke-width="3" />
+        </Rule>
+      </Style>
+    </Map>
+    """
+    tile = {"main": to_wkb("POLYGON((-5000 100,5000 100,5000 5000,-5000 100))",
+                           "LINESTRING(10 10,2000 3000)",
+                           "POINT(9000 9000)")}
+
+    # pylint: disable=protected-access
+    unclipped = service._render_image(tile, 1, xml, service.TILE_SIZE, 16)
+    service.configure_renderer(64, 4, clip_features=True)
+    try:
+        clipped = service._render_image(tile, 1, xml, service.TILE_SIZE, 16)
+    finally:
+        service.configure_renderer(64, 4)
+
+    # Allow for anti-aliasing rounding along the clipped line.
+    for x in range(service.TILE_SIZE):
+        for y in range(service.TILE_SIZE):
+            pixels = (clipped.get_pixel(x, y), unclipped.get_pixel(x, y))
+            channels = [[(pixel >> shift) & 0xff for shift in (0, 8, 16, 24)]
+                        for pixel in pixels]
+            assert max(abs(a - b) for (a, b) in zip(*channels)) <= 2
+
+
+def test_render_png_feature_properties():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main">
+        <Rule>
+          <Filter>[size] = 2</Filter>
+          <MarkersSymbolizer fill="#0000cc" width="10" />
+        </Rule>
+      </Style>
+    </Map>
+    """
+    [wkb] = to_wkb("POINT(50 50)")
+
+    plain = service.render_png({"main": [wkb]}, 1, xml, 0)
+    matching = service.render_png({"main": [(wkb, {'size': 2})]}, 1, xml, 0)
+    other = service.render_png({"main": [(wkb, {'size': 3})]}, 1, xml, 0)
+
+    assert matching != plain
+    assert other == plain
+
+
+def test_render_png_columnar_layers():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main">
+        <Rule>
+          <Filter>[size] = 2</Filter>
+          <MarkersSymbolizer fill="#0000cc" width="10" />
+        </Rule>
+        <Rule>
+          <LineSymbolizer stroke="#cc0000" stroke-width="2" />
+        </Rule>
+      </Style>
+    </Map>
+    """
+    wkbs = to_wkb('POINT(50 50)', 'LINESTRING(0 0,200 120)')
+    offsets = [0, len(wkbs[0]), len(wkbs[0]) + len(wkbs[1])]
+    layer = {b'geometries': b''.join(wkbs),
+             b'offsets': b''.join(struct.pack('<I', o) for o in offsets),
+             b'properties': [{b'size': 2}, None]}
+
+    expected = service.render_png(
+        {'main': [(wkbs[0], {'size': 2}), wkbs[1]]}, 1, xml, 0)
+    assert service.render_png({b'main': layer}, 1, xml, 0) == expected
+    assert service.count_features({b'tile': {b'main': layer}}) == 2
+
+    del layer[b'properties']
+    decoder = service.BodyDecoder()
+    decoder.feed(msgpack.packb({b'tile': {b'main': layer},
+                                b'zoom': 1, b'style': b''}))
+    assert decoder.payload()[b'tile'][b'main'] == layer
+
+    for bad in ({b'geometries': b'', b'offsets': b'\x00' * 4,
+                 b'properties': 5},
+                {**layer, b'offsets': layer[b'offsets'][:-4]}):
+        decoder = service.BodyDecoder()
+        decoder.feed(msgpack.packb({b'tile': {b'main': bad}}))
+        with raises(errors.BadRequest):
+            decoder.payload()
+
+
+def test_render_png_honours_zoom():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main">
+        <Rule>
+          <MaxScaleDenominator>100000</MaxScaleDenominator>
+          <MarkersSymbolizer fill="#0000cc" width="10" />
+        </Rule>
+      </Style>
+      <Style name="hidden">
+        <Rule>
+          <MinScaleDenominator>100000000</MinScaleDenominator>
+          <MarkersSymbolizer fill="#cc0000" width="10" />
+        </Rule>
+      </Style>
+    </Map>
+    """
+    [wkb] = to_wkb("POINT(50 50)")
+    blank = service.render_png({"main": []}, 1, xml, 0)
+
+    assert service.render_png({"main": [wkb]}, 1, xml, 0) == blank
+    assert service.render_png({"main": [wkb]}, 14, xml, 0) != blank
+    assert service.render_png({"hidden": [wkb]}, 1, xml, 0) != blank
+    assert service.render_png({"hidden": [wkb]}, 14, xml, 0) == blank
+
+
+def test_render_png_skips_undrawn_layers():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Style name="main"><Rule><MarkersSymbolizer /></Rule></Style>
+    </Map>
+    """
+    service.render_png({"main": []}, 14, xml, 0)
+
+    with mock.patch.object(service, 'prepare_wkb') as prepare:
+        service.render_png({"unstyled": to_wkb("POINT(50 50)")}, 14, xml, 0)
+    assert not prepare.called
+
+
+@given(integers(min_value=-5, max_value=40))
+def test_scale_denominator(zoom):
+    scale = service.scale_denominator(zoom)
+    assert scale == 2 ** (service.BASE_ZOOM - min(max(zoom, 0),
+                                                  service.BASE_ZOOM))
+    assert service.scale_denominator(zoom + 1) <= scale
+
+
+@pytest.mark.parametrize('background', ['', ' background-color="#336699"',
+                                        ' background-color="rgba(0,0,0,0.5)"'])
+def test_render_blank(background):
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map{}>
+      <Style name="main">
+        <Rule>
+          <MaxScaleDenominator>100000</MaxScaleDenominator>
+          <MarkersSymbolizer fill="#0000cc" width="10" />
+        </Rule>
+      </Style>
+    </Map>
+    """.format(background)
+    [wkb] = to_wkb("POINT(50 50)")
+
+    for (tile, zoom) in [({}, 14), ({"main": []}, 14), ({"other": [wkb]}, 14),
+                         ({"main": [wkb]}, 1)]:
+        blank = service.render_blank(tile, zoom, xml, 'png')
+        assert blank == service.render_png(tile, zoom, xml, 0)
+        assert blank is service.render_blank(tile, zoom, xml, 'png')
+
+    assert service.render_blank({"main": [wkb]}, 14, xml) is None
+
+
+def test_render_blank_fixed_content():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map>
+      <Layer name="static">
+        <Datasource><Parameter name="type">shape</Parameter></Datasource>
+      </Layer>
+    </Map>
+    """
+    assert service.render_blank({}, 14, xml) is None
+
+
+@pytest.mark.asyncio
+async def test_render_handler_blank_fast_path():
+    css = '#main{marker-line-color:#00C;marker-width:1}'
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map><Style name="main"><Rule><MarkersSymbolizer /></Rule></Style></Map>
+    """
+    client = MockClient(css, xml)
+
+    handler = RenderStrHandler()
+    handler.body = {b'zoom': 14, b'style': css, b'tile': {b'main': []},
+                    b'overscan': 0, b'format': b'png8'}
+    handler.http_client = client
+    handler.executor = mock.MagicMock()
+    await handler.post()
+
+    assert handler.response_headers['X-Render-Fast-Path'] == 'blank'
+    assert handler.written == [service.blank_tile(handler.formats['png8'][1])]
+    assert not handler.executor.submit.called
+
+    handler = RenderStrHandler()
+    handler.body = {b'zoom': 14, b'style': css,
+                    b'tile': {b'main': to_wkb("POINT(50 50)")},
+                    b'overscan': 0}
+    handler.http_client = client
+    await handler.post()
+    assert 'X-Render-Fast-Path' not in handler.response_headers
+
+
+@pytest.mark.asyncio
+async def test_render_handler_caches_fast_path():
+    css = '#main{marker-width:2}'
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map><Style name="main"><Rule><MarkersSymbolizer /></Rule></Style></Map>
+    """
+    client = MockClient(css, xml)
+    cache = LRUCache(None, max_weight=1 << 20, weigher=service.tile_weight)
+
+    def handler():
+        render = RenderStrHandler()
+        render.body = {b'zoom': 14, b'style': css, b'tile': {b'main': []},
+                       b'overscan': 0}
+        render.http_client = client
+        render.tile_cache = cache
+        return render
+
+    # The first renders, the others wait on it; then a cache hit.
+    coalesced = [handler() for _ in range(3)]
+    await asyncio.gather(*[render.post() for render in coalesced])
+    hit = handler()
+    await hit.post()
+
+    assert cache.stats()['coalesced'] == 2
+    assert cache.stats()['hits'] == 1
+    for render in coalesced + [hit]:
+        assert render.response_headers['X-Render-Fast-Path'] == 'blank'
+
+
+@pytest.mark.asyncio
+async def test_render_handler_analyses_rules_off_the_loop():
+    xml = """<?xml version="1.0" encoding="utf-8"?>
+    <Map><Style name="fresh"><Rule><MarkersSymbolizer /></Rule></Style></Map>
+    """
+    threads = []
+
+    def style_rules(xml):
+        threads.append(threading.current_thread())
+        return rules(xml)
+
+    rules = service.StyleRules
+    with mock.patch.object(service, 'StyleRules', style_rules):
+        handler = RenderStrHandler()
+        blank = await handler.render_blank({}, 14, xml)
+        assert blank == service.blank_tile()
+        assert await handler.render_blank({}, 14, xml) == blank
+
+    assert len(threads) == 1
+    assert threads[0] is not threading.current_thread()
@@ -0,0 +1,54 @@
+# pylint: disable=missing-docstring
+import xml.etree.ElementTree as ET
+
+from carto_renderer.style import StyleRules
+
+XML = """<?xml version="1.0" encoding="utf-8"?>
+<Map>
+  <Style name="roads">
+    <Rule>
+      <MaxScaleDenominator>50000</MaxScaleDenominator>
+      <LineSymbolizer stroke="#000" />
+    </Rule>
+    <Rule>
+      <MinScaleDenominator>50000</MinScaleDenominator>
+      <MaxScaleDenominator>1000000</MaxScaleDenominator>
+      <LineSymbolizer stroke="#333" />
+    </Rule>
+  </Style>
+  <Style name="empty" />
+  <Style name="always"><Rule><MarkersSymbolizer /></Rule></Style>
+</Map>
+"""
+
+
+def test_visible():
+    rules = StyleRules(XML)
+
+    assert rules.visible('roads', 1000)
+    assert rules.visible('roads', 50000)
+    assert rules.visible('roads', 999999)
+    assert not rules.visible('roads', 1000001)
+    assert not rules.visible('empty', 1000)
+    assert not rules.visible('missing', 1000)
+    assert rules.visible('always', 1e12)
+
+
+def test_at_scale():
+    rules = StyleRules(XML)
+
+    near = ET.fromstring(rules.at_scale(1000))
+    far = ET.fromstring(rules.at_scale(1e9))
+
+    [roads] = [s for s in near.findall('Style') if s.get('name') == 'roads']
+    [rule] = roads.findall('Rule')
+    assert rule.find('LineSymbolizer').get('stroke') == '#000'
+    assert rule.find('MaxScaleDenominator') is None
+    assert not [s for s in far.findall('Style')
+                if s.get('name') == 'roads'][0].findall('Rule')
+    assert rules.at_scale(1000) is rules.at_scale(1000)
+
+
+def test_at_scale_unscaled():
+    xml = '<Map><Style name="a"><Rule><MarkersSymbolizer /></Rule></Style></Map>'
+    assert StyleRules(xml).at_scale(1000) is xml
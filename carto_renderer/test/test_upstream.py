@@ -0,0 +1,155 @@
+# pylint: disable=missing-docstring
+import asyncio
+
+import pytest
+from pytest import raises
+from tornado.curl_httpclient import CurlAsyncHTTPClient
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+from carto_renderer.errors import ServiceError
+from carto_renderer.upstream import StyleClient, make_http_client
+
+
+class FakeClock(object):
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class ScriptedClient(object):
+    """
+    Answers fetches from a list of results; exceptions are raised.
+    """
+    def __init__(self, results, delay=0):
+        self.results = list(results)
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.peak = 0
+
+    async def fetch(self, request):
+        self.requests.append(request)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            result = self.results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        finally:
+            self.active -= 1
+
+
+def request():
+    return HTTPRequest('http://style/style?style=x')
+
+
+@pytest.mark.asyncio
+async def test_retries_then_succeeds():
+    client = ScriptedClient([HTTPClientError(599), HTTPClientError(503),
+                             'ok'])
+    style = StyleClient(client, retries=2, backoff=0)
+
+    assert await style.fetch(request()) == 'ok'
+    assert len(client.requests) == 3
+    assert client.requests[0].request_timeout == 5.0
+    assert client.requests[0].connect_timeout == 1.0
+
+
+@pytest.mark.asyncio
+async def test_gives_up_with_503():
+    client = ScriptedClient([ConnectionRefusedError()] * 3)
+    style = StyleClient(client, retries=2, backoff=0)
+
+    with raises(ServiceError) as err:
+        await style.fetch(request())
+    assert err.value.status_code == 503
+    assert len(client.requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_client_errors_are_not_retried():
+    client = ScriptedClient([HTTPClientError(400)])
+    style = StyleClient(client, backoff=0, failure_threshold=1)
+
+    with raises(HTTPClientError):
+        await style.fetch(request())
+    assert len(client.requests) == 1
+    assert style.opened_at is None
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    clock = FakeClock()
+    client = ScriptedClient([HTTPClientError(599)] * 3 + ['ok'])
+    style = StyleClient(client, retries=0, backoff=0, failure_threshold=2,
+                        reset_timeout=10, clock=clock)
+
+    for _ in range(2):
+        with raises(ServiceError):
+            await style.fetch(request())
+
+    # Open: fail fast without touching the upstream.
+    with raises(ServiceError) as err:
+        await style.fetch(request())
+    assert 'failing fast' in err.value.message
+    assert len(client.requests) == 2
+
+    # A failed trial re-opens it.
+    clock.now = 10
+    with raises(ServiceError):
+        await style.fetch(request())
+    assert len(client.requests) == 3
+    with raises(ServiceError):
+        await style.fetch(request())
+
+    # A successful trial closes it.
+    clock.now = 20
+    assert await style.fetch(request()) == 'ok'
+    assert style.opened_at is None
+    assert style.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial():
+    clock = FakeClock()
+    client = ScriptedClient([HTTPClientError(599), 'ok', 'ok'], delay=0.01)
+    style = StyleClient(client, retries=0, backoff=0, failure_threshold=1,
+                        reset_timeout=10, clock=clock)
+    with raises(ServiceError):
+        await style.fetch(request())
+
+    clock.now = 10
+    trial = asyncio.ensure_future(style.fetch(request()))
+    await asyncio.sleep(0)
+    trial.cancel()
+    with raises(asyncio.CancelledError):
+        await trial
+
+    # Another fetch gets to be the trial, and closes the circuit.
+    assert not style.trial
+    assert await style.fetch(request()) == 'ok'
+    assert style.opened_at is None
+
+
+@pytest.mark.asyncio
+async def test_bounds_concurrency():
+    client = ScriptedClient(['ok'] * 10, delay=0.01)
+    style = StyleClient(client, max_concurrent=3)
+
+    await asyncio.gather(*[style.fetch(request()) for _ in range(10)])
+    assert client.peak == 3
+
+
+@pytest.mark.asyncio
+async def test_make_http_client_pools_connections():
+    client = make_http_client(4)
+    try:
+        assert isinstance(client, CurlAsyncHTTPClient)
+    finally:
+        client.close()
+        AsyncHTTPClient.configure(None)
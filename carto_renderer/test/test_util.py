@@ -0,0 +1,78 @@
+# pylint: disable=missing-docstring
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from carto_renderer import util
+
+
+class Capture(logging.Handler):
+    def __init__(self, gate=None):
+        super(Capture, self).__init__()
+        self.records = []
+        self.gate = gate
+
+    def emit(self, record):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.records.append((record.getMessage(),
+                             getattr(record, 'X-Socrata-RequestId')))
+
+
+def capturing_logger(handler):
+    logger = logging.getLogger('carto_renderer.test_util')
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return util.LogWrapper(logger)
+
+
+@pytest.mark.asyncio
+async def test_request_ids_stay_with_their_requests():
+    capture = Capture()
+    logger = capturing_logger(capture)
+
+    async def handle(request_id, delay):
+        util.REQUEST_ID.set(request_id)
+        await asyncio.sleep(delay)
+        logger.info(request_id)
+
+    await asyncio.gather(handle('first', 0.02), handle('second', 0.01))
+    assert sorted(capture.records) == [('first', 'first'),
+                                       ('second', 'second')]
+
+    with ThreadPoolExecutor(1) as executor:
+        await asyncio.get_event_loop().run_in_executor(
+            executor, util.call_with_request_id, 'third', logger.info, 'x')
+    assert capture.records[-1] == ('x', 'third')
+    assert util.REQUEST_ID.get() not in ('first', 'second', 'third')
+
+
+def test_lazy_fields_only_when_enabled():
+    calls = []
+    logger = capturing_logger(Capture())
+
+    logger.debug('%s', util.LogWrapper.Lazy(lambda: calls.append('debug')))
+    logger.info('%s', util.LogWrapper.Lazy(lambda: calls.append('info')))
+    assert calls == ['info']
+
+
+def test_background_handler_does_not_block():
+    gate = threading.Event()
+    capture = Capture(gate)
+    background = util.BackgroundHandler(capture, max_queue=2)
+    logger = capturing_logger(background)
+    dropped = util.LOG_DROPPED.labels().value
+
+    for index in range(10):
+        logger.info('record %d', index)
+    assert util.LOG_DROPPED.labels().value - dropped >= 7
+
+    gate.set()
+    background.close()
+    messages = [message for (message, _) in capture.records]
+    assert messages[0] == 'record 0'
+    assert len(messages) == 10 - (util.LOG_DROPPED.labels().value - dropped)
@@ -0,0 +1,125 @@
+# pylint: disable=missing-docstring
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import msgpack
+import pytest
+
+from carto_renderer import service, warmup
+from carto_renderer.admission import AdmissionControl
+from carto_renderer.cache import LRUCache
+from carto_renderer.test.test_service import MockClient, to_wkb
+
+XML = """<?xml version="1.0" encoding="utf-8"?>
+<Map>
+  <Style name="main">
+    <Rule>
+      <MarkersSymbolizer fill="#0000cc" width="10" />
+    </Rule>
+  </Style>
+</Map>
+"""
+
+
+def test_sample_draws_everything():
+    stats = {}
+    image = service.render_png(warmup.sample_tile(), warmup.SAMPLE_ZOOM,
+                               warmup.sample_xml(), 0, stats=stats)
+    assert stats['counts'][:2] == [3, 3]
+    assert image != service.blank_tile()
+
+    service.preload(service.make_formats())
+
+
+def parsed_maps():
+    return (os.getpid(), service.MAP_POOL.parsed)
+
+
+def test_init_render_process_preloads():
+    formats = service.make_formats()
+    service.init_render_process((8, 1), formats)
+    try:
+        assert service.MAP_POOL.parsed == 1
+        service.preload(formats)
+        assert service.MAP_POOL.parsed == 1
+    finally:
+        service.configure_renderer(64, 4)
+
+    with ProcessPoolExecutor(2, initializer=service.init_render_process,
+                             initargs=((8, 1), formats)) as pool:
+        futures = [pool.submit(parsed_maps) for _ in range(8)]
+        results = dict(future.result() for future in futures)
+    # Whichever process took the work, it was warm before it did.
+    assert set(results.values()) == {1}
+
+
+def test_read_payloads(tmpdir):
+    path = str(tmpdir.join('payloads.msgpack'))
+    with open(path, 'wb') as payloads:
+        payloads.write(msgpack.packb({'style': '#a{}'}))
+        payloads.write(msgpack.packb({'style': '#b{}', 'zoom': 3}))
+
+    assert warmup.read_payloads(path) == [{b'style': b'#a{}'},
+                                          {b'style': b'#b{}', b'zoom': 3}]
+
+
+@pytest.mark.asyncio
+async def test_readiness():
+    admission = AdmissionControl(1, 4)
+    readiness = warmup.Readiness(admission, max_queued=1)
+    assert readiness.reasons() == ['warming up']
+
+    readiness.warmed()
+    assert readiness.reasons() == []
+    assert readiness.warm_seconds >= 0
+
+    await admission.acquire()
+    queued = [asyncio.ensure_future(admission.acquire()) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert readiness.reasons() == ['2 requests queued']
+
+    for _ in queued:
+        admission.release()
+    await asyncio.gather(*queued)
+    assert readiness.reasons() == []
+
+
+def render_args(client):
+    return {'executor': ThreadPoolExecutor(2),
+            'formats': service.make_formats(),
+            'default_format': 'png',
+            'http_client': client,
+            'style_host': 'localhost',
+            'style_port': 4097,
+            'style_cache': LRUCache(4)}
+
+
+@pytest.mark.asyncio
+async def test_warm_up_prefetches_and_renders():
+    client = MockClient('#main{}', XML)
+    args = render_args(client)
+    readiness = warmup.Readiness()
+    payloads = [{b'style': b'#main{}'},
+                {b'style': b'#main{}', b'zoom': 14, b'format': b'jpeg',
+                 b'tile': {b'main': to_wkb('POINT(50 50)')}},
+                {b'style': b'#other{}'}]
+
+    await service.warm_up(readiness, args, workers=2, payloads=payloads)
+    assert readiness.warm
+    assert client.fetches == 1
+    assert args['style_cache'].get(b'#main{}') == XML
+
+
+@pytest.mark.asyncio
+async def test_warm_up_gives_up_after_timeout():
+    class StuckClient(object):
+        # pylint: disable=too-few-public-methods
+        async def fetch(self, _):
+            await asyncio.sleep(10)
+
+    readiness = warmup.Readiness()
+    await service.warm_up(readiness, render_args(StuckClient()),
+                          payloads=[{b'style': b'#main{}'}], timeout=0.1)
+    assert readiness.warm
+    assert readiness.warm_seconds < 5
@@ -0,0 +1,179 @@
+"""
+Client for the style renderer: bounded, retrying and circuit-breaking.
+"""
+
+import random
+import time
+
+from tornado import gen, locks
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+from carto_renderer import metrics
+from carto_renderer.errors import ServiceError
+from carto_renderer.util import get_logger
+
+RETRIES = metrics.Counter(
+    'carto_renderer_upstream_retries_total',
+    'Style renderer requests retried.')
+REJECTED = metrics.Counter(
+    'carto_renderer_upstream_rejected_total',
+    'Style renderer requests refused while the circuit was open.')
+CIRCUIT_OPEN = metrics.Gauge(
+    'carto_renderer_upstream_circuit_open',
+    'Whether calls to the style renderer are failing fast (0 or 1).')
+
+
+def make_http_client(max_clients):
+    """
+    Return an AsyncHTTPClient that keeps connections to upstreams alive.
+
+    That needs the curl client, so pycurl is a requirement; without it
+    (e.g. in a bare development environment) the simple client is used,
+    which opens a connection per request.
+    """
+    try:
+        import pycurl  # pylint: disable=import-error,unused-import
+        AsyncHTTPClient.configure(
+            'tornado.curl_httpclient.CurlAsyncHTTPClient')
+    except ImportError:
+        get_logger().warn('pycurl is not installed; style renderer '
+                          'connections will not be kept alive')
+    return AsyncHTTPClient(max_clients=max_clients)
+
+
+class StyleClient(object):
+    """
+    Wrap an HTTP client's fetch with the protections the style renderer
+    needs when it slows down or fails.
+
+    - At most max_concurrent requests are outstanding at once; the rest
+      wait their turn.
+    - Each attempt gets connect_timeout and request_timeout seconds.
+    - Timeouts, connection failures and 5xx responses are retried up to
+      retries times, after backoff * 2 ** attempt seconds with jitter.
+    - After failure_threshold failed fetches in a row the circuit opens:
+      fetches fail at once with a 503 for reset_timeout seconds, then a
+      single trial fetch decides whether it closes again.
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, http_client, max_concurrent=32, connect_timeout=1.0,
+                 request_timeout=5.0, retries=2, backoff=0.05,
+                 failure_threshold=5, reset_timeout=10.0,
+                 clock=time.monotonic):
+        self.http_client = http_client
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._slots = locks.Semaphore(max_concurrent)
+
+    @staticmethod
+    def retryable(err):
+        """
+        Whether a failed attempt is worth repeating.
+        """
+        if isinstance(err, HTTPClientError):
+            # 599 is Tornado's code for timeouts and connection errors.
+            return err.code >= 500
+        return isinstance(err, (IOError, OSError))
+
+    def _admit(self):
+        """
+        Raise a 503 if the circuit is open; let one trial through after
+        the reset timeout. Returns whether this fetch is the trial.
+        """
+        if self.opened_at is None:
+            return False
+        if not self.trial and \
+           self.clock() - self.opened_at >= self.reset_timeout:
+            self.trial = True
+            return True
+
+        REJECTED.inc()
+        raise ServiceError('Style renderer unavailable; failing fast', 503)
+
+    def _succeeded(self):
+        """
+        Close the circuit.
+        """
+        if self.opened_at is not None:
+            get_logger(self).info('Style renderer recovered; closing circuit')
+            CIRCUIT_OPEN.set(0)
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def _failed(self):
+        """
+        Count a failure, opening the circuit at the threshold.
+        """
+        self.failures += 1
+        if self.trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                get_logger(self).error(
+                    'Style renderer failed %d times; opening circuit',
+                    self.failures)
+                CIRCUIT_OPEN.set(1)
+            self.opened_at = self.clock()
+            self.trial = False
+
+    async def fetch(self, request):
+        """
+        Fetch request (an HTTPRequest), as AsyncHTTPClient.fetch does.
+
+        Raises ServiceError (503) if the style renderer stays unreachable.
+        """
+        trial = self._admit()
+        if request.connect_timeout is None:
+            request.connect_timeout = self.connect_timeout
+        if request.request_timeout is None:
+            request.request_timeout = self.request_timeout
+
+        try:
+            return await self._attempt(request)
+        finally:
+            if trial and self.trial:
+                # The trial ended undecided, e.g. cancelled; let the next
+                # fetch try instead.
+                self.trial = False
+
+    async def _attempt(self, request):
+        """
+        Fetch request, retrying and counting successes and failures.
+        """
+        logger = get_logger(self)
+
+        attempt = 0
+        while True:
+            try:
+                async with self._slots:
+                    response = await self.http_client.fetch(request)
+            except Exception as err:  # pylint: disable=broad-except
+                if not self.retryable(err):
+                    if isinstance(err, HTTPClientError):
+                        # The style renderer answered; it just said no.
+                        self._succeeded()
+                    else:
+                        self._failed()
+                    raise
+                if attempt >= self.retries:
+                    self._failed()
+                    raise ServiceError(
+                        "Failed to contact style-renderer at '{}': {}".format(
+                            request.url, err), 503)
+
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warn('Style renderer attempt %d failed (%s); '
+                            'retrying in %.3fs', attempt + 1, err, delay)
+                RETRIES.inc()
+                attempt += 1
+                await gen.sleep(delay)
+            else:
+                self._succeeded()
+                return response
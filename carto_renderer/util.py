@@ -2,18 +2,49 @@
 Miscalenous utility functions and classes.
 """
 
+import contextvars
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
 from tornado.options import options
 
+from carto_renderer import metrics
 
-class LogWrapper(object):
+# The X-Socrata-RequestId of the request being handled. Each request's
+# task gets its own value, so concurrent requests do not see each other's.
+REQUEST_ID = contextvars.ContextVar('request_id', default=None)
+
+LOG_DROPPED = metrics.Counter(
+    'carto_renderer_log_records_dropped_total',
+    'Log records dropped because the log writer had fallen behind.')
+
+
+def call_with_request_id(request_id, func, *args):
     """
-    A logging wrapper that includes log environment automatically.
+    Call func(*args) with REQUEST_ID set to request_id.
+
+    Executor threads and processes do not inherit the caller's context,
+    so work sent to them goes through this.
     """
-    ENV = {'X-Socrata-RequestId': None}
+    token = REQUEST_ID.set(request_id)
+    try:
+        return func(*args)
+    finally:
+        REQUEST_ID.reset(token)
+
 
+class LogWrapper(object):
+    """
+    A logging wrapper that includes the request id automatically.
+    """
     class Lazy(object):         # pylint: disable=too-few-public-methods
         """
         Lazy evaluation wrapper around a thunk.
+
+        The thunk only runs if the record is written, and then on the log
+        writer's thread.
         """
         def __init__(self, thunk):
             self.thunk = thunk
@@ -24,33 +55,102 @@ class LogWrapper(object):
     def __init__(self, underlying):
         self.underlying = underlying
 
+    @staticmethod
+    def env():
+        """The extra fields for a record logged now."""
+        return {'X-Socrata-RequestId': REQUEST_ID.get()}
+
     def debug(self, *args):
         """Log a debug statement."""
-        self.underlying.debug(*args, extra=LogWrapper.ENV)
+        self.underlying.debug(*args, extra=LogWrapper.env())
 
     def info(self, *args):
         """Log an info statement."""
-        self.underlying.info(*args, extra=LogWrapper.ENV)
+        self.underlying.info(*args, extra=LogWrapper.env())
 
     def warn(self, *args):
         """Log a warning."""
-        self.underlying.warning(*args, extra=LogWrapper.ENV)
+        self.underlying.warning(*args, extra=LogWrapper.env())
 
     def error(self, *args):
         """Log an error."""
-        self.underlying.error(*args, extra=LogWrapper.ENV)
+        self.underlying.error(*args, extra=LogWrapper.env())
 
     def exception(self, *args):
         """Log an exception."""
-        self.underlying.exception(*args, extra=LogWrapper.ENV)
+        self.underlying.exception(*args, extra=LogWrapper.env())
+
+
+class _Writer(QueueListener):
+    """
+    A QueueListener that gives up on a stuck handler when stopped.
+    """
+    def stop(self, timeout=5):
+        """
+        Let the thread write what is queued, for up to timeout seconds.
+        """
+        try:
+            self.queue.put(self._sentinel, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Queue records for a thread that passes them on to target.
+
+    Logging never waits on target's output: records are formatted and
+    written by the thread, and once max_queue records are waiting, new
+    ones are dropped and counted instead. Forked children start their
+    own thread and queue.
+    """
+    def __init__(self, target, max_queue=10000):
+        super(BackgroundHandler, self).__init__(queue.Queue(max_queue))
+        self.target = target
+        self.max_queue = max_queue
+        self.listener = None
+        self.start()
+        os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        """
+        Start a writer thread with an empty queue.
+        """
+        self.queue = queue.Queue(self.max_queue)
+        self.listener = _Writer(self.queue, self.target,
+                                respect_handler_level=True)
+        self.listener.start()
+
+    def prepare(self, record):
+        """
+        Leave formatting to the writer thread; the queue is in-process.
+        """
+        return record
+
+    def enqueue(self, record):
+        """
+        Queue record, or drop it if the writer has fallen behind.
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+    def close(self):
+        """
+        Write out the queued records and stop the writer thread.
+        """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super(BackgroundHandler, self).close()
 
 
 def get_logger(obj=None):
     """
     Return a (wrapped) logger with appropriate name.
     """
-    import logging
-
     tail = '.' + obj.__class__.__name__ if obj else ''
     return LogWrapper(logging.getLogger(__package__ + tail))
 
@@ -58,8 +158,10 @@ def get_logger(obj=None):
 def init_logging():             # pragma: no cover
     """
     Initialize logging from config.
+
+    Records are written to stdout from a background thread, so a slow
+    reader cannot stall the IOLoop or the renderers.
     """
-    import logging
     import sys
 
     root_formatter = logging.Formatter(
@@ -71,7 +173,11 @@ def init_logging():             # pragma: no cover
 
     root = logging.getLogger()
     root.setLevel(options.log_level)
-    root.addHandler(root_handler)
+    # Tornado's own handler, if parse_command_line installed it, included.
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        root.addHandler(BackgroundHandler(handler))
+    root.addHandler(BackgroundHandler(root_handler))
 
     carto_formatter = logging.Formatter(options.log_format)
 
@@ -82,4 +188,4 @@ def init_logging():             # pragma: no cover
     carto = get_logger().underlying
     carto.setLevel(options.log_level)
     carto.propagate = 0
-    carto.addHandler(carto_handler)
+    carto.addHandler(BackgroundHandler(carto_handler))
@@ -0,0 +1,98 @@
+"""
+Warm-up before serving, and the readiness it gates.
+
+A cold worker pays for Mapnik's first renders, for parsing styles and for
+having the style renderer compile them on its first requests. Workers
+warm up as they start, and /ready holds traffic back until that is done.
+"""
+
+import time
+
+import mapnik                   # pylint: disable=import-error
+import msgpack
+
+SAMPLE_LAYER = 'warmup'
+SAMPLE_ZOOM = 14
+SAMPLE_FEATURES = ('POINT(64 64)',
+                   'LINESTRING(0 128, 128 192, 255 128)',
+                   'POLYGON((128 16, 240 16, 240 112, 128 112, 128 16))')
+
+
+def sample_xml():
+    """
+    Mapnik XML that draws SAMPLE_LAYER with the common symbolizers.
+
+    Labels use the first registered font, if there is one.
+    """
+    # mapnik is installed in a non-standard way.
+    # It confuses pylint.
+    # pylint: disable=no-member
+    fonts = mapnik.FontEngine.face_names()
+    text = '' if not fonts else \
+        '<TextSymbolizer face-name="{}" size="10" fill="#000000">' \
+        '[name]</TextSymbolizer>'.format(fonts[0])
+    return """<?xml version="1.0" encoding="utf-8"?>
+<Map>
+  <Style name="{layer}">
+    <Rule>
+      <MarkersSymbolizer fill="#0000cc" width="6" />
+      <LineSymbolizer stroke="#cc0000" stroke-width="2" />
+      <PolygonSymbolizer fill="#00cc00" />
+      {text}
+    </Rule>
+  </Style>
+</Map>
+""".format(layer=SAMPLE_LAYER, text=text)
+
+
+def sample_tile():
+    """
+    A tile with a labelled point, line and polygon in SAMPLE_LAYER.
+    """
+    # pylint: disable=no-member
+    return {SAMPLE_LAYER: [
+        (mapnik.Geometry.from_wkt(wkt).to_wkb(mapnik.wkbByteOrder.NDR),
+         {'name': 'warm-up'})
+        for wkt in SAMPLE_FEATURES]}
+
+
+def read_payloads(path):
+    """
+    Return the /render payloads in a file of msgpack payloads, one after
+    another (as bin/loadtest.sh --generate writes).
+    """
+    with open(path, 'rb') as payloads:
+        return list(msgpack.Unpacker(payloads, raw=True))
+
+
+class Readiness(object):
+    """
+    Whether this worker should be sent traffic: it has warmed up, and no
+    more than max_queued requests are waiting for admission.
+    """
+    def __init__(self, admission=None, max_queued=0):
+        self.admission = admission
+        self.max_queued = max_queued
+        self.warm = False
+        self.started = time.monotonic()
+        self.warm_seconds = None
+
+    def warmed(self):
+        """
+        Record that warm-up is over.
+        """
+        self.warm = True
+        self.warm_seconds = time.monotonic() - self.started
+
+    def reasons(self):
+        """
+        Return why the worker is not ready; empty when it is.
+        """
+        reasons = []
+        if not self.warm:
+            reasons.append('warming up')
+        if self.admission is not None and \
+           self.admission.queued > self.max_queued:
+            reasons.append('{} requests queued'.format(
+                self.admission.queued))
+        return reasons